@@ -15,7 +15,7 @@ from django.contrib.contenttypes.models import ContentType
 from django.db import connection
 from django_tenants.middleware import TenantMainMiddleware
 
-from accounts.models import UserInfo, UserProfile
+from teams.identity import resolve_identity
 
 
 class EventMiddleware(object):
@@ -27,12 +27,10 @@ class EventMiddleware(object):
 
     def process_view(self, request, view_func, view_args, view_kwargs):
         if request.user.is_authenticated and request.tenant is not None:
-            UserProfile.objects.get_or_create(user=request.user)
-            (user, _) = UserInfo.objects.get_or_create(user=request.user)
-            user.attendance_set.get_or_create(
-                user_info=request.user.info,
-                event=request.tenant,
-            )
+            request.identity = resolve_identity(request.user, request.tenant)
+            # Save the views looking these up again
+            request.user.profile = request.identity.profile
+            request.user.info = request.identity.info
         return
 
 
@@ -0,0 +1,21 @@
+// Open a websocket to the given path on this host which reconnects itself if the connection is lost.
+// Returns a function which tells whether the socket is currently open, so callers can fall back to polling.
+export default function openWebsocket(path, onMessage) {
+  var scheme = window.location.protocol == 'https:' ? 'wss://' : 'ws://'
+  var socket = null
+
+  function connect() {
+    socket = new WebSocket(scheme + window.location.host + path)
+    socket.onmessage = function (e) {
+      onMessage(JSON.parse(e.data))
+    }
+    socket.onclose = function () {
+      setTimeout(connect, 5000)
+    }
+  }
+  connect()
+
+  return function isOpen() {
+    return socket.readyState == WebSocket.OPEN
+  }
+}
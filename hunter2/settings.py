@@ -41,6 +41,20 @@ EMAIL_DOMAIN       = env.str       ('H2_EMAIL_DOMAIN',  default=BASE_DOMAIN)
 ADMINS             = env.list      ('H2_ADMINS',        default=[])
 SENTRY_DSN         = env.url       ('H2_SENTRY_DSN',    default=None)
 SENDFILE_BACKEND   = env.str       ('H2_SENDFILE',      default='sendfile.backends.development')
+LUA_POOL_SIZE      = env.int       ('H2_LUA_POOL_SIZE', default=4)
+LUA_POOL_MAX_USES  = env.int       ('H2_LUA_POOL_USES', default=1000)
+LUA_POOL_GROWTH    = env.int       ('H2_LUA_POOL_MEM',  default=16)
+LUA_POOL_CHECK     = env.int       ('H2_LUA_POOL_GC',   default=100)
+LUA_POOL_SCRIPTS   = env.int       ('H2_LUA_SCRIPTS',   default=64)
+LUA_WORKERS        = env.int       ('H2_LUA_WORKERS',   default=0)
+LUA_WORKER_TIMEOUT = env.float     ('H2_LUA_TIMEOUT',   default=5)
+LUA_WORKER_MEMORY  = env.int       ('H2_LUA_MEMORY',    default=256)
+ASYNC_REVALIDATION = env.bool      ('H2_ASYNC_REVALIDATE', default=False)
+ASYNC_GUESSES      = env.bool      ('H2_ASYNC_GUESSES', default=False)
+GUESS_INTERVAL     = env.float     ('H2_GUESS_INTERVAL', default=5)
+GUESS_BURST        = env.int       ('H2_GUESS_BURST',    default=1)
+CALLBACK_INTERVAL  = env.float     ('H2_CALLBACK_INTERVAL', default=0.1)
+CALLBACK_BURST     = env.int       ('H2_CALLBACK_BURST', default=20)
 
 DATABASES = {
     'default': env.db('H2_DATABASE_URL', default="postgres://postgres:postgres@db:5432/postgres")
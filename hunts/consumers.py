@@ -0,0 +1,202 @@
+# Copyright (C) 2018 The Hunter2 Contributors.
+#
+# This file is part of Hunter2.
+#
+# Hunter2 is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# Hunter2 is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import asyncio
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.layers import get_channel_layer
+from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
+from django.db import connection
+from django.http import Http404
+from django.utils import timezone
+from django_tenants.utils import get_tenant_domain_model, remove_www
+
+from teams.models import Team
+from . import rules, utils
+from .context_processors import ANNOUNCEMENT_CSS_CLASSES
+from .models import TeamPuzzleData
+
+logger = logging.getLogger(__name__)
+
+
+def puzzle_group(event, team_id, puzzle_id):
+    return f'{event.schema_name}.team-{team_id}.puzzle-{puzzle_id}'
+
+
+def announcements_group(event):
+    return f'{event.schema_name}.announcements'
+
+
+def guesses_group(event):
+    return f'{event.schema_name}.guesses'
+
+
+def group_send(group, message):
+    """Send a message to a group from synchronous code. Failures are logged rather than raised, so that an unavailable
+    channel layer does not break the request which caused the message."""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    try:
+        async_to_sync(channel_layer.group_send)(group, message)
+    except Exception:
+        logger.exception(f'Failed to send message to {group}')
+
+
+def tenant_for_scope(scope):
+    """Find the event for a websocket connection from its host, as the tenant middleware does for requests."""
+    headers = dict(scope['headers'])
+    host = headers.get(b'x-forwarded-host', headers.get(b'host', b'')).decode('latin1')
+    hostname = remove_www(host.split(',')[0].strip().split(':')[0])
+    connection.set_schema_to_public()
+    return get_tenant_domain_model().objects.select_related('tenant').get(domain=hostname).tenant
+
+
+class TenantWebsocketConsumer(AsyncJsonWebsocketConsumer):
+    """A websocket consumer for the event whose domain the connection was made to.
+
+    Database access must go through database_sync_to_async and call connection.set_tenant(self.tenant) first, since
+    every call may run in a different thread."""
+    async def connect(self):
+        self.joined_groups = []
+        try:
+            groups = await database_sync_to_async(self.setup)()
+        except (ObjectDoesNotExist, PermissionDenied, Http404):
+            await self.close()
+            return
+
+        await self.accept()
+        for group in groups:
+            await self.channel_layer.group_add(group, self.channel_name)
+            self.joined_groups.append(group)
+
+    async def disconnect(self, close_code):
+        for group in self.joined_groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    def setup(self):
+        """Check the user may connect and return the groups to join. Runs synchronously."""
+        self.tenant = tenant_for_scope(self.scope)
+        connection.set_tenant(self.tenant)
+        self.user = self.scope['user']
+        if not self.user.is_authenticated:
+            raise PermissionDenied
+        return []
+
+    async def hunts_message(self, event):
+        await self.send_json(event['content'])
+
+
+class PuzzleWebsocket(TenantWebsocketConsumer):
+    """Pushes new hints, unlocks, solves by teammates and announcements to a team's open puzzle pages."""
+    async def connect(self):
+        self.pending_hints = []
+        await super().connect()
+        self.hint_tasks = [asyncio.ensure_future(self.send_hint(delay, content)) for delay, content in self.pending_hints]
+
+    async def disconnect(self, close_code):
+        for task in self.hint_tasks:
+            task.cancel()
+        await super().disconnect(close_code)
+
+    def setup(self):
+        groups = super().setup()
+        kwargs = self.scope['url_route']['kwargs']
+        episode, self.puzzle = utils.event_episode_puzzle(self.tenant, kwargs['episode_number'], kwargs['puzzle_number'])
+        if rules.is_admin_for_puzzle(self.user, self.puzzle):
+            # Admins need not be on a team, in which case there is nothing to push to them but announcements
+            team = Team.objects.filter(at_event=self.tenant, members__user=self.user).first()
+            if team is None:
+                return groups + [announcements_group(self.tenant)]
+        else:
+            team = self.user.profile.team_at(self.tenant)
+            if not episode.started(team) or not self.puzzle.started(team) or not self.puzzle.unlocked_by(team):
+                raise PermissionDenied
+
+        # Hints are revealed by time alone, so schedule those not yet revealed to be pushed when they are
+        try:
+            start_time = TeamPuzzleData.objects.get(puzzle=self.puzzle, team=team).start_time
+        except TeamPuzzleData.DoesNotExist:
+            start_time = None
+        if start_time:
+            now = timezone.now()
+            self.pending_hints = [
+                ((start_time + hint.time - now).total_seconds(), {'type': 'hint', 'time': str(hint.time), 'text': hint.text})
+                for hint in self.puzzle.hint_set.all()
+                if start_time + hint.time > now
+            ]
+
+        return groups + [puzzle_group(self.tenant, team.pk, self.puzzle.pk), announcements_group(self.tenant)]
+
+    async def send_hint(self, delay, content):
+        await asyncio.sleep(delay)
+        await self.send_json(content)
+
+    async def hunts_announcement(self, event):
+        if event['puzzle'] is None or event['puzzle'] == self.puzzle.pk:
+            await self.send_json(event['content'])
+
+
+class GuessesWebsocket(TenantWebsocketConsumer):
+    """Pushes every new guess at the event to admins."""
+    def setup(self):
+        groups = super().setup()
+        if not rules.is_admin_for_event(self.user, self.tenant):
+            raise PermissionDenied
+        return groups + [guesses_group(self.tenant)]
+
+
+def send_guess(guess):
+    """Tell the guess's team about any solve or unlocks it caused, and admins about the guess itself."""
+    event = connection.tenant
+    team = guess.by_team
+    puzzle = guess.for_puzzle
+
+    group_send(guesses_group(event), {
+        'type': 'hunts.message',
+        'content': {
+            'type': 'guess',
+            'puzzle': puzzle.pk,
+            'team': team.pk,
+            'user': guess.by.pk,
+            'guess': guess.guess,
+            'correct': guess.correct_for_id is not None,
+            'given': guess.given.isoformat(),
+        },
+    })
+
+    if guess.correct_for_id is not None:
+        content = {'type': 'solved', 'by': guess.by.username}
+        content.update(utils.next_puzzle_link(puzzle.episode, team))
+        group_send(puzzle_group(event, team.pk, puzzle.pk), {'type': 'hunts.message', 'content': content})
+    elif guess.unlocks.exists():
+        group_send(puzzle_group(event, team.pk, puzzle.pk), {
+            'type': 'hunts.message',
+            'content': {'type': 'unlocks', 'unlocks': utils.unlocks_json(puzzle, team, guess)},
+        })
+
+
+def send_announcement(announcement):
+    group_send(announcements_group(connection.tenant), {
+        'type': 'hunts.announcement',
+        'puzzle': announcement.puzzle_id,
+        'content': {
+            'type': 'announcement',
+            'title': announcement.title,
+            'message': announcement.message,
+            'css_type': ANNOUNCEMENT_CSS_CLASSES[announcement.type],
+        },
+    })
@@ -0,0 +1,155 @@
+# Copyright (C) 2018 The Hunter2 Contributors.
+#
+# This file is part of Hunter2.
+#
+# Hunter2 is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# Hunter2 is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from string import Template
+
+from django.core.cache import cache
+from django.db import connection, transaction
+
+from .runtimes.static import StaticRuntime
+from .utils import bump_cache_version, cache_version
+
+CONTENT_CACHE_TIMEOUT = 24 * 60 * 60  # Seconds
+CONTENT_LOCAL_TIMEOUT = 5  # Seconds
+CONTENT_LOCAL_MAX_SIZE = 1000  # Values kept in this process for each event
+
+
+class ContentCache:
+    """Caches values calculated from an event's content, which hardly changes while the event is running.
+
+    Values are kept in the configured cache against a version for the event which is bumped whenever any of its content
+    is saved, and in this process for up to CONTENT_LOCAL_TIMEOUT seconds before the version is checked again. So other
+    processes may show old content for that long after it changes; this process drops it straight away. Without a
+    configured cache the values are only kept in this process. At most CONTENT_LOCAL_MAX_SIZE values are kept in this
+    process for each event, dropping the least recently used.
+
+    The version is only bumped by the signals in hunts.signals.content_changed, for EventFile, PuzzleFile, SolutionFile
+    and Hint. Anything cached here must be calculated from those models alone, or from its name, or the signal must be
+    extended to cover what it depends on; otherwise it will be out of date for up to CONTENT_CACHE_TIMEOUT."""
+    def __init__(self):
+        # Maps each schema to when it must next be checked, the version it was checked against and the values cached
+        # against that version in this process
+        self._local = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _version_key(schema_name):
+        return f'hunts.content.{schema_name}.version'
+
+    def _local_values(self, schema_name):
+        now = time.monotonic()
+        with self._lock:
+            (expires, local_version, values) = self._local.get(schema_name, (None, None, OrderedDict()))
+            if expires is not None and now < expires:
+                return local_version, values
+
+        version = cache_version(self._version_key(schema_name))
+        with self._lock:
+            if version is None or version != local_version:
+                values = OrderedDict()
+            self._local[schema_name] = (now + CONTENT_LOCAL_TIMEOUT, version, values)
+        return version, values
+
+    def get(self, name, calculate):
+        """Return the value cached under name for the current event, calling calculate to get it if it is not cached."""
+        schema_name = connection.schema_name
+        (version, values) = self._local_values(schema_name)
+        with self._lock:
+            if name in values:
+                values.move_to_end(name)
+                return values[name]
+
+        if version is None:
+            value = calculate()
+        else:
+            key = f'hunts.content.{schema_name}.{version}.{name}'
+            value = cache.get(key)
+            if value is None:
+                value = calculate()
+                cache.set(key, value, CONTENT_CACHE_TIMEOUT)
+        with self._lock:
+            values[name] = value
+            while len(values) > CONTENT_LOCAL_MAX_SIZE:
+                values.popitem(last=False)
+        return value
+
+    def _drop_local(self, schema_name):
+        with self._lock:
+            self._local.pop(schema_name, None)
+
+    def invalidate(self):
+        """Mark every value cached for the current event out of date.
+
+        Values in this process are dropped straight away, and again once the current transaction is committed in case
+        they were calculated again in the meantime; the version is bumped for other processes once it is committed."""
+        schema_name = connection.schema_name
+        self._drop_local(schema_name)
+        transaction.on_commit(lambda: self._drop_local(schema_name))
+        bump_cache_version(self._version_key(schema_name))
+
+
+content_cache = ContentCache()
+
+
+def event_files(event):
+    """Return a dictionary of the slugs of the event's files to their URLs."""
+    return content_cache.get('event_files', lambda: {
+        f.slug: f.file.url for f in event.eventfile_set.filter(slug__isnull=False)
+    })
+
+
+def puzzle_files(puzzle):
+    """Return a dictionary of the slugs of the puzzle's files to their URL paths."""
+    return content_cache.get(f'puzzle_files.{puzzle.pk}', lambda: dict(
+        puzzle.puzzlefile_set.filter(slug__isnull=False).values_list('slug', 'url_path')
+    ))
+
+
+def solution_files(puzzle):
+    """Return a dictionary of the slugs of the puzzle's solution files to their URL paths."""
+    return content_cache.get(f'solution_files.{puzzle.pk}', lambda: dict(
+        puzzle.solutionfile_set.filter(slug__isnull=False).values_list('slug', 'url_path')
+    ))
+
+
+def hints(puzzle):
+    """Return a list of the puzzle's hints in the order they are revealed."""
+    return content_cache.get(f'hints.{puzzle.pk}', lambda: list(puzzle.hint_set.order_by('time')))
+
+
+def substitute(text, files):
+    """Return the text with the URLs of the files substituted for their slugs.
+
+    The result is cached against a hash of the text and files, so editing either renders the text afresh."""
+    digest = hashlib.sha256(repr((text, sorted(files.items()))).encode()).hexdigest()
+    return content_cache.get(f'substituted.{digest}', lambda: Template(text).safe_substitute(**files))
+
+
+def render(runtime, script, files, data):
+    """Return the script evaluated by the runtime for the puzzle data, with the files substituted into the result.
+
+    Static scripts evaluate to the same text for every team so are substituted through the cache; other runtimes are
+    evaluated on every call."""
+    if runtime.type is StaticRuntime:
+        return substitute(script, files)
+    return Template(runtime.create().evaluate(
+        script,
+        data.tp_data,
+        data.up_data,
+        data.t_data,
+        data.u_data,
+    )).safe_substitute(**files)
@@ -11,10 +11,50 @@
 # You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from django.core.cache import cache
+from django.db import connection
 from django.db.models import Q
 
 from hunts import models
 from hunts.models import AnnouncementType
+from hunts.utils import bump_cache_version, cache_version
+
+ANNOUNCEMENTS_CACHE_TIMEOUT = 60 * 60  # Seconds
+
+ANNOUNCEMENT_CSS_CLASSES = {
+    AnnouncementType.INFO: 'alert-info',
+    AnnouncementType.SUCCESS: 'alert-success',
+    AnnouncementType.WARNING: 'alert-warning',
+    AnnouncementType.ERROR: 'alert-danger',
+}
+
+
+def _version_key():
+    return f'hunts.announcements.{connection.schema_name}.version'
+
+
+def event_announcements(event):
+    """Return a list of the event's announcements, including those for a single puzzle, in the order they were posted.
+
+    The list is cached until an announcement is saved or deleted."""
+    def load():
+        return list(models.Announcement.objects.filter(Q(event__isnull=True) | Q(event=event)).order_by('posted', 'pk'))
+
+    version = cache_version(_version_key())
+    if version is None:
+        return load()
+
+    key = f'hunts.announcements.{connection.schema_name}.{version}'
+    result = cache.get(key)
+    if result is None:
+        result = load()
+        cache.set(key, result, ANNOUNCEMENTS_CACHE_TIMEOUT)
+    return result
+
+
+def invalidate_announcements():
+    """Mark the announcements of the current event out of date once the current transaction is committed."""
+    bump_cache_version(_version_key())
 
 
 def announcements(request):
@@ -23,35 +63,27 @@ def announcements(request):
         return {}
 
     # Get all announcements, including puzzle specific announcements if present
-    has_puzzle = hasattr(request, 'puzzle') and request.puzzle is not None
-
-    css_class = {
-        AnnouncementType.INFO: 'alert-info',
-        AnnouncementType.SUCCESS: 'alert-success',
-        AnnouncementType.WARNING: 'alert-warning',
-        AnnouncementType.ERROR: 'alert-danger',
-    }
+    puzzle = getattr(request, 'puzzle', None)
+    puzzle_id = puzzle.pk if puzzle is not None else None
+    current_announcements = [
+        a for a in event_announcements(request.tenant) if a.puzzle_id is None or a.puzzle_id == puzzle_id
+    ]
 
-    if has_puzzle:
-        current_announcements = models.Announcement.objects.filter(
-            (Q(event__isnull=True) | Q(event=request.tenant)) &
-            (Q(puzzle__isnull=True) | Q(puzzle=request.puzzle)))
-    else:
-        current_announcements = models.Announcement.objects.filter(
-            (Q(event__isnull=True) | Q(event=request.tenant)) &
-            (Q(puzzle__isnull=True)))
-
-    if request.user.is_authenticated and request.user.info.attendance_at(request.tenant).seat == '':
-        current_announcements = list(current_announcements) + [models.Announcement(
-            event=request.tenant,
-            title='No Seat Set',
-            message="You don't have a seat set at this event. Set your seat on the account page.",
-            type=AnnouncementType.WARNING,
-        )]
+    if request.user.is_authenticated:
+        # EventMiddleware has usually loaded the attendance already
+        identity = getattr(request, 'identity', None)
+        attendance = identity.attendance if identity else request.user.info.attendance_at(request.tenant)
+        if attendance.seat == '':
+            current_announcements.append(models.Announcement(
+                event=request.tenant,
+                title='No Seat Set',
+                message="You don't have a seat set at this event. Set your seat on the account page.",
+                type=AnnouncementType.WARNING,
+            ))
 
     # TODO: This is relatively closely linked to the CSS so perhaps should be further moved to the view / template
     for announcement in current_announcements:
-        announcement.css_type = css_class[announcement.type]
+        announcement.css_type = ANNOUNCEMENT_CSS_CLASSES[announcement.type]
 
     return {
         'announcements': current_announcements
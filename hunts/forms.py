@@ -43,7 +43,8 @@ class AnswerForm(forms.ModelForm):
             # We are adding a new puzzle, it won't have any guesses
             return cleaned_data
 
-        old_valid_guesses = [g for g in guesses if self.instance.validate_guess(g)]
+        old_validator = self.instance.validator()
+        old_valid_guesses = self.valid_guesses(guesses, old_validator)
 
         if cleaned_data['DELETE']:
             # If we delete this answer, no guesses will validate against it
@@ -56,7 +57,8 @@ class AnswerForm(forms.ModelForm):
                 answer=cleaned_data['answer']
             )
             guesses = Guess.objects.filter(for_puzzle=new_answer.for_puzzle)
-            new_valid_guesses = [g for g in guesses if new_answer.validate_guess(g)]
+            new_validator = new_answer.validator()
+            new_valid_guesses = self.valid_guesses(guesses, new_validator)
 
         # Has anything actually changed?
         if old_valid_guesses == new_valid_guesses:
@@ -101,6 +103,16 @@ class AnswerForm(forms.ModelForm):
 
         return cleaned_data
 
+    @staticmethod
+    def valid_guesses(guesses, validator):
+        """Return the guesses which pass the validator, checking each distinct guess string only once"""
+
+        matches = {}
+        for g in guesses:
+            if g.guess not in matches:
+                matches[g.guess] = validator(g.guess)
+        return [g for g in guesses if matches[g.guess]]
+
     def collect_guesses(self, guesses):
         """Collect guesses by team"""
 
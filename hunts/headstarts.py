@@ -0,0 +1,76 @@
+# Copyright (C) 2018 The Hunter2 Contributors.
+#
+# This file is part of Hunter2.
+#
+# Hunter2 is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# Hunter2 is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import defaultdict
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Sum
+
+from .utils import bump_cache_version, cache_version
+
+HEADSTART_CACHE_TIMEOUT = 60 * 60  # Seconds
+
+
+def _prefix():
+    return f'hunts.headstarts.{connection.schema_name}'
+
+
+def _calculate(team):
+    from .models import Episode, Headstart, TeamPuzzleProgress
+
+    granted = defaultdict(timedelta)
+    granted.update({
+        p['puzzle__episode']: p['headstart']
+        for p in TeamPuzzleProgress.objects.filter(
+            team=team, puzzle__episode__isnull=False,
+        ).values('puzzle__episode').annotate(headstart=Sum('puzzle__headstart_granted'))
+    })
+
+    applied = defaultdict(timedelta)
+    for h in Headstart.objects.filter(team=team):
+        applied[h.episode_id] += h.headstart_adjustment
+    # Each row says that the 'from' episode is given a headstart by the 'to' episode
+    for episode_id, source_id in Episode.headstart_from.through.objects.values_list('from_episode_id', 'to_episode_id'):
+        applied[episode_id] += granted[source_id]
+
+    return {'granted': dict(granted), 'applied': dict(applied)}
+
+
+def team_headstarts(team):
+    """Return the headstart the team has earned from each episode and that applied to each episode as a dictionary with
+    'granted' and 'applied' keys, each mapping episode IDs to timedeltas. Episodes without a headstart are left out.
+
+    The result is cached until the team's progress changes, or puzzles, episodes or headstarts are edited."""
+    if team is None:
+        return {'granted': {}, 'applied': {}}
+
+    # Headstarts are recalculated when either every team's or just this team's version changes
+    event_version = cache_version(f'{_prefix()}.version')
+    team_version = cache_version(f'{_prefix()}.team-{team.pk}.version')
+    if event_version is None or team_version is None:
+        return _calculate(team)
+
+    key = f'{_prefix()}.team-{team.pk}.{event_version}.{team_version}'
+    headstarts = cache.get(key)
+    if headstarts is None:
+        headstarts = _calculate(team)
+        cache.set(key, headstarts, HEADSTART_CACHE_TIMEOUT)
+    return headstarts
+
+
+def invalidate_headstarts(team_id=None):
+    """Mark the headstarts of the team with the given ID, or every team, out of date once the current transaction is
+    committed."""
+    bump_cache_version(f'{_prefix()}.version' if team_id is None else f'{_prefix()}.team-{team_id}.version')
@@ -0,0 +1,70 @@
+# Copyright (C) 2018 The Hunter2 Contributors.
+#
+# This file is part of Hunter2.
+#
+# Hunter2 is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# Hunter2 is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+import queue
+import threading
+
+from django.db import close_old_connections, connection, transaction
+
+logger = logging.getLogger(__name__)
+
+_queue = queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def update_derived_later(guess, created):
+    """Update the records derived from a saved guess in a background worker once the current transaction commits, then
+    tell the guess's team and admins about it."""
+    tenant = connection.tenant
+    transaction.on_commit(lambda: _enqueue(tenant, guess.pk, created))
+
+
+def _enqueue(tenant, guess_id, created):
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_work, name='guess-ingestion', daemon=True)
+            _worker.start()
+    _queue.put((tenant, guess_id, created))
+
+
+def _work():
+    while True:
+        tenant, guess_id, created = _queue.get()
+        # The worker lives as long as the process, so do what a request would to avoid holding on to broken connections
+        close_old_connections()
+        try:
+            process(tenant, guess_id, created)
+        except Exception:
+            logger.exception(f'Failed to process guess {guess_id}')
+        finally:
+            _queue.task_done()
+
+
+def process(tenant, guess_id, created):
+    """Update the records derived from the guess with the given ID at the event and tell its team and admins about it.
+
+    `created` says whether the guess had just been created when it was saved."""
+    from . import consumers
+    from .models import Guess
+
+    connection.set_tenant(tenant)
+    try:
+        guess = Guess.objects.select_related('for_puzzle__episode', 'by__user', 'by_team').get(pk=guess_id)
+    except Guess.DoesNotExist:
+        return
+    with transaction.atomic():
+        guess.update_derived(created)
+    consumers.send_guess(guess)
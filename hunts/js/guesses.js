@@ -4,13 +4,56 @@ import 'bootstrap'
 import '../scss/guesses.scss'
 
 import setupJQueryAjaxCsrf from 'hunter2/js/csrf.js'
+import openWebsocket from 'hunter2/js/websocket.js'
+
+var socketOpen = function () { return false }
+var pendingUpdate = null
+
+// The live view is at most this many guesses long, after which it is reloaded to trim it back to a single page
+var maxGuesses = 200
+
+function scheduleUpdate() {
+  // New guesses are pushed to us while the websocket is open. Otherwise go for more guesses 5 seconds after
+  // we're done getting the last lot of guesses.
+  if (!socketOpen()) {
+    setTimeout(updateGuesses, 5000)
+  }
+}
 
 function updateGuesses(force) {
-  if (force || $('#auto-update').prop('checked')) {
-    $('#guesses-container').load('guesses_content' + window.location.search + ' #guesses-container', function() {
-      // Go for more guesses 5 seconds after we're done getting the last lot of guesses.
-      setTimeout(updateGuesses, 5000)
-    })
+  if (!(force || $('#auto-update').prop('checked'))) {
+    return
+  }
+  var table = $('#guesses-table')
+  var newest = table.data('newest')
+  if (force || !newest || table.find('.guess-viewer-guess').length > maxGuesses) {
+    $('#guesses-container').load('guesses_content' + window.location.search + ' #guesses-container', scheduleUpdate)
+    return
+  }
+  // Only fetch the guesses newer than the newest we already have
+  var search = window.location.search ? window.location.search + '&' : '?'
+  $.get('guesses_content' + search + 'after=' + encodeURIComponent(newest), {}, function (content) {
+    var newTable = $($.parseHTML(content)).find('#guesses-table')
+    if (newTable.data('more-newer')) {
+      // There are too many new guesses to fit on one page, so skip straight to the latest page
+      updateGuesses(true)
+      return
+    }
+    if (newTable.data('newest')) {
+      table.find('.guess-viewer-header').after(newTable.find('.guess-viewer-guess'))
+      table.data('newest', newTable.data('newest'))
+    }
+    scheduleUpdate()
+  })
+}
+
+function receiveMessage(message) {
+  if (message.type == 'guess' && !pendingUpdate) {
+    // Guesses often arrive in bursts, so wait a moment to pick them up together
+    pendingUpdate = setTimeout(function () {
+      pendingUpdate = null
+      updateGuesses()
+    }, 1000)
   }
 }
 
@@ -33,10 +76,10 @@ function getQueryParam(param) {
 $(function () {
   setupJQueryAjaxCsrf()
 
+  socketOpen = openWebsocket(window.location.pathname + '/ws', receiveMessage)
   updateGuesses(true)
   var autoUpdate = $('#auto-update')
-  var page = parseInt(getQueryParam('page'))
-  if (page > 1) {
+  if (getQueryParam('before') || getQueryParam('after')) {
     autoUpdate.prop('checked', false)
   }
   autoUpdate.click(function () {
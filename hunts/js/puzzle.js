@@ -5,6 +5,7 @@ import { easeLinear, format, select } from 'd3'
 import '../scss/puzzle.scss'
 
 import setupJQueryAjaxCsrf from 'hunter2/js/csrf.js'
+import openWebsocket from 'hunter2/js/websocket.js'
 
 function escapeHtml(text) {
   return text.replace(/["&<>]/g, function (a) {
@@ -13,23 +14,14 @@ function escapeHtml(text) {
 }
 
 function incorrect_answer(guess, timeout_length, timeout, new_hints, unlocks) {
-  var hints_div = $('#hints')
   var n_hints = new_hints.length
   for (let i = 0; i < n_hints; i++) {
-    hints_div.append('<p>' + new_hints[i].time + ': ' + new_hints[i].text + '</p>')
+    add_hint(new_hints[i])
   }
 
-  var unlocks_div = $('#unlocks')
-  unlocks_div.empty()
-
-  var n_unlocks = unlocks.length
-  for (let i = 0; i < n_unlocks; i++) {
-    var guesses = unlocks[i].guesses.join(', ')
-    if (unlocks[i].new) {
-      unlocks_div.append('<p class="new-unlock">' + escapeHtml(guesses) + ': ' + unlocks[i].text + '</p>')
-    } else {
-      unlocks_div.append('<p>' + escapeHtml(guesses) + ': ' + unlocks[i].text + '</p>')
-    }
+  // Unlocks are left out when they are pushed over the websocket instead
+  if (unlocks !== undefined) {
+    update_unlocks(unlocks)
   }
 
   var milliseconds = Date.parse(timeout) - Date.now()
@@ -49,6 +41,49 @@ function incorrect_answer(guess, timeout_length, timeout, new_hints, unlocks) {
   }, milliseconds)
 }
 
+function add_hint(hint) {
+  $('#hints').append('<p>' + hint.time + ': ' + hint.text + '</p>')
+}
+
+function update_unlocks(unlocks) {
+  var unlocks_div = $('#unlocks')
+  unlocks_div.empty()
+
+  var n_unlocks = unlocks.length
+  for (let i = 0; i < n_unlocks; i++) {
+    var guesses = unlocks[i].guesses.join(', ')
+    if (unlocks[i].new) {
+      unlocks_div.append('<p class="new-unlock">' + escapeHtml(guesses) + ': ' + unlocks[i].text + '</p>')
+    } else {
+      unlocks_div.append('<p>' + escapeHtml(guesses) + ': ' + unlocks[i].text + '</p>')
+    }
+  }
+}
+
+function add_announcement(announcement) {
+  $('main header').first().before(
+    '<div class="alert ' + announcement.css_type + '" role="alert"><strong>' + escapeHtml(announcement.title) + '</strong> ' +
+    escapeHtml(announcement.message) + '</div>'
+  )
+}
+
+function receive_message(message) {
+  if (message.type == 'hint') {
+    add_hint(message)
+    // Don't have the hint sent again in response to the next answer
+    last_updated = Date.now()
+  } else if (message.type == 'unlocks') {
+    update_unlocks(message.unlocks)
+  } else if (message.type == 'solved') {
+    if (!$('#correct-answer-message').length) {
+      $('#correct-answer-pending').remove()
+      correct_answer(message.url, message.text)
+    }
+  } else if (message.type == 'announcement') {
+    add_announcement(message)
+  }
+}
+
 function correct_answer(url, text) {
   var form = $('.form-inline')
   form.after(`<div id="correct-answer-message">Correct! Taking you ${text}. <a class="puzzle-complete-redirect" href="${url}">go right now</a></div>`)
@@ -56,6 +91,12 @@ function correct_answer(url, text) {
   setTimeout(function () {window.location.href = url}, 3000)
 }
 
+function correct_answer_pending() {
+  var form = $('.form-inline')
+  form.after('<div id="correct-answer-pending">Correct!</div>')
+  form.remove()
+}
+
 function message(message, error) {
   var error_msg = $('<p class="submission-error" title="' + error + '">' + message + '</p>')
   error_msg.appendTo($('.form-inline')).delay(5000).fadeOut(5000, function(){$(this).remove()})
@@ -202,6 +243,8 @@ $(function() {
 
   addSVG()
 
+  openWebsocket(window.location.pathname + 'ws', receive_message)
+
   let field = $('#answer-entry')
   let button = $('#answer-button')
 
@@ -237,7 +280,12 @@ $(function() {
         last_updated = Date.now()
         if (data.correct == 'true') {
           button.removeAttr('disabled')
-          correct_answer(data.url, data.text)
+          if (data.url) {
+            correct_answer(data.url, data.text)
+          } else if (!$('#correct-answer-message').length) {
+            // Where to go next will be pushed over the websocket once the solve has been recorded
+            correct_answer_pending()
+          }
         } else {
           incorrect_answer(data.guess, data.timeout_length, data.timeout_end, data.new_hints, data.unlocks)
         }
@@ -4,6 +4,7 @@ import * as d3 from 'd3'
 import '../scss/stats.scss'
 
 import setupJQueryAjaxCsrf from 'hunter2/js/csrf.js'
+import openWebsocket from 'hunter2/js/websocket.js'
 
 // Keep the number of entries in here such that it has a large least common multiple with the number of colours.
 var symbolsPathList = [
@@ -37,6 +38,7 @@ var entityMap = {
 
 var globalData = null
 var timeout = null
+var socketOpen = function () { return false }
 var invisteams = []
 
 function escapeHtml (string) {
@@ -52,10 +54,14 @@ function getStats(force) {
   if (!(force || $('#auto-update').prop('checked'))) {
     return
   }
-  $.get('stats_content/' + $('#episode').val(), {}, function (data) {
-    // Get new stats 5 seconds after we got last stats
-    timeout = setTimeout(getStats, 5000)
-    globalData = data
+  var episode = $('#episode').val()
+  // Series which have not changed since the stats we already have for this episode are left out of the response
+  var params = (globalData && globalData.episode == episode && globalData.cursor !== null) ? {since: globalData.cursor} : {}
+  $.get('stats_content/' + episode, params, function (data) {
+    // Correct guesses are pushed to us while the websocket is open. Otherwise get new stats 5 seconds after we got
+    // last stats
+    timeout = setTimeout(getStats, socketOpen() ? 60000 : 5000)
+    globalData = $.extend(params.since === undefined ? {} : globalData, data, {episode: episode})
     drawGraph()
     restoreView(invisteams)
   })
@@ -597,9 +603,24 @@ function restoreView(invisteams) {
 
 var drawFunction = drawCompletion
 
+// Milliseconds to wait after a pushed solve before getting new stats, so that a burst of solves needs one request
+var pushedSolveDelay = 10000
+var pushedSolveTimeout = null
+
+function receiveMessage(message) {
+  // Only solves change the stats; stuckness grows with time anyway so is picked up by the slower polling
+  if (message.type == 'guess' && message.correct && pushedSolveTimeout === null) {
+    pushedSolveTimeout = setTimeout(function () {
+      pushedSolveTimeout = null
+      getStats()
+    }, pushedSolveDelay)
+  }
+}
+
 $(function () {
   setupJQueryAjaxCsrf()
 
+  socketOpen = openWebsocket('/huntadmin/guesses/ws', receiveMessage)
   $.get('episode_list', {}, function (episodes) {
     var select = $('#episode')
     select.children(':not([value="all"])').remove()
@@ -0,0 +1,122 @@
+# Copyright (C) 2018 The Hunter2 Contributors.
+#
+# This file is part of Hunter2.
+#
+# Hunter2 is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# Hunter2 is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import time
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.management import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from accounts.models import UserProfile
+from teams.models import Team
+from ...models import Answer, Episode, Guess, Puzzle, TeamPuzzleProgress
+
+
+class Command(BaseCommand):
+    help = 'Fills an event with generated guesses and prints the query plans of the main guess lookups. ' \
+           'Everything generated is rolled back afterwards. Run for an event with tenant_command.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--guesses', type=int, default=1000000, help='Number of guesses to generate')
+        parser.add_argument('--puzzles', type=int, default=50, help='Number of puzzles to spread the guesses over')
+        parser.add_argument('--teams', type=int, default=500, help='Number of single-member teams to make the guesses')
+        parser.add_argument('--correct', type=float, default=0.01, help='Proportion of guesses which are correct')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            puzzles, answers, teams, profiles = self.create_structure(options['puzzles'], options['teams'])
+            start = time.monotonic()
+            self.create_guesses(options['guesses'], options['correct'], answers, teams, profiles)
+            self.stdout.write(f'Generated {options["guesses"]} guesses in {time.monotonic() - start:.1f}s')
+
+            puzzle = puzzles[0]
+            team = teams[0]
+            puzzle._rebuild_progress()
+
+            self.explain('Each team\'s first correct guess, when rebuilding progress', Guess.objects.filter(
+                for_puzzle=puzzle, by_team__isnull=False, correct_for__isnull=False,
+            ).order_by('by_team', 'given').distinct('by_team').only('id', 'by_team', 'given'))
+            self.explain('Puzzle.first_correct_guesses', TeamPuzzleProgress.objects.filter(
+                puzzle=puzzle,
+            ).select_related('team', 'solving_guess'))
+            self.explain('Puzzle.answered_by', Guess.objects.filter(
+                by__in=team.members.all(), for_puzzle=puzzle,
+            ).order_by('given').select_related('correct_for'))
+            self.explain('Puzzle.update_progress', Guess.objects.filter(
+                for_puzzle=puzzle, by_team=team,
+            ).order_by('given').select_related('correct_for'))
+            self.explain('Latest guess, when rate limiting without a cache', Guess.objects.filter(
+                for_puzzle=puzzle, by=profiles[0],
+            ).order_by('-given')[:1])
+            self.explain('GuessesContent, newest page', Guess.objects.order_by('-given', '-id')[:51])
+            self.explain('GuessesContent, newest page for a puzzle', Guess.objects.filter(
+                for_puzzle=puzzle,
+            ).order_by('-given', '-id')[:51])
+            self.explain('GuessesContent, newest page for a team', Guess.objects.filter(
+                by_team=team,
+            ).order_by('-given', '-id')[:51])
+
+            transaction.set_rollback(True)
+
+    def create_structure(self, n_puzzles, n_teams):
+        event = connection.tenant
+        # Names must be unique, and may clash with those left by a run which was not rolled back
+        prefix = f'benchmark-{uuid.uuid4().hex[:8]}'
+        episode = Episode.objects.create(event=event, name=prefix, start_date=timezone.now())
+        puzzles = [Puzzle.objects.create(episode=episode, title=f'{prefix}-{i}', content='') for i in range(n_puzzles)]
+        answers = [Answer.objects.create(for_puzzle=p, answer=f'answer-{p.pk}') for p in puzzles]
+
+        users = User.objects.bulk_create(User(username=f'{prefix}-{i}') for i in range(n_teams))
+        profiles = UserProfile.objects.bulk_create(UserProfile(user=u) for u in users)
+        teams = Team.objects.bulk_create(Team(at_event=event, name=f'{prefix}-{i}') for i in range(n_teams))
+        Team.members.through.objects.bulk_create(
+            Team.members.through(team_id=t.pk, userprofile_id=p.pk) for t, p in zip(teams, profiles)
+        )
+        return puzzles, answers, teams, profiles
+
+    def create_guesses(self, n_guesses, correct, answers, teams, profiles):
+        # Generating the guesses in the database is many times faster than sending them from here
+        with connection.cursor() as cursor:
+            cursor.execute(
+                '''
+                INSERT INTO hunts_guess (id, for_puzzle_id, by_id, by_team_id, guess, given, correct_current, correct_for_id)
+                SELECT
+                    md5(random()::text || i::text)::uuid,
+                    (%(puzzles)s::int[])[1 + i %% %(n_puzzles)s],
+                    (%(profiles)s::int[])[1 + i %% %(n_teams)s],
+                    (%(teams)s::int[])[1 + i %% %(n_teams)s],
+                    md5(i::text),
+                    now() - interval '1 second' * (%(n_guesses)s - i),
+                    true,
+                    CASE WHEN random() < %(correct)s THEN (%(answers)s::int[])[1 + i %% %(n_puzzles)s] END
+                FROM generate_series(1, %(n_guesses)s) AS i
+                ''',
+                {
+                    'puzzles': [a.for_puzzle_id for a in answers],
+                    'answers': [a.pk for a in answers],
+                    'profiles': [p.pk for p in profiles],
+                    'teams': [t.pk for t in teams],
+                    'n_puzzles': len(answers),
+                    'n_teams': len(teams),
+                    'n_guesses': n_guesses,
+                    'correct': correct,
+                },
+            )
+            cursor.execute('ANALYZE hunts_guess')
+
+    def explain(self, title, queryset):
+        self.stdout.write(self.style.MIGRATE_HEADING(title))
+        self.stdout.write(queryset.explain(analyze=True, buffers=True))
+        self.stdout.write('')
@@ -0,0 +1,41 @@
+# Copyright (C) 2018 The Hunter2 Contributors.
+#
+# This file is part of Hunter2.
+#
+# Hunter2 is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# Hunter2 is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from ...models import Puzzle
+
+
+class Command(BaseCommand):
+    help = 'Revalidates every guess and rebuilds every team\'s progress and standings. Run for an event with tenant_command.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--puzzle',
+            dest='puzzle_ids',
+            type=int,
+            action='append',
+            help="Only rebuild progress on the puzzle with this ID (may be repeated)",
+            default=None,
+        )
+
+    def handle(self, *args, **options):
+        puzzles = Puzzle.objects.all()
+        if options['puzzle_ids']:
+            puzzles = puzzles.filter(pk__in=options['puzzle_ids'])
+
+        for puzzle in puzzles:
+            with transaction.atomic():
+                changed = puzzle.revalidate_guesses()
+            self.stdout.write(f'{puzzle}: {changed} guesses changed')
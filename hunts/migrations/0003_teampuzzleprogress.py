@@ -0,0 +1,51 @@
+# Generated by Django 2.1.7 on 2019-03-16 11:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_progress(apps, schema_editor):
+    Guess = apps.get_model('hunts', 'Guess')
+    TeamPuzzleProgress = apps.get_model('hunts', 'TeamPuzzleProgress')
+    solved = set()
+    for guess in Guess.objects.filter(correct_for__isnull=False, by_team__isnull=False).order_by('given'):
+        if (guess.for_puzzle_id, guess.by_team_id) not in solved:
+            solved.add((guess.for_puzzle_id, guess.by_team_id))
+            TeamPuzzleProgress.objects.create(
+                puzzle_id=guess.for_puzzle_id,
+                team_id=guess.by_team_id,
+                solved_at=guess.given,
+                solving_guess=guess,
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('teams', '0002_auto_20180513_1909'),
+        ('hunts', '0002_auto_20190305_0948'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TeamPuzzleProgress',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('solved_at', models.DateTimeField()),
+                ('puzzle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='hunts.Puzzle')),
+                ('solving_guess', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='hunts.Guess')),
+                ('team', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='teams.Team')),
+            ],
+            options={
+                'verbose_name_plural': 'Team puzzle progress',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='teampuzzleprogress',
+            unique_together={('puzzle', 'team')},
+        ),
+        migrations.RunPython(
+            code=populate_progress,
+            reverse_code=migrations.RunPython.noop,
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.1.7 on 2019-03-17 14:26
+
+from django.db import migrations, models
+
+
+def populate_unlocks(apps, schema_editor):
+    Guess = apps.get_model('hunts', 'Guess')
+    Unlock = apps.get_model('hunts', 'Unlock')
+    GuessUnlock = Guess.unlocks.through
+    for unlock in Unlock.objects.prefetch_related('unlockanswer_set'):
+        validators = [u.runtime.create().create_validator(u.guess) for u in unlock.unlockanswer_set.all()]
+        GuessUnlock.objects.bulk_create(
+            GuessUnlock(guess_id=guess.id, unlock_id=unlock.id)
+            for guess in Guess.objects.filter(for_puzzle_id=unlock.puzzle_id)
+            if any(validator(guess.guess) for validator in validators)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hunts', '0003_teampuzzleprogress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='guess',
+            name='unlocks',
+            field=models.ManyToManyField(blank=True, editable=False, related_name='guesses', to='hunts.Unlock'),
+        ),
+        migrations.RunPython(
+            code=populate_unlocks,
+            reverse_code=migrations.RunPython.noop,
+        ),
+    ]
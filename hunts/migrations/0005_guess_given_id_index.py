@@ -0,0 +1,17 @@
+# Generated by Django 2.1.7 on 2019-03-18 20:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hunts', '0004_guess_unlocks'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='guess',
+            index=models.Index(fields=['given', 'id'], name='hunts_guess_given_id'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.1.7 on 2019-03-24 15:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hunts', '0005_guess_given_id_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='guess',
+            index=models.Index(fields=['for_puzzle', 'by_team', 'given'], name='hunts_guess_puzzle_team_given'),
+        ),
+        migrations.AddIndex(
+            model_name='guess',
+            index=models.Index(fields=['for_puzzle', 'by', 'given'], name='hunts_guess_puzzle_by_given'),
+        ),
+        migrations.AlterField(
+            model_name='guess',
+            name='for_puzzle',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='hunts.Puzzle'),
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX hunts_guess_puzzle_team_solved ON hunts_guess (for_puzzle_id, by_team_id, given) '
+            'WHERE correct_for_id IS NOT NULL',
+            'DROP INDEX hunts_guess_puzzle_team_solved',
+        ),
+    ]
@@ -19,6 +19,7 @@ from django.urls import reverse
 from . import rules
 from . import utils
 from .models import Puzzle
+from .progress import TeamProgress
 
 # If PuzzleUnlockedMixin inherits from EpisodeUnlockedMixin the dispatch methods execute in the wrong order
 
@@ -28,8 +29,9 @@ class EpisodeUnlockedMixin():
         # Views using this mixin inevitably want the episode object so keep it on the request
         request.episode = utils.event_episode(request.tenant, episode_number)
         request.admin = rules.is_admin_for_episode(request.user, request.episode)
+        request.progress = TeamProgress(request.tenant, request.team)
 
-        if not request.episode.started(request.team) and not request.admin:
+        if not request.progress.episode_started(request.episode) and not request.admin:
             if request.is_ajax():
                 raise PermissionDenied
             return TemplateResponse(
@@ -37,14 +39,13 @@ class EpisodeUnlockedMixin():
                 'hunts/episodenotstarted.html',
                 context={
                     'episode': request.episode.name,
-                    'startdate': request.episode.start_date - request.episode.headstart_applied(request.team),
-                    'headstart': request.episode.headstart_applied(request.team),
+                    'startdate': request.progress.start_date(request.episode),
+                    'headstart': request.progress.headstart_applied(request.episode),
                 },
                 status=403,
             )
 
-        # TODO: May need caching of progress to avoid DB load
-        if not request.episode.unlocked_by(request.team) and not request.admin:
+        if not request.progress.episode_unlocked(request.episode) and not request.admin:
             if request.is_ajax():
                 raise PermissionDenied
             return TemplateResponse(
@@ -59,8 +60,9 @@ class PuzzleUnlockedMixin():
         # Views using this mixin inevitable want the episode and puzzle objects so keep it on the request
         request.episode, request.puzzle = utils.event_episode_puzzle(request.tenant, episode_number, puzzle_number)
         request.admin = rules.is_admin_for_puzzle(request.user, request.puzzle)
+        request.progress = TeamProgress(request.tenant, request.team)
 
-        if (not request.episode.started(request.team) or not request.episode.unlocked_by(request.team)) and not request.admin:
+        if (not request.progress.episode_started(request.episode) or not request.progress.episode_unlocked(request.episode)) and not request.admin:
             if request.is_ajax():
                 raise PermissionDenied
             event_url = reverse('event')
@@ -78,7 +80,7 @@ class PuzzleUnlockedMixin():
                 status=403,
             )
 
-        if not request.puzzle.unlocked_by(request.team) and not request.admin:
+        if not request.progress.puzzle_unlocked(request.puzzle) and not request.admin:
             if request.is_ajax():
                 raise PermissionDenied
             return TemplateResponse(
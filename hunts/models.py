@@ -11,13 +11,19 @@
 # You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import copy
+import logging
+import threading
 import uuid
+from collections import defaultdict
 from datetime import timedelta
+from itertools import groupby, islice
 
 from django.contrib.postgres.fields import JSONField
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models import Q
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models import Count, Max, Q
 from django.utils import timezone
 from django.urls import reverse
 from django_prometheus.models import ExportModelOperationsMixin
@@ -27,7 +33,15 @@ from ordered_model.models import OrderedModel
 import accounts
 import events
 import teams
+from .headstarts import invalidate_headstarts, team_headstarts
+from .ingestion import update_derived_later
+from .ordinals import ordinals
+from .prequels import episode_graph
 from .runtimes import Runtime
+from .runtimes.cache import validator_cache
+from .stats import invalidate_stats
+
+logger = logging.getLogger(__name__)
 
 
 class Episode(models.Model):
@@ -60,14 +74,13 @@ class Episode(models.Model):
 
     def follows(self, episode):
         """Does this episode follow the provied episode by one or more prequel relationships?"""
-        if episode in self.prequels.all():
-            return True
-        else:
-            return any([p.follows(episode) for p in self.prequels.all()])
+        return episode_graph().follows(self.pk, episode.pk)
 
     def get_puzzle(self, puzzle_number):
-        n = int(puzzle_number)
-        return self.puzzle_set.all()[n - 1:n].get()
+        puzzle_id = ordinals().puzzle_id(self.pk, int(puzzle_number))
+        if puzzle_id is None:
+            raise Puzzle.DoesNotExist
+        return self.puzzle_set.get(pk=puzzle_id)
 
     def next_puzzle(self, team):
         """return the relative id of the next puzzle the player should attempt, or None.
@@ -75,10 +88,11 @@ class Episode(models.Model):
         None is returned if the puzzle is parallel and there is not exactly
         one unlocked puzzle, or if it is linear and all puzzles have been unlocked."""
 
+        solved = self.puzzles_solved_by(team)
         if self.parallel:
             unlocked = None
             for i, puzzle in enumerate(self.puzzle_set.all()):
-                if not puzzle.answered_by(team):
+                if puzzle.pk not in solved:
                     if unlocked is None:  # If this is the first not unlocked puzzle, it might be the "next puzzle"
                         unlocked = i + 1
                     else:  # We've found a second not unlocked puzzle, we can terminate early and return None
@@ -86,7 +100,7 @@ class Episode(models.Model):
             return unlocked  # This is either None, if we found no unlocked puzzles, or the one puzzle we found above
         else:
             for i, puzzle in enumerate(self.puzzle_set.all()):
-                if not puzzle.answered_by(team):
+                if puzzle.pk not in solved:
                     return i + 1
 
         return None
@@ -99,43 +113,46 @@ class Episode(models.Model):
         return date < timezone.now()
 
     def get_relative_id(self):
-        episodes = self.event.episode_set.order_by('start_date')
-        for index, e in enumerate(episodes):
-            if e == self:
-                return index + 1
-        return -1
+        number = ordinals().episode_number(self.pk)
+        return -1 if number is None else number
 
     def unlocked_by(self, team):
-        result = self.event.end_date < timezone.now() or \
-            all([episode.finished_by(team) for episode in self.prequels.all()])
-        return result
+        return self.event.end_date < timezone.now() or \
+            episode_graph().unlocked(self.pk, self._solved_by(team))
 
     def finished_by(self, team):
-        return all([puzzle.answered_by(team) for puzzle in self.puzzle_set.all()])
+        return episode_graph().finished(self.pk, self._solved_by(team))
+
+    @staticmethod
+    def _solved_by(team):
+        """Return the set of primary keys of every puzzle the given team has solved."""
+        return set(TeamPuzzleProgress.objects.filter(team=team).values_list('puzzle_id', flat=True))
+
+    def puzzles_solved_by(self, team):
+        """Return the set of primary keys of the puzzles in this episode which the given team has solved."""
+        return set(TeamPuzzleProgress.objects.filter(
+            puzzle__episode=self,
+            team=team,
+        ).values_list('puzzle_id', flat=True))
 
     def finished_times(self):
         """Get a list of teams who have finished this episode together with the time at which they finished."""
-        if not self.puzzle_set.all():
+        num_puzzles = self.puzzle_set.count()
+        if not num_puzzles:
             return []
 
         if self.parallel:
             # The position is determined by when the latest of a team's first successful guesses came in, over
             # all puzzles in the episode. Teams which haven't answered all questions are discarded.
-            last_team_guesses = {team: None for team in teams.models.Team.objects.filter(at_event=self.event)}
-
-            for p in self.puzzle_set.all():
-                team_guesses = p.first_correct_guesses(self.event)
-                for team in list(last_team_guesses.keys()):
-                    if team not in team_guesses:
-                        del last_team_guesses[team]
-                        continue
-                    if not last_team_guesses[team]:
-                        last_team_guesses[team] = team_guesses[team]
-                    elif team_guesses[team].given > last_team_guesses[team].given:
-                        last_team_guesses[team] = team_guesses[team]
-
-            last_team_times = ((t, last_team_guesses[t].given) for t in last_team_guesses)
-            return last_team_times
+            finished_teams = teams.models.Team.objects.filter(
+                teampuzzleprogress__puzzle__episode=self,
+            ).annotate(
+                solved=Count('teampuzzleprogress'),
+                finished=Max('teampuzzleprogress__solved_at'),
+            ).filter(
+                solved=num_puzzles,
+            )
+            return [(team, team.finished) for team in finished_teams]
 
         else:
             last_puzzle = self.puzzle_set.all().last()
@@ -147,17 +164,11 @@ class Episode(models.Model):
 
     def headstart_applied(self, team):
         """The headstart that the team has acquired that will be applied to this episode"""
-        seconds = sum([e.headstart_granted(team).total_seconds() for e in self.headstart_from.all()])
-        try:
-            seconds += self.headstart_set.get(team=team).headstart_adjustment.total_seconds()
-        except Headstart.DoesNotExist:
-            pass
-        return timedelta(seconds=seconds)
+        return team_headstarts(team)['applied'].get(self.pk, timedelta())
 
     def headstart_granted(self, team):
         """The headstart that the team has acquired by completing puzzles in this episode"""
-        seconds = sum([p.headstart_granted.total_seconds() for p in self.puzzle_set.all() if p.answered_by(team)])
-        return timedelta(seconds=seconds)
+        return team_headstarts(team)['granted'].get(self.pk, timedelta())
 
     def _puzzle_unlocked_by(self, puzzle, team):
         now = timezone.now()
@@ -167,10 +178,11 @@ class Episode(models.Model):
         if self.parallel or self.event.end_date < now:
             return puzzle in started_puzzles
         else:
+            solved = self.puzzles_solved_by(team)
             for p in started_puzzles:
                 if p == puzzle:
                     return True
-                if not p.answered_by(team):
+                if p.pk not in solved:
                     return False
 
     def unlocked_puzzles(self, team):
@@ -181,10 +193,11 @@ class Episode(models.Model):
         if self.parallel or self.event.end_date < now:
             return started_puzzles
         else:
+            solved = self.puzzles_solved_by(team)
             result = []
             for p in started_puzzles:
                 result.append(p)
-                if not p.answered_by(team):
+                if p.pk not in solved:
                     break
 
             return result
@@ -254,23 +267,23 @@ class Puzzle(OrderedModel):
             raise ValidationError(e) from e
 
     def get_absolute_url(self):
+        if self.episode_id is None:
+            raise ValueError("Puzzle %s is not on an episode and so has no URL" % self.title)
+        numbers = ordinals()
         params = {
-            'episode_number': self.episode.get_relative_id(),
-            'puzzle_number': self.get_relative_id()
+            'episode_number': numbers.episode_number(self.episode_id),
+            'puzzle_number': self.get_relative_id(numbers)
         }
         return reverse('puzzle', kwargs=params)
 
-    def get_relative_id(self):
-        if self.episode is None:
+    def get_relative_id(self, numbers=None):
+        if self.episode_id is None:
             raise ValueError("Puzzle %s is not on an episode and so has no relative id" % self.title)
 
-        puzzles = self.episode.puzzle_set.all()
-
-        for i, p in enumerate(puzzles, start=1):
-            if self.pk == p.pk:
-                return i
-
-        raise RuntimeError("Could not find Puzzle pk when iterating episode's puzzle list")
+        number = (numbers or ordinals()).puzzle_number(self.pk)
+        if number is None:
+            raise RuntimeError("Could not find Puzzle pk in the event's puzzle numbering")
+        return number
 
     def started(self, team):
         """Determine whether this puzzle should be visible to teams yet.
@@ -285,8 +298,16 @@ class Puzzle(OrderedModel):
         return self.episode.event.end_date < timezone.now() or \
             self.episode.unlocked_by(team) and self.episode._puzzle_unlocked_by(self, team)
 
+    def solved_by(self, team):
+        """Return whether the given team has solved this puzzle."""
+        return TeamPuzzleProgress.objects.filter(puzzle=self, team=team).exists()
+
     def answered_by(self, team):
         """Return a list of correct guesses for this puzzle by the given team, ordered by when they were given."""
+        # Teams which have not solved the puzzle have no correct guesses, so avoid scanning their guesses
+        if not self.solved_by(team):
+            return []
+
         # Select related since get_correct_for() will want it
         guesses = Guess.objects.filter(
             by__in=team.members.all(),
@@ -298,28 +319,146 @@ class Puzzle(OrderedModel):
         # TODO: Should return bool
         return [g for g in guesses if g.get_correct_for()]
 
-    def first_correct_guesses(self, event):
-        """Returns a dictionary of teams to guesses, where the guess is that team's earliest correct, validated guess for this puzzle"""
-        # Select related to avoid a load of queries for answers and teams
-        correct_guesses = Guess.objects.filter(
+    def unlocks_by(self, team):
+        """Return (unlock, guesses) pairs for the unlocks of this puzzle which the given team has unlocked.
+
+        The guesses are those which unlocked each unlock, ordered by when they were given."""
+        matches = Guess.unlocks.through.objects.filter(
+            unlock__puzzle=self,
+            guess__by_team=team,
+        ).select_related(
+            'unlock', 'guess'
+        ).order_by(
+            'unlock', 'guess__given'
+        )
+        return [
+            (unlock, [m.guess for m in unlock_matches])
+            for unlock, unlock_matches in groupby(matches, key=lambda m: m.unlock)
+        ]
+
+    def update_progress(self, team=None):
+        """Recalculate the progress of the given team, or every team which has guessed, on this puzzle.
+
+        Any guesses made before the team's first correct guess whose correctness cache is out of date are re-evaluated."""
+        if team is None:
+            team_ids = Guess.objects.filter(
+                for_puzzle=self,
+                by_team__isnull=False,
+            ).values_list('by_team_id', flat=True).distinct()
+            for team in teams.models.Team.objects.filter(pk__in=team_ids):
+                self.update_progress(team)
+            return
+
+        TeamPuzzleProgress.objects.filter(puzzle=self, team=team).delete()
+        invalidate_headstarts(team.pk)
+        invalidate_stats()
+        guesses = Guess.objects.filter(
             for_puzzle=self,
+            by_team=team,
         ).order_by(
             'given'
-        ).select_related('correct_for', 'by_team')
+        ).select_related('correct_for')
 
-        team_guesses = {}
-        for g in correct_guesses:
-            if g.get_correct_for() and g.by_team not in team_guesses:
-                team_guesses[g.by_team] = g
+        for g in guesses:
+            if not g.correct_current:
+                # Saving the guess would update its derived records, which are what is being recalculated here
+                g._evaluate_correctness()
+                Guess.objects.filter(pk=g.pk).update(correct_for=g.correct_for, correct_current=True)
+            if g.correct_for:
+                TeamPuzzleProgress.objects.update_or_create(
+                    puzzle=self, team=team,
+                    defaults={'solved_at': g.given, 'solving_guess': g},
+                )
+                return
 
-        return team_guesses
+    REVALIDATE_CHUNK_SIZE = 2000
+
+    def revalidate_guesses(self, exclude=None, chunk_size=REVALIDATE_CHUNK_SIZE):
+        """Re-evaluate every guess for this puzzle against its current answers, then recalculate every team's progress.
+
+        Teams often submit the same strings, so each distinct guess string is validated once and every guess with that
+        string is then updated together; the distinct strings are streamed from the database in chunks. If exclude is
+        given, that answer is treated as though it were already deleted. Returns the number of guesses whose answer changed."""
+        validators = [(answer.pk, answer.validator()) for answer in self.answer_set.exclude(pk=getattr(exclude, 'pk', None))]
+        guess_strings = Guess.objects.filter(
+            for_puzzle=self
+        ).order_by().values_list(
+            'guess', flat=True
+        ).distinct().iterator(chunk_size=chunk_size)
+
+        changed = 0
+        while True:
+            chunk = list(islice(guess_strings, chunk_size))
+            if not chunk:
+                break
+
+            matches = defaultdict(list)
+            for guess in chunk:
+                answer_id = next((pk for pk, validator in validators if validator(guess)), None)
+                matches[answer_id].append(guess)
+
+            for answer_id, strings in matches.items():
+                guesses = Guess.objects.filter(for_puzzle=self, guess__in=strings)
+                if answer_id is None:
+                    changed += guesses.filter(correct_for__isnull=False).update(correct_for=None, correct_current=True)
+                else:
+                    changed += guesses.exclude(correct_for=answer_id).update(correct_for=answer_id, correct_current=True)
+                guesses.filter(correct_current=False).update(correct_current=True)
+
+        self._rebuild_progress()
+        return changed
+
+    def revalidate_guesses_later(self):
+        """Revalidate this puzzle's guesses in a background thread once the current transaction commits.
+
+        Until then, guesses whose correctness cache has been marked out of date are re-evaluated individually if read."""
+        tenant = connection.tenant
+        key = (tenant.schema_name, self.pk)
+        with _pending_revalidations_lock:
+            if key in _pending_revalidations:
+                return
+            _pending_revalidations.add(key)
+        transaction.on_commit(lambda: threading.Thread(
+            target=_revalidate_in_background, args=(tenant, self.pk), daemon=True
+        ).start())
+
+    def _rebuild_progress(self):
+        """Recreate every team's progress on this puzzle from its guesses' correctness caches, which must be current."""
+        solving_guesses = list(Guess.objects.filter(
+            for_puzzle=self,
+            by_team__isnull=False,
+            correct_for__isnull=False,
+        ).order_by(
+            'by_team', 'given'
+        ).distinct(
+            'by_team'
+        ).only(
+            'id', 'by_team', 'given'
+        ))
+        TeamPuzzleProgress.objects.filter(puzzle=self).delete()
+        TeamPuzzleProgress.objects.bulk_create(
+            TeamPuzzleProgress(puzzle=self, team_id=g.by_team_id, solved_at=g.given, solving_guess=g)
+            for g in solving_guesses
+        )
+        invalidate_headstarts()
+        invalidate_stats()
+
+    def first_correct_guesses(self, event):
+        """Returns a dictionary of teams to guesses, where the guess is that team's earliest correct, validated guess for this puzzle"""
+        progress = TeamPuzzleProgress.objects.filter(
+            puzzle=self,
+        ).select_related('team', 'solving_guess')
+
+        return {p.team: p.solving_guess for p in progress}
 
     def finished_team_times(self, event):
         """Return an iterable of (team, time) tuples of teams who have completed this puzzle at the given event,
 together with the team at which they completed the puzzle."""
-        team_guesses = self.first_correct_guesses(event)
+        progress = TeamPuzzleProgress.objects.filter(
+            puzzle=self,
+        ).select_related('team')
 
-        return ((team, team_guesses[team].given) for team in team_guesses)
+        return ((p.team, p.solved_at) for p in progress)
 
     def finished_teams(self, event):
         """Return a list of teams who have completed this puzzle at the given event in order of completion."""
@@ -328,9 +467,30 @@ together with the team at which they completed the puzzle."""
     def position(self, team):
         """Returns the position in which the given team finished this puzzle: 0 = first, None = not yet finished."""
         try:
-            return self.finished_teams(team.at_event).index(team)
-        except ValueError:
+            progress = TeamPuzzleProgress.objects.get(puzzle=self, team=team)
+        except TeamPuzzleProgress.DoesNotExist:
             return None
+        return TeamPuzzleProgress.objects.filter(puzzle=self, solved_at__lt=progress.solved_at).count()
+
+
+_pending_revalidations = set()
+_pending_revalidations_lock = threading.Lock()
+
+
+def _revalidate_in_background(tenant, puzzle_id):
+    connection.set_tenant(tenant)
+    try:
+        with _pending_revalidations_lock:
+            _pending_revalidations.discard((tenant.schema_name, puzzle_id))
+        puzzle = Puzzle.objects.get(pk=puzzle_id)
+        changed = puzzle.revalidate_guesses()
+        logger.info(f'Revalidating guesses for {puzzle} changed {changed} guesses')
+    except Puzzle.DoesNotExist:
+        pass
+    except Exception:
+        logger.exception(f'Failed to revalidate guesses for puzzle {puzzle_id}')
+    finally:
+        connection.close()
 
 
 def puzzle_file_path(instance, filename):
@@ -411,13 +571,25 @@ class Hint(Clue):
 
 class Unlock(Clue):
     def unlocked_by(self, team):
-        guesses = Guess.objects.filter(
-            by__in=team.members.all()
-        ).filter(
-            for_puzzle=self.puzzle
+        """Return the guesses by the given team which unlock this, ordered by when they were given."""
+        return list(self.guesses.filter(by_team=team).order_by('given'))
+
+    def update_guesses(self):
+        """Recalculate which guesses for this unlock's puzzle unlock it, validating each distinct guess string once."""
+        validators = [u.validator() for u in self.unlockanswer_set.all()]
+        guess_strings = Guess.objects.filter(
+            for_puzzle=self.puzzle_id
+        ).order_by().values_list(
+            'guess', flat=True
+        ).distinct()
+        matching = [g for g in guess_strings if any(validator(g) for validator in validators)]
+
+        GuessUnlock = Guess.unlocks.through
+        GuessUnlock.objects.filter(unlock=self).delete()
+        GuessUnlock.objects.bulk_create(
+            GuessUnlock(guess_id=guess_id, unlock=self)
+            for guess_id in Guess.objects.filter(for_puzzle=self.puzzle_id, guess__in=matching).values_list('id', flat=True)
         )
-        unlockanswers = self.unlockanswer_set.all()
-        return [g for g in guesses if any([u.validate_guess(g) for u in unlockanswers])]
 
     def __str__(self):
         return f'Unlock for {self.puzzle}'
@@ -456,11 +628,22 @@ class UnlockAnswer(models.Model):
         except SyntaxError as e:
             raise ValidationError(e) from e
 
+    def validator(self):
+        """Return a callable which validates guess strings against this unlock answer."""
+        if self.pk is None:
+            return self.runtime.create().create_validator(self.guess)
+        return validator_cache.get((self._meta.label, self.pk), self.runtime, self.guess)
+
     def validate_guess(self, guess):
-        return self.runtime.create().validate_guess(
-            self.guess,
-            guess.guess,
-        )
+        return self.validator()(guess.guess)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.unlock.update_guesses()
+
+    def delete(self, *args, **kwargs):
+        super().delete(*args, **kwargs)
+        self.unlock.update_guesses()
 
 
 class Answer(models.Model):
@@ -487,30 +670,40 @@ class Answer(models.Model):
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
-        guesses = Guess.objects.filter(
-            Q(for_puzzle=self.for_puzzle),
-            Q(correct_for__isnull=True) | Q(correct_for=self)
-        )
-        guesses.update(correct_current=False)
+        if settings.ASYNC_REVALIDATION:
+            Guess.objects.filter(
+                Q(for_puzzle=self.for_puzzle),
+                Q(correct_for__isnull=True) | Q(correct_for=self)
+            ).update(correct_current=False)
+            self.for_puzzle.revalidate_guesses_later()
+        else:
+            changed = self.for_puzzle.revalidate_guesses()
+            logger.info(f'Saving answer {self.pk} for {self.for_puzzle} changed {changed} guesses')
 
     def delete(self, *args, **kwargs):
-        guesses = Guess.objects.filter(
-            for_puzzle=self.for_puzzle,
-            correct_for=self
-        )
-        guesses.update(correct_current=False)
-        super().delete(*args, **kwargs)
+        if settings.ASYNC_REVALIDATION:
+            Guess.objects.filter(for_puzzle=self.for_puzzle, correct_for=self).update(correct_current=False)
+            super().delete(*args, **kwargs)
+            self.for_puzzle.revalidate_guesses_later()
+        else:
+            changed = self.for_puzzle.revalidate_guesses(exclude=self)
+            logger.info(f'Deleting answer {self.pk} for {self.for_puzzle} changed {changed} guesses')
+            super().delete(*args, **kwargs)
+
+    def validator(self):
+        """Return a callable which validates guess strings against this answer."""
+        if self.pk is None:
+            return self.runtime.create().create_validator(self.answer)
+        return validator_cache.get((self._meta.label, self.pk), self.runtime, self.answer)
 
     def validate_guess(self, guess):
-        return self.runtime.create().validate_guess(
-            self.answer,
-            guess.guess,
-        )
+        return self.validator()(guess.guess)
 
 
 class Guess(ExportModelOperationsMixin('guess'), models.Model):
     id = models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True)
-    for_puzzle = models.ForeignKey(Puzzle, on_delete=models.CASCADE)
+    # Every index below which starts with for_puzzle serves lookups by puzzle alone too
+    for_puzzle = models.ForeignKey(Puzzle, on_delete=models.CASCADE, db_index=False)
     by = models.ForeignKey(accounts.models.UserProfile, on_delete=models.CASCADE)
     by_team = models.ForeignKey(teams.models.Team, on_delete=models.SET_NULL, null=True, blank=True)
     guess = models.TextField()
@@ -518,8 +711,20 @@ class Guess(ExportModelOperationsMixin('guess'), models.Model):
     # The following two fields cache whether the guess is correct. Do not use them directly.
     correct_for = models.ForeignKey(Answer, blank=True, null=True, on_delete=models.SET_NULL)
     correct_current = models.BooleanField(default=False)
+    # The unlocks this guess unlocks. Maintained from Guess and UnlockAnswer; do not modify directly.
+    unlocks = models.ManyToManyField(Unlock, blank=True, editable=False, related_name='guesses')
 
     class Meta:
+        # Migration 0006 also adds hunts_guess_puzzle_team_solved, a partial index on (for_puzzle, by_team, given) of
+        # correct guesses for finding each team's first correct guess, which Index can not express in this Django.
+        indexes = (
+            # For reading guesses in the order they were given a page at a time
+            models.Index(fields=('given', 'id'), name='hunts_guess_given_id'),
+            # For reading a team's guesses on a puzzle in order when recalculating its progress
+            models.Index(fields=('for_puzzle', 'by_team', 'given'), name='hunts_guess_puzzle_team_given'),
+            # For reading a user's guesses on a puzzle in order, and finding their latest
+            models.Index(fields=('for_puzzle', 'by', 'given'), name='hunts_guess_puzzle_by_given'),
+        )
         verbose_name_plural = 'Guesses'
 
     def __str__(self):
@@ -541,8 +746,6 @@ class Guess(ExportModelOperationsMixin('guess'), models.Model):
 
         Sets self.correct_current to True, and self.correct_for to the first
         answer this is correct for, if such exists. Does not save the model."""
-        if data is None:
-            data = PuzzleData(self.for_puzzle, self.by_team)
         if answers is None:
             answers = self.for_puzzle.answer_set.all()
 
@@ -558,7 +761,45 @@ class Guess(ExportModelOperationsMixin('guess'), models.Model):
         if not self.by_team:
             self.by_team = self.get_team()
         self._evaluate_correctness()
+        created = self._state.adding
         super().save(*args, **kwargs)
+        if settings.ASYNC_GUESSES:
+            update_derived_later(self, created)
+        else:
+            self.update_derived(created)
+
+    def update_derived(self, created):
+        """Update the records derived from this guess: its team's progress on its puzzle and, if it has just been
+        created, the unlocks it unlocks. Later changes to unlocks are handled by Unlock and UnlockAnswer."""
+        with transaction.atomic():
+            self._update_progress()
+            if created:
+                self._update_unlocks()
+
+    def _update_progress(self):
+        """Update the progress of this guess's team on its puzzle to account for this guess."""
+        progress = TeamPuzzleProgress.objects.filter(puzzle=self.for_puzzle, team=self.by_team)
+        # Lock the progress if this guess solved the puzzle, so that other guesses wait for it to be recalculated
+        if progress.select_for_update().filter(solving_guess=self).exists():
+            # This guess may no longer be correct, or no longer be the earliest, so start from scratch
+            self.for_puzzle.update_progress(self.by_team)
+        elif self.correct_for:
+            (_, created) = progress.get_or_create(defaults={'solved_at': self.given, 'solving_guess': self})
+            # Only replace the progress of other guesses if this one is earlier, checking and updating in one statement
+            if created or progress.filter(solved_at__gt=self.given).update(solved_at=self.given, solving_guess=self):
+                invalidate_headstarts(self.by_team_id)
+                invalidate_stats()
+
+    def _update_unlocks(self):
+        """Record which of its puzzle's unlocks this guess unlocks."""
+        unlocks = Unlock.objects.filter(
+            puzzle=self.for_puzzle_id
+        ).prefetch_related(
+            'unlockanswer_set'
+        )
+        self.unlocks.set([
+            u for u in unlocks if any(a.validator()(self.guess) for a in u.unlockanswer_set.all())
+        ])
 
     def time_on_puzzle(self):
         data = TeamPuzzleData.objects.filter(
@@ -574,6 +815,21 @@ class Guess(ExportModelOperationsMixin('guess'), models.Model):
         return '%02d:%02d:%02d' % (hours, minutes, seconds)
 
 
+class TeamPuzzleProgress(models.Model):
+    """Records when a team first solved a puzzle. Maintained from Guess and Answer; do not modify directly."""
+    puzzle = models.ForeignKey(Puzzle, on_delete=models.CASCADE)
+    team = models.ForeignKey(teams.models.Team, on_delete=models.CASCADE)
+    solved_at = models.DateTimeField()
+    solving_guess = models.ForeignKey(Guess, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        unique_together = (('puzzle', 'team'), )
+        verbose_name_plural = 'Team puzzle progress'
+
+    def __str__(self):
+        return f'{self.team} solved {self.puzzle} @ {self.solved_at}'
+
+
 class TeamData(models.Model):
     team = models.OneToOneField(teams.models.Team, on_delete=models.CASCADE)
     data = JSONField(blank=True, null=True)
@@ -633,28 +889,104 @@ class UserPuzzleData(models.Model):
 
 # Convenience class for using all the above data objects together
 class PuzzleData:
-    from .models import TeamData, UserData, TeamPuzzleData, UserPuzzleData
+    """The team, team puzzle, user and user puzzle data for a puzzle, loaded with a single query.
+
+    Missing objects are created. save() only writes back the objects whose fields have been changed since loading."""
+    TRACKED_FIELDS = ('data', 'start_time')
 
     def __init__(self, puzzle, team, user=None):
-        self.t_data, created = TeamData.objects.get_or_create(team=team)
-        self.tp_data, created = TeamPuzzleData.objects.get_or_create(
-            puzzle=puzzle, team=team
-        )
+        self.u_data = None
+        self.up_data = None
+        self._originals = []
+
+        queries = [
+            (TeamData, {'team': team}),
+            (TeamPuzzleData, {'puzzle': puzzle, 'team': team}),
+        ]
+        if user:
+            queries += [
+                (UserData, {'event': team.at_event, 'user': user}),
+                (UserPuzzleData, {'puzzle': puzzle, 'user': user}),
+            ]
+        t_data, tp_data, *user_data = self._load(queries)
+
+        self.t_data = t_data
+        self.tp_data = tp_data
         if user:
-            self.u_data, created = UserData.objects.get_or_create(
-                event=team.at_event, user=user
+            self.u_data, self.up_data = user_data
+
+    def _load(self, queries):
+        """Fetch the object of each model matching its lookup in one query, creating any which do not exist."""
+        rows = self._select(queries)
+        if len(rows) < len(queries):
+            self._create([query for i, query in enumerate(queries) if i not in rows])
+            rows = self._select(queries)
+
+        objects = []
+        for i, (model, lookup) in enumerate(queries):
+            fields = model._meta.concrete_fields
+            obj = model.from_db(
+                connection.alias,
+                [f.attname for f in fields],
+                [self._from_json(f, rows[i][f.column]) for f in fields],
             )
-            self.up_data, created = UserPuzzleData.objects.get_or_create(
-                puzzle=puzzle, user=user
+            # Populate the related objects we already have so they are not fetched again
+            for name, value in lookup.items():
+                setattr(obj, name, value)
+            self._originals.append((obj, {
+                field: copy.deepcopy(getattr(obj, field)) for field in self.TRACKED_FIELDS if hasattr(obj, field)
+            }))
+            objects.append(obj)
+        return objects
+
+    @staticmethod
+    def _select(queries):
+        """Return a dictionary of the index of each query to its object's row as JSON, for those which exist."""
+        sql = []
+        params = []
+        for i, (model, lookup) in enumerate(queries):
+            where = ' AND '.join(f'{model._meta.get_field(name).column} = %s' for name in lookup)
+            sql.append(f'SELECT {i}, row_to_json(t) FROM {model._meta.db_table} t WHERE {where}')
+            params += [getattr(value, 'pk', value) for value in lookup.values()]
+
+        with connection.cursor() as cursor:
+            cursor.execute(' UNION ALL '.join(sql), params)
+            return dict(cursor.fetchall())
+
+    @staticmethod
+    def _create(queries):
+        """Create the object of each model with its lookup and default values in one statement.
+
+        Objects created by someone else in the meantime are left alone. No signals are sent, as none of these models
+        have receivers which care about new objects."""
+        sql = []
+        params = []
+        for i, (model, lookup) in enumerate(queries):
+            obj = model(**lookup)
+            fields = [f for f in model._meta.concrete_fields if not isinstance(f, models.AutoField)]
+            columns = ', '.join(f.column for f in fields)
+            placeholders = ', '.join(['%s'] * len(fields))
+            sql.append(
+                f'create_{i} AS (INSERT INTO {model._meta.db_table} ({columns}) VALUES ({placeholders}) ON CONFLICT DO NOTHING)'
             )
-
-    def save(self, *args, **kwargs):
-        self.t_data.save(*args, **kwargs)
-        self.tp_data.save(*args, **kwargs)
-        if self.u_data:
-            self.u_data.save(*args, **kwargs)
-        if self.up_data:
-            self.up_data.save(*args, **kwargs)
+            params += [f.get_db_prep_save(f.pre_save(obj, True), connection) for f in fields]
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'WITH {", ".join(sql)} SELECT 1', params)
+
+    @staticmethod
+    def _from_json(field, value):
+        # JSON data comes back as is, other values need converting from their JSON representation
+        if value is None or isinstance(field, JSONField):
+            return value
+        return field.to_python(value)
+
+    def save(self):
+        for obj, original in self._originals:
+            changed = [field for field, value in original.items() if getattr(obj, field) != value]
+            if changed:
+                obj.save(update_fields=changed)
+                original.update({field: copy.deepcopy(getattr(obj, field)) for field in changed})
 
 
 class Headstart(models.Model):
@@ -0,0 +1,114 @@
+# Copyright (C) 2018 The Hunter2 Contributors.
+#
+# This file is part of Hunter2.
+#
+# Hunter2 is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# Hunter2 is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.core.signals import request_finished, request_started
+from django.db import connection
+from django.dispatch import receiver
+
+from .utils import bump_cache_version, cache_version
+
+ORDINALS_CACHE_TIMEOUT = 24 * 60 * 60  # Seconds
+
+
+class Ordinals:
+    """Maps between the primary keys of an event's episodes and puzzles and the numbers they have in URLs.
+
+    Episodes are numbered from 1 in order of their start date, and puzzles from 1 in order within their episode."""
+    def __init__(self, episodes, puzzles):
+        self._episode_ids = list(episodes)
+        self._episode_numbers = {e: i for i, e in enumerate(self._episode_ids, start=1)}
+        self._puzzle_ids = {e: list(p) for e, p in puzzles.items()}
+        self._puzzle_numbers = {p: i for ps in self._puzzle_ids.values() for i, p in enumerate(ps, start=1)}
+
+    def episode_number(self, episode_id):
+        """Return the number of the episode with the given ID, or None if there is no such episode."""
+        return self._episode_numbers.get(episode_id)
+
+    def episode_id(self, episode_number):
+        """Return the ID of the episode with the given number, or None if there is no such episode."""
+        if 1 <= episode_number <= len(self._episode_ids):
+            return self._episode_ids[episode_number - 1]
+        return None
+
+    def puzzle_number(self, puzzle_id):
+        """Return the number of the puzzle with the given ID within its episode, or None if there is no such puzzle."""
+        return self._puzzle_numbers.get(puzzle_id)
+
+    def puzzle_id(self, episode_id, puzzle_number):
+        """Return the ID of the puzzle with the given number in the given episode, or None if there is no such puzzle."""
+        puzzle_ids = self._puzzle_ids.get(episode_id, ())
+        if 1 <= puzzle_number <= len(puzzle_ids):
+            return puzzle_ids[puzzle_number - 1]
+        return None
+
+
+def _load():
+    from .models import Episode, Puzzle
+
+    puzzles = defaultdict(list)
+    for episode_id, puzzle_id in Puzzle.objects.filter(episode__isnull=False).order_by('episode', 'order').values_list('episode_id', 'id'):
+        puzzles[episode_id].append(puzzle_id)
+    return Ordinals(Episode.objects.order_by('start_date').values_list('id', flat=True), puzzles)
+
+
+def _version_key():
+    return f'hunts.ordinals.{connection.schema_name}.version'
+
+
+# Without a configured cache, the Ordinals of each schema are kept until the end of the current request
+_request_local = threading.local()
+
+
+@receiver(request_started)
+def _request_started(sender, **kwargs):
+    _request_local.ordinals = {}
+
+
+@receiver(request_finished)
+def _request_finished(sender, **kwargs):
+    _request_local.ordinals = None
+
+
+def ordinals():
+    """Return the Ordinals of the current event, which are cached until episodes or puzzles are changed.
+
+    If there is no cache they are only kept until the end of the current request."""
+    version = cache_version(_version_key())
+    if version is None:
+        memo = getattr(_request_local, 'ordinals', None)
+        if memo is None:
+            return _load()
+        if connection.schema_name not in memo:
+            memo[connection.schema_name] = _load()
+        return memo[connection.schema_name]
+
+    key = f'hunts.ordinals.{connection.schema_name}.{version}'
+    result = cache.get(key)
+    if result is None:
+        result = _load()
+        cache.set(key, result, ORDINALS_CACHE_TIMEOUT)
+    return result
+
+
+def invalidate_ordinals():
+    """Mark the Ordinals of the current event out of date once the current transaction is committed.
+
+    Those kept for the current request are dropped straight away, since the request can see its own changes."""
+    memo = getattr(_request_local, 'ordinals', None)
+    if memo:
+        memo.pop(connection.schema_name, None)
+    bump_cache_version(_version_key())
@@ -0,0 +1,99 @@
+# Copyright (C) 2018 The Hunter2 Contributors.
+#
+# This file is part of Hunter2.
+#
+# Hunter2 is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# Hunter2 is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db import connection
+
+from .utils import bump_cache_version, cache_version
+
+PREQUELS_CACHE_TIMEOUT = 24 * 60 * 60  # Seconds
+
+
+class EpisodeGraph:
+    """The episodes of an event, the puzzles in each and the prequels each must have been finished after.
+
+    prequels maps each episode ID to the IDs of its direct prequels, and ancestors to those of every episode it follows by
+    one or more prequel relationships."""
+    def __init__(self, episodes, prequels, puzzles):
+        self.prequels = {e: frozenset(prequels.get(e, ())) for e in episodes}
+        self.puzzles = {e: frozenset(puzzles.get(e, ())) for e in episodes}
+        self.ancestors = {}
+        for episode in episodes:
+            self._ancestors(episode, ())
+
+    def _ancestors(self, episode, path):
+        if episode in self.ancestors:
+            return self.ancestors[episode]
+        if episode in path:
+            # Cycles are refused when prequels are added, so this is only reachable with a corrupt database
+            raise ValueError(f'Circular dependency found in episodes at episode {episode}')
+        ancestors = set(self.prequels.get(episode, ()))
+        for prequel in self.prequels.get(episode, ()):
+            ancestors |= self._ancestors(prequel, path + (episode, ))
+        self.ancestors[episode] = frozenset(ancestors)
+        return self.ancestors[episode]
+
+    def follows(self, episode_id, prequel_id):
+        """Does the first episode follow the second by one or more prequel relationships?"""
+        return prequel_id in self.ancestors.get(episode_id, ())
+
+    def finished(self, episode_id, solved):
+        """Has a team which has solved the puzzles with IDs in solved finished the episode?"""
+        return self.puzzles.get(episode_id, frozenset()) <= solved
+
+    def unlocked(self, episode_id, solved):
+        """Has a team which has solved the puzzles with IDs in solved finished all the episode's prequels?"""
+        return all(self.finished(prequel, solved) for prequel in self.prequels.get(episode_id, ()))
+
+
+def _load():
+    from .models import Episode, Puzzle
+
+    prequels = defaultdict(list)
+    for episode_id, prequel_id in Episode.prequels.through.objects.values_list('from_episode_id', 'to_episode_id'):
+        prequels[episode_id].append(prequel_id)
+    puzzles = defaultdict(list)
+    for episode_id, puzzle_id in Puzzle.objects.filter(episode__isnull=False).values_list('episode_id', 'id'):
+        puzzles[episode_id].append(puzzle_id)
+    return EpisodeGraph(Episode.objects.values_list('id', flat=True), prequels, puzzles)
+
+
+def _version_key():
+    return f'hunts.prequels.{connection.schema_name}.version'
+
+
+def episode_graph(cached=True):
+    """Return the EpisodeGraph of the current event.
+
+    It is cached until episodes, their prequels or their puzzles change, but those changes only take effect once they
+    are committed. Pass cached=False to load the graph as the current transaction sees it."""
+    if not cached:
+        return _load()
+
+    version = cache_version(_version_key())
+    if version is None:
+        return _load()
+
+    key = f'hunts.prequels.{connection.schema_name}.{version}'
+    graph = cache.get(key)
+    if graph is None:
+        graph = _load()
+        cache.set(key, graph, PREQUELS_CACHE_TIMEOUT)
+    return graph
+
+
+def invalidate_episode_graph():
+    """Mark the EpisodeGraph of the current event out of date once the current transaction is committed."""
+    bump_cache_version(_version_key())
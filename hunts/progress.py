@@ -0,0 +1,108 @@
+# Copyright (C) 2018 The Hunter2 Contributors.
+#
+# This file is part of Hunter2.
+#
+# Hunter2 is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# Hunter2 is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from datetime import timedelta
+
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from .headstarts import team_headstarts
+from .models import Episode, TeamPuzzleProgress
+
+
+class TeamProgress:
+    """A team's progress through an event, loaded with a handful of queries the first time it is needed.
+
+    This answers the same questions as the progress methods of Episode and Puzzle, which query the database every time
+    they are called. It is intended to live for a single request: progress made after it is loaded is not seen."""
+    def __init__(self, event, team):
+        self.event = event
+        self.team = team
+        self.now = timezone.now()
+
+    @cached_property
+    def _episodes(self):
+        return {
+            e.pk: e for e in Episode.objects.filter(
+                event=self.event
+            ).prefetch_related(
+                'prequels', 'puzzle_set',
+            )
+        }
+
+    @cached_property
+    def _solved(self):
+        if self.team is None:
+            return set()
+        return set(TeamPuzzleProgress.objects.filter(team=self.team).values_list('puzzle_id', flat=True))
+
+    @cached_property
+    def _headstarts(self):
+        return team_headstarts(self.team)
+
+    def _episode(self, episode):
+        return self._episodes[episode.pk]
+
+    def puzzles(self, episode):
+        """Return the episode's puzzles in order."""
+        return self._episode(episode).puzzle_set.all()
+
+    def solved(self, puzzle):
+        return puzzle.pk in self._solved
+
+    def puzzles_solved(self, episode):
+        """Return the set of primary keys of the puzzles in the episode which the team has solved."""
+        return {p.pk for p in self.puzzles(episode) if p.pk in self._solved}
+
+    def finished(self, episode):
+        return all(p.pk in self._solved for p in self.puzzles(episode))
+
+    def headstart_granted(self, episode):
+        """The headstart that the team has acquired by completing puzzles in the episode"""
+        return self._headstarts['granted'].get(episode.pk, timedelta())
+
+    def headstart_applied(self, episode):
+        """The headstart that the team has acquired that will be applied to the episode"""
+        return self._headstarts['applied'].get(episode.pk, timedelta())
+
+    def start_date(self, episode):
+        """When the episode starts for the team, taking its headstart into account"""
+        if self.team is None:
+            return episode.start_date
+        return episode.start_date - self.headstart_applied(episode)
+
+    def episode_started(self, episode):
+        return self.start_date(episode) < self.now
+
+    def episode_unlocked(self, episode):
+        return self.event.end_date < self.now or all(self.finished(e) for e in self._episode(episode).prequels.all())
+
+    def unlocked_puzzles(self, episode):
+        episode = self._episode(episode)
+        puzzles = self.puzzles(episode)
+        if episode.parallel:
+            return [p for p in puzzles if p.start_date < self.now]
+        if self.event.end_date < self.now:
+            return list(puzzles)
+        result = []
+        for p in puzzles:
+            result.append(p)
+            if p.pk not in self._solved:
+                break
+        return result
+
+    def puzzle_unlocked(self, puzzle):
+        if self.event.end_date < self.now:
+            return True
+        episode = self._episodes[puzzle.episode_id]
+        return self.episode_unlocked(episode) and puzzle.pk in {p.pk for p in self.unlocked_puzzles(episode)}
@@ -0,0 +1,54 @@
+# Copyright (C) 2018 The Hunter2 Contributors.
+#
+# This file is part of Hunter2.
+#
+# Hunter2 is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# Hunter2 is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import math
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.db import connection
+
+
+class RateLimiter:
+    """Limits something to being done once every `interval` seconds on average, allowing up to `burst` at once.
+
+    This is a token bucket, kept in the configured cache as the time at which the bucket will next be full. With a burst
+    of 1 it enforces a gap of at least `interval` between attempts. The first attempt in a scope is recorded with
+    cache.add, so is atomic, but later ones are read then written, so attempts made at the same moment by one client from
+    several processes may occasionally all be allowed."""
+    def __init__(self, name, interval, burst):
+        self.name = name
+        self.interval = interval
+        self.burst = burst
+
+    def allow(self, scope, now):
+        """Count an attempt at the given time within the scope, returning whether it is allowed, or None if there is no
+        cache to count attempts in."""
+        if isinstance(caches['default'], DummyCache):
+            return None
+
+        key = f'hunts.ratelimit.{connection.schema_name}.{self.name}.{scope}'
+        now = now.timestamp()
+        timeout = math.ceil(self.interval * self.burst) + 1
+        if cache.add(key, now + self.interval, timeout):
+            return True
+
+        full_at = cache.get(key, now)
+        if full_at - now > self.interval * (self.burst - 1):
+            return False
+        cache.set(key, max(full_at, now) + self.interval, timeout)
+        return True
+
+
+guess_limiter = RateLimiter('guess', settings.GUESS_INTERVAL, settings.GUESS_BURST)
+callback_limiter = RateLimiter('callback', settings.CALLBACK_INTERVAL, settings.CALLBACK_BURST)
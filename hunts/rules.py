@@ -11,18 +11,49 @@
 # You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from django.core.cache import cache
+
 from teams.models import Team
+from .utils import bump_cache_version, cache_version
 
 import rules
 
+ADMINS_CACHE_TIMEOUT = 60 * 60  # Seconds
+
+
+def _admins_key(event_id):
+    return f'hunts.rules.event-{event_id}.admins'
+
+
+def admin_user_ids(event_id):
+    """Return the set of IDs of the users in the admin team of the event with the given ID.
+
+    The set is cached until the event's teams or their members change."""
+    def load():
+        return frozenset(
+            Team.objects.filter(at_event=event_id, is_admin=True, members__isnull=False).values_list('members__user_id', flat=True)
+        )
+
+    version = cache_version(f'{_admins_key(event_id)}.version')
+    if version is None:
+        return load()
+
+    key = f'{_admins_key(event_id)}.{version}'
+    user_ids = cache.get(key)
+    if user_ids is None:
+        user_ids = load()
+        cache.set(key, user_ids, ADMINS_CACHE_TIMEOUT)
+    return user_ids
+
+
+def invalidate_admins(event_id):
+    """Mark the admins of the event with the given ID out of date once the current transaction is committed."""
+    bump_cache_version(f'{_admins_key(event_id)}.version')
+
 
 @rules.predicate
 def is_admin_for_event(user, event):
-    try:
-        admin_team = event.teams.filter(is_admin=True).get()
-    except Team.DoesNotExist:
-        return False
-    return user.profile in admin_team.members.all()
+    return user.pk in admin_user_ids(event.pk)
 
 
 rules.add_perm('hunts.change_event', is_admin_for_event)
@@ -30,7 +61,7 @@ rules.add_perm('hunts.change_event', is_admin_for_event)
 
 @rules.predicate
 def is_admin_for_episode(user, episode):
-    return is_admin_for_event(user, episode.event)
+    return user.pk in admin_user_ids(episode.event_id)
 
 
 rules.add_perm('hunts.change_episode', is_admin_for_episode)
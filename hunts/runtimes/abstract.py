@@ -21,3 +21,9 @@ class AbstractRuntime:
     # TODO: Consider changing to allow returning a result and unlock hints for this puzzle.
     def validate_guess(self, validator, guess):
         raise NotImplementedError("Abstract")
+
+    def create_validator(self, validator):
+        """Return a callable which validates a guess against the given validator.
+
+        Runtimes which can do expensive preparation of the validator once and reuse it for many guesses override this."""
+        return lambda guess: self.validate_guess(validator, guess)
@@ -0,0 +1,59 @@
+# Copyright (C) 2018 The Hunter2 Contributors.
+#
+# This file is part of Hunter2.
+#
+# Hunter2 is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# Hunter2 is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+from collections import OrderedDict
+
+
+class ValidatorCache:
+    """A least recently used cache of validators created by Runtime.create_validator.
+
+    Validators are keyed on their owner (any hashable identifying the object the validator belongs to) together with the
+    runtime and script, so an owner which has been modified in memory never receives a validator for its old script."""
+    DEFAULT_MAX_SIZE = 1000
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._validators = OrderedDict()
+
+    def __len__(self):
+        return len(self._validators)
+
+    def get(self, owner, runtime, script):
+        key = (owner, runtime, script)
+        with self._lock:
+            if key in self._validators:
+                self._validators.move_to_end(key)
+                return self._validators[key]
+
+        # Create the validator outside the lock since this may be slow
+        validator = runtime.create().create_validator(script)
+
+        with self._lock:
+            self._validators[key] = validator
+            while len(self._validators) > self.max_size:
+                self._validators.popitem(last=False)
+        return validator
+
+    def invalidate(self, owner):
+        with self._lock:
+            for key in [k for k in self._validators if k[0] == owner]:
+                del self._validators[key]
+
+    def clear(self):
+        with self._lock:
+            self._validators.clear()
+
+
+validator_cache = ValidatorCache()
@@ -13,9 +13,14 @@
 
 import os
 import sys
+import threading
+
+from django.conf import settings
 
 from ..abstract import AbstractRuntime
 from ..exceptions import RuntimeExecutionError, RuntimeExecutionTimeExceededError, RuntimeMemoryExceededError, RuntimeSandboxViolationError
+from .pool import SandboxPool
+from .worker import LuaWorkerPool
 
 # TODO: Replace this with proper DLFCN support in the docker python version
 orig_dlflags = sys.getdlopenflags()
@@ -32,9 +37,59 @@ class LuaRuntime(AbstractRuntime):
     ERROR_MEMORY_LIMIT_EXCEEDED      = "ERROR_MEMORY_LIMIT_EXCEEDED"
     ERROR_SANDBOX_VIOLATION          = "ERROR_SANDBOX_VIOLATION"
 
+    DEFAULT_POOL_SIZE     = 4     # Idle Lua states kept per process
+    DEFAULT_POOL_MAX_USES = 1000  # Scripts run before a Lua state is replaced
+    DEFAULT_POOL_GROWTH   = 16    # KB a Lua state may grow by before it is replaced
+    DEFAULT_POOL_CHECK    = 100   # Scripts run between checks of a Lua state's growth
+    DEFAULT_POOL_SCRIPTS  = 64    # Scripts compiled in a Lua state before it is replaced
+
+    DEFAULT_WORKER_TIMEOUT = 5    # Seconds a script may run for in a worker process
+    DEFAULT_WORKER_MEMORY  = 256  # MB of address space available to each worker process
+
+    _pool = None
+    _pool_lock = threading.Lock()
+    _workers = None
+    _workers_lock = threading.Lock()
+
     def __init__(self):
         pass
 
+    @classmethod
+    def pool(cls):
+        """The SandboxPool shared by every LuaRuntime in this process, configured by the LUA_POOL_* settings."""
+        if cls._pool is None:
+            with cls._pool_lock:
+                if cls._pool is None:
+                    cls._pool = SandboxPool(
+                        cls._create_lua_runtime,
+                        size=getattr(settings, 'LUA_POOL_SIZE', cls.DEFAULT_POOL_SIZE),
+                        max_uses=getattr(settings, 'LUA_POOL_MAX_USES', cls.DEFAULT_POOL_MAX_USES),
+                        max_growth=getattr(settings, 'LUA_POOL_GROWTH', cls.DEFAULT_POOL_GROWTH),
+                        check_interval=getattr(settings, 'LUA_POOL_CHECK', cls.DEFAULT_POOL_CHECK),
+                        max_scripts=getattr(settings, 'LUA_POOL_SCRIPTS', cls.DEFAULT_POOL_SCRIPTS),
+                    )
+        return cls._pool
+
+    @classmethod
+    def workers(cls):
+        """The LuaWorkerPool shared by every LuaRuntime in this process, or None if scripts are run in-process.
+
+        Configured by the LUA_WORKER* settings; LUA_WORKERS is the number of worker processes and defaults to 0."""
+        if cls._workers is None:
+            with cls._workers_lock:
+                if cls._workers is None:
+                    size = getattr(settings, 'LUA_WORKERS', 0)
+                    if size:
+                        memory_limit = getattr(settings, 'LUA_WORKER_MEMORY', cls.DEFAULT_WORKER_MEMORY)
+                        cls._workers = LuaWorkerPool(
+                            size,
+                            timeout=getattr(settings, 'LUA_WORKER_TIMEOUT', cls.DEFAULT_WORKER_TIMEOUT),
+                            memory_limit=memory_limit * 1024 * 1024 if memory_limit else None,
+                        )
+                    else:
+                        cls._workers = False
+        return cls._workers or None
+
     def check_script(self, script):
         try:
             # Use the sandbox engine with a *very* restrictive limit which will prevent anything meaningful happening.
@@ -44,6 +99,12 @@ class LuaRuntime(AbstractRuntime):
             return True
 
     def evaluate(self, script, team_puzzle_data, user_puzzle_data, team_data, user_data):
+        workers = self.workers()
+        if workers is not None:
+            return workers.evaluate(script, team_puzzle_data, user_puzzle_data, team_data, user_data)
+        return self._evaluate(script, team_puzzle_data, user_puzzle_data, team_data, user_data)
+
+    def _evaluate(self, script, team_puzzle_data, user_puzzle_data, team_data, user_data):
         return_values = self._sandbox_run(script, {
             "team_puzzle_data": team_puzzle_data,
             "user_puzzle_data": user_puzzle_data,
@@ -57,6 +118,12 @@ class LuaRuntime(AbstractRuntime):
         return return_values[0]
 
     def validate_guess(self, validator, guess):
+        workers = self.workers()
+        if workers is not None:
+            return workers.validate_guess(validator, guess)
+        return self._validate_guess(validator, guess)
+
+    def _validate_guess(self, validator, guess):
         return_values = self._sandbox_run(validator, {
             "guess":            guess,
         })
@@ -66,7 +133,8 @@ class LuaRuntime(AbstractRuntime):
 
         return return_values[0]
 
-    def _create_lua_runtime(self):
+    @staticmethod
+    def _create_lua_runtime():
         # noinspection PyArgumentList
         lua = lupa.LuaRuntime(
             register_eval=False,
@@ -88,61 +156,108 @@ class LuaRuntime(AbstractRuntime):
 
         return lua
 
+    def create_validator(self, validator):
+        if self.workers() is not None:
+            # Check the syntax up front, as the other validators do, then leave the worker processes to run it
+            with self.pool().state() as state:
+                sandboxed_function, error = state.compile(validator)
+            if sandboxed_function is None:
+                raise SyntaxError(error)
+            return super().create_validator(validator)
+        return LuaValidator(self, validator)
+
     def _sandbox_run(
             self,
             lua_script,
             parameters=None,
             instruction_limit=DEFAULT_INSTRUCTION_LIMIT,
             memory_limit=DEFAULT_MEMORY_LIMIT):
-        lua = self._create_lua_runtime()
+        with self.pool().state() as state:
+            try:
+                sandboxed_function, env = state.compile(lua_script)
+                if sandboxed_function is None:
+                    # Pass the syntax error on in the same form as the result of running the script
+                    result = (None, env)
+                else:
+                    state.sandbox.reset(env)
 
-        # Load the sandbox Lua module
-        sandbox = lua.require('sandbox')
+                    # Load parameters into the sandbox
+                    self._load_parameters(env, parameters)
 
-        # Load parameters into the sandbox
+                    result = state.call(sandboxed_function, env, instruction_limit, memory_limit)
+            except lupa.LuaError as error:
+                # An error has occurred in the sandbox runtime itself
+                raise RuntimeExecutionError("Sandbox") from error
+
+        return self._handle_result(result)
+
+    @staticmethod
+    def _load_parameters(env, parameters):
         if parameters is not None:
             for key, value in parameters.items():
-                if sandbox.env[key] is not None:
+                if env[key] is not None:
                     raise RuntimeExecutionError("Passed parameter '{}' overrides sandbox environment".format(key))
                 else:
-                    sandbox.env[key] = value
-
-        # Enable instruction and memory limits
-        sandbox.enable_limits(instruction_limit, memory_limit)
+                    env[key] = value
 
+    def _handle_result(self, result):
         # The 'result' object here can be either a bool or a tuple depending on
         # the result of the Lua function, the following results are possible:
         #  - True:           script succeeded but returned nothing
         #  - (True, ...):    script succeeded with return values
         #  - (False, error): script raised an error during execution
         #  - (None, error):  script syntax loading error
-        try:
-            result = sandbox.run(lua_script)
-            # If just a bool, return the empty result for success
-            if isinstance(result, bool) and result is True:
-                return []
-
-            # Check result of executing the Lua script
-            if result[0] is not True:
-                exit_status, error = result
-
-                if exit_status is None:
-                    raise SyntaxError(error)
-
-                if exit_status is False:
-                    if str(error).endswith(self.ERROR_INSTRUCTION_LIMIT_EXCEEDED):
-                        raise RuntimeExecutionTimeExceededError()
-                    elif str(error).endswith(self.ERROR_MEMORY_LIMIT_EXCEEDED):
-                        raise RuntimeMemoryExceededError()
-                    elif str(error).endswith(self.ERROR_SANDBOX_VIOLATION):
-                        raise RuntimeSandboxViolationError(str(error).replace(" " + self.ERROR_SANDBOX_VIOLATION, ""))
-                    else:
-                        raise RuntimeExecutionError(error)
-            else:
-                # Expand the return values to a list and return
-                exit_status, *return_values = result
-                return return_values
-
-        except lupa.LuaError as error:
-            # An error has occurred in the sandbox runtime itself
-            raise RuntimeExecutionError("Sandbox") from error
+
+        # If just a bool, return the empty result for success
+        if isinstance(result, bool) and result is True:
+            return []
+
+        # Check result of executing the Lua script
+        if result[0] is not True:
+            exit_status, error = result
+
+            if exit_status is None:
+                raise SyntaxError(error)
+
+            if exit_status is False:
+                if str(error).endswith(self.ERROR_INSTRUCTION_LIMIT_EXCEEDED):
+                    raise RuntimeExecutionTimeExceededError()
+                elif str(error).endswith(self.ERROR_MEMORY_LIMIT_EXCEEDED):
+                    raise RuntimeMemoryExceededError()
+                elif str(error).endswith(self.ERROR_SANDBOX_VIOLATION):
+                    raise RuntimeSandboxViolationError(str(error).replace(" " + self.ERROR_SANDBOX_VIOLATION, ""))
+                else:
+                    raise RuntimeExecutionError(error)
+        else:
+            # Expand the return values to a list and return
+            exit_status, *return_values = result
+            return return_values
+
+
+class LuaValidator:
+    """Validates guesses against a Lua script, run on a state borrowed from the runtime's pool.
+
+    Each state compiles the script the first time it runs it and keeps it until the pool next checks the state's memory.
+    The script's environment is reset before every guess so no state can leak from one guess to the next."""
+    def __init__(self, runtime, script,
+                 instruction_limit=LuaRuntime.DEFAULT_INSTRUCTION_LIMIT,
+                 memory_limit=LuaRuntime.DEFAULT_MEMORY_LIMIT):
+        self.runtime = runtime
+        self.script = script
+        self.instruction_limit = instruction_limit
+        self.memory_limit = memory_limit
+
+        with runtime.pool().state() as state:
+            sandboxed_function, error = state.compile(script)
+        if sandboxed_function is None:
+            raise SyntaxError(error)
+
+    def __call__(self, guess):
+        return_values = self.runtime._sandbox_run(self.script, {
+            "guess": guess,
+        }, self.instruction_limit, self.memory_limit)
+
+        if len(return_values) == 0:
+            raise RuntimeExecutionError("Lua script did not return a value")
+
+        return return_values[0]
@@ -0,0 +1,101 @@
+# Copyright (C) 2018 The Hunter2 Contributors.
+#
+# This file is part of Hunter2.
+#
+# Hunter2 is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# Hunter2 is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import threading
+from contextlib import contextmanager
+
+
+class SandboxState:
+    """A Lua state with the sandbox module loaded, which can be used to run any number of scripts one at a time."""
+    def __init__(self, lua):
+        self.lua = lua
+        self.sandbox = lua.require('sandbox')
+        self.uses = 0
+        # Scripts compiled in this state, each with the environment it runs in, and the memory they keep in kilobytes
+        self.compiled = {}
+        self.compiled_memory = 0
+        self.initial_memory = self.memory()
+
+    def compile(self, script):
+        """Return the script compiled in this state and its environment, or None and the error if it does not compile."""
+        compiled = self.compiled.get(script)
+        if compiled is None:
+            compiled = self.sandbox.compile(script)
+            if compiled[0] is not None:
+                self.compiled[script] = compiled
+                self.compiled_memory = self.memory() - self.initial_memory
+        return compiled
+
+    def call(self, sandboxed_function, env, instruction_limit, memory_limit):
+        """Run a compiled script in its environment, returning the results of pcall.
+
+        The memory limit applies to what the script uses on top of the scripts compiled in this state."""
+        return self.sandbox.call(sandboxed_function, env, instruction_limit, memory_limit + self.compiled_memory)
+
+    def clear(self):
+        """Drop the scripts compiled in this state."""
+        self.compiled.clear()
+        self.compiled_memory = 0
+
+    def memory(self):
+        """Memory in use by the Lua state after a full garbage collection, in kilobytes."""
+        return self.sandbox.memory()
+
+
+class SandboxPool:
+    """A pool of idle SandboxStates, so that running a script does not have to pay for creating and initialising Lua.
+
+    At most `size` idle states are kept. States are discarded rather than returned to the pool once they have been used
+    `max_uses` times, have compiled `max_scripts` scripts or their memory usage has grown by more than `max_growth`
+    kilobytes. Measuring memory needs a full garbage collection, so it is only done every `check_interval` uses, and drops
+    the scripts compiled in the state so that they are not counted."""
+    def __init__(self, create_lua, size, max_uses, max_growth, check_interval, max_scripts):
+        self.create_lua = create_lua
+        self.size = size
+        self.max_uses = max_uses
+        self.max_growth = max_growth
+        self.check_interval = check_interval
+        self.max_scripts = max_scripts
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def __len__(self):
+        return len(self._idle)
+
+    @contextmanager
+    def state(self):
+        with self._lock:
+            state = self._idle.pop() if self._idle else None
+        if state is None:
+            state = SandboxState(self.create_lua())
+
+        yield state
+
+        # We only get here if the caller did not raise, so states which saw an error in the Lua runtime are dropped
+        state.uses += 1
+        self._release(state)
+
+    def _release(self, state):
+        if state.uses >= self.max_uses or len(state.compiled) >= self.max_scripts:
+            return
+        if state.uses % self.check_interval == 0:
+            state.clear()
+            if state.memory() - state.initial_memory > self.max_growth:
+                return
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(state)
+
+    def clear(self):
+        with self._lock:
+            self._idle.clear()
@@ -158,20 +158,37 @@ sandbox.env = {
   },
 }
 
+-- Copy of the environment taken before any script has run, used to reset the environments scripts run in
+local pristine_env = {}
+for k, v in pairs(sandbox.env) do
+  pristine_env[k] = v
+end
+
 function sandbox.enable_limits(instruction_limit, memory_limit)
   sandbox.cpu_count = 0
   debug.sethook(function()
     sandbox.cpu_count = sandbox.cpu_count + 1
     local kilobytes, _ = collectgarbage('count')
-    if kilobytes > memory_limit then error("ERROR_MEMORY_LIMIT_EXCEEDED") end
-    if sandbox.cpu_count > instruction_limit then error("ERROR_INSTRUCTION_LIMIT_EXCEEDED") end
+    -- The count includes garbage left by previous runs, so only collect it when it would otherwise stop the script
+    if kilobytes > memory_limit then
+      collectgarbage()
+      kilobytes, _ = collectgarbage('count')
+    end
+    -- Remove the hook before raising so that a Lua state can continue to be used once the script has been stopped
+    if kilobytes > memory_limit then debug.sethook() error("ERROR_MEMORY_LIMIT_EXCEEDED") end
+    if sandbox.cpu_count > instruction_limit then debug.sethook() error("ERROR_INSTRUCTION_LIMIT_EXCEEDED") end
   end, '', 10)
 end
 
-function sandbox.run(sandboxed_code, mem_limit, instruction_limit)
+function sandbox.disable_limits(...)
+  debug.sethook()
+  return ...
+end
+
+function sandbox.protect_metatables(string_library)
   -- Replace string metatable with sandboxed version
   local metatable = {__index={}}
-  for k, v in pairs(sandbox.env.string) do
+  for k, v in pairs(string_library) do
     metatable['__index'][k] = v
   end
   debug.setmetatable('', metatable)
@@ -180,10 +197,57 @@ function sandbox.run(sandboxed_code, mem_limit, instruction_limit)
   debug.setmetatable(1, nil)
   debug.setmetatable(function() end, nil)
   debug.setmetatable(true, nil)
+end
 
-  local sandboxed_function, message = load(sandboxed_code, nil, 't', sandbox.env)
+-- Load a script so that it can be run, possibly repeatedly, with sandbox.call
+-- Returns the compiled function and the environment it runs in, or nil and an error message
+function sandbox.compile(sandboxed_code)
+  local env = {}
+  local sandboxed_function, message = load(sandboxed_code, nil, 't', env)
   if not sandboxed_function then return nil, message end
-  return pcall(sandboxed_function)
+  return sandboxed_function, env
+end
+
+-- Restore the environment of a compiled script to its pristine state, discarding anything left by previous runs
+function sandbox.reset(env)
+  for k, _ in pairs(env) do
+    env[k] = nil
+  end
+  for k, v in pairs(pristine_env) do
+    if type(v) == 'table' then
+      local library = {}
+      for lk, lv in pairs(v) do
+        library[lk] = lv
+      end
+      env[k] = library
+    else
+      env[k] = v
+    end
+  end
+  -- Scripts can change the modules they require and the random number generator, so give the next run fresh ones
+  for _, module in ipairs(sandbox.allowed_modules) do
+    package.loaded[module] = nil
+  end
+  math.randomseed(os.time())
+end
+
+-- Enable the limits and run a compiled script, from inside pcall so that the limits can only stop the script
+local function run_limited(sandboxed_function, instruction_limit, memory_limit)
+  sandbox.enable_limits(instruction_limit, memory_limit)
+  return sandboxed_function()
+end
+
+-- Run a compiled script with limits enabled, returning the results of pcall
+function sandbox.call(sandboxed_function, env, instruction_limit, memory_limit)
+  sandbox.protect_metatables(env.string)
+  return sandbox.disable_limits(pcall(run_limited, sandboxed_function, instruction_limit, memory_limit))
+end
+
+-- Memory in use by this Lua state in kilobytes, after collecting any garbage
+function sandbox.memory()
+  collectgarbage()
+  local kilobytes, _ = collectgarbage('count')
+  return kilobytes
 end
 
 return sandbox
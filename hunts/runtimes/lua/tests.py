@@ -11,11 +11,16 @@
 # You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from types import SimpleNamespace
+from unittest import mock
+
 from django.test import SimpleTestCase
 from parameterized import parameterized
 
 from ..exceptions import RuntimeExecutionError, RuntimeExecutionTimeExceededError, RuntimeMemoryExceededError, RuntimeSandboxViolationError
 from . import LuaRuntime
+from .pool import SandboxPool
+from .worker import LuaWorkerPool
 
 
 class LuaRuntimeTestCase(SimpleTestCase):
@@ -57,6 +62,52 @@ class LuaRuntimeTestCase(SimpleTestCase):
             lua_runtime.evaluate(lua_script, None, None, None, None)
         self.assertRegex(context.exception.message, ".*error_message$")
 
+    def test_validator(self):
+        lua_runtime = LuaRuntime()
+        validator = lua_runtime.create_validator('''return (tonumber(guess) == 100 + 100)''')
+        self.assertTrue(validator("200"))
+        self.assertFalse(validator("100"))
+        self.assertTrue(validator("200"))
+
+    def test_validator_syntax_error_fails(self):
+        lua_runtime = LuaRuntime()
+        with self.assertRaises(SyntaxError):
+            lua_runtime.create_validator('''@''')
+
+    def test_validator_isolates_guesses(self):
+        lua_runtime = LuaRuntime()
+        validator = lua_runtime.create_validator('''
+            local clean = seen == nil and string.upper ~= nil
+            seen = true
+            string.upper = nil
+            return clean
+        ''')
+        self.assertTrue(validator("one"))
+        self.assertTrue(validator("two"), "State from the previous guess was visible to the next")
+
+    def test_validator_recovers_from_limits(self):
+        lua_runtime = LuaRuntime()
+        validator = lua_runtime.create_validator('''
+            if guess == "loop" then
+                while true do end
+            end
+            return true
+        ''')
+        with self.assertRaises(RuntimeExecutionTimeExceededError):
+            validator("loop")
+        self.assertTrue(validator("stop"))
+
+    def test_validator_uses_pool(self):
+        pool = SandboxPool(LuaRuntime._create_lua_runtime, size=1, max_uses=100, max_growth=1024, check_interval=100, max_scripts=100)
+        lua_script = '''return guess == "answer"'''
+        with mock.patch.object(LuaRuntime, '_pool', pool):
+            validator = LuaRuntime().create_validator(lua_script)
+            self.assertTrue(validator("answer"))
+            self.assertFalse(validator("other"))
+        with pool.state() as state:
+            self.assertEqual(state.uses, 3)
+            self.assertIn(lua_script, state.compiled)
+
 
 class LuaSandboxTestCase(SimpleTestCase):
     # Functions that we do not want to expose to our sandbox
@@ -125,6 +176,109 @@ class LuaSandboxTestCase(SimpleTestCase):
             lua_runtime._sandbox_run(lua_script)
 
 
+class LuaSandboxPoolTestCase(SimpleTestCase):
+    def test_lua_sandbox_state_reuse(self):
+        pool = SandboxPool(LuaRuntime._create_lua_runtime, size=1, max_uses=100, max_growth=1024, check_interval=1, max_scripts=100)
+        with pool.state() as state:
+            first = state
+        with pool.state() as state:
+            self.assertIs(state, first)
+            self.assertEqual(state.uses, 1)
+
+    def test_lua_sandbox_state_recycling(self):
+        pool = SandboxPool(LuaRuntime._create_lua_runtime, size=1, max_uses=2, max_growth=1024, check_interval=1, max_scripts=100)
+        with pool.state() as state:
+            first = state
+        with pool.state():
+            pass
+        with pool.state() as state:
+            self.assertIsNot(state, first)
+
+    def test_lua_sandbox_state_discarded_on_error(self):
+        pool = SandboxPool(LuaRuntime._create_lua_runtime, size=1, max_uses=100, max_growth=1024, check_interval=1, max_scripts=100)
+        with self.assertRaises(ValueError):
+            with pool.state():
+                raise ValueError()
+        self.assertEqual(len(pool), 0)
+
+    def test_lua_sandbox_state_growth(self):
+        pool = SandboxPool(LuaRuntime._create_lua_runtime, size=1, max_uses=100, max_growth=0, check_interval=2, max_scripts=100)
+        with pool.state() as state:
+            state.lua.execute('leak = {} for i = 1, 1000 do leak[i] = i end')
+            first = state
+        # Growth is only checked every other use
+        with pool.state() as state:
+            self.assertIs(state, first)
+        with pool.state() as state:
+            self.assertIsNot(state, first)
+
+    def test_lua_sandbox_many_scripts(self):
+        # The scripts compiled in a state must not count towards the memory limit of the script being run
+        pool = SandboxPool(LuaRuntime._create_lua_runtime, size=1, max_uses=1000, max_growth=1024, check_interval=1000, max_scripts=1000)
+        with mock.patch.object(LuaRuntime, '_pool', pool):
+            lua_runtime = LuaRuntime()
+            for i in range(100):
+                self.assertEqual(lua_runtime._sandbox_run(f'''return {i}''')[0], i)
+        with pool.state() as state:
+            self.assertEqual(len(state.compiled), 100)
+
+    def test_lua_sandbox_state_script_limit(self):
+        pool = SandboxPool(LuaRuntime._create_lua_runtime, size=1, max_uses=100, max_growth=1024, check_interval=100, max_scripts=2)
+        with pool.state() as state:
+            state.compile('''return 1''')
+            first = state
+        with pool.state() as state:
+            self.assertIs(state, first)
+            state.compile('''return 2''')
+        with pool.state() as state:
+            self.assertIsNot(state, first)
+
+    def test_lua_sandbox_isolation_between_runs(self):
+        lua_runtime = LuaRuntime()
+        lua_script = '''
+            local clean = counter == nil and string.upper ~= nil
+            counter = 1
+            string.upper = nil
+            return clean
+        '''
+        for _ in range(3):
+            self.assertTrue(lua_runtime._sandbox_run(lua_script)[0], "State from a previous run was visible")
+
+
+class LuaWorkerPoolTestCase(SimpleTestCase):
+    def setUp(self):
+        self.workers = LuaWorkerPool(1, timeout=5)
+
+    def tearDown(self):
+        self.workers.close()
+
+    def test_lua_worker_evaluate(self):
+        team_data = SimpleNamespace(data={'x': 1})
+        lua_script = '''team_data.data = "changed" return "Hello World"'''
+        result = self.workers.evaluate(lua_script, None, None, team_data, None)
+        self.assertEqual(result, "Hello World")
+        self.assertEqual(team_data.data, "changed")
+
+    def test_lua_worker_validate_guess(self):
+        lua_script = '''return (tonumber(guess) == 100 + 100)'''
+        self.assertTrue(self.workers.validate_guess(lua_script, "200"))
+        self.assertFalse(self.workers.validate_guess(lua_script, "201"))
+
+    def test_lua_worker_errors(self):
+        with self.assertRaises(SyntaxError):
+            self.workers.validate_guess('''@''', "")
+        with self.assertRaises(RuntimeExecutionTimeExceededError):
+            self.workers.validate_guess('''while true do end''', "")
+
+    def test_lua_worker_timeout(self):
+        self.workers.timeout = 0.01
+        with self.assertRaises(RuntimeExecutionTimeExceededError):
+            self.workers.validate_guess('''while true do end''', "")
+        # The worker was killed, so a new one should be started for the next script
+        self.workers.timeout = 5
+        self.assertTrue(self.workers.validate_guess('''return true''', ""))
+
+
 class LuaSandboxLibrariesTestCase(SimpleTestCase):
     # Functions that we do not want to expose to our sandbox
     SUPPORTED_LIBRARIES = [
@@ -138,3 +292,13 @@ class LuaSandboxLibrariesTestCase(SimpleTestCase):
         lua_script = '''return require('{}')'''.format(library)
         result = lua_runtime._sandbox_run(lua_script)[0]
         self.assertTrue(result, "Lua library {} can not be loaded in the sandbox".format(library))
+
+    def test_lua_sandbox_library_isolation_between_runs(self):
+        pool = SandboxPool(LuaRuntime._create_lua_runtime, size=1, max_uses=100, max_growth=1024, check_interval=100, max_scripts=100)
+        with mock.patch.object(LuaRuntime, '_pool', pool):
+            lua_runtime = LuaRuntime()
+            lua_runtime._sandbox_run('''require('cjson').encode = nil''')
+            self.assertTrue(
+                lua_runtime._sandbox_run('''return require('cjson').encode ~= nil''')[0],
+                "Change to a library from a previous run was visible"
+            )
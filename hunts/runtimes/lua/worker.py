@@ -0,0 +1,168 @@
+# Copyright (C) 2018 The Hunter2 Contributors.
+#
+# This file is part of Hunter2.
+#
+# Hunter2 is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# Hunter2 is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import multiprocessing
+import pickle  # nosec we only unpickle messages from our own worker processes
+import queue
+import resource
+from types import SimpleNamespace
+
+from ..exceptions import RuntimeExecutionError, RuntimeExecutionTimeExceededError
+
+# Attributes of the puzzle data objects passed to evaluate which are made available to scripts in worker processes
+EXPORTED_ATTRIBUTES = ('data', 'start_time', 'token')
+
+
+def _export(obj):
+    if obj is None:
+        return None
+    return {attr: getattr(obj, attr) for attr in EXPORTED_ATTRIBUTES if hasattr(obj, attr)}
+
+
+def _import(exported):
+    if exported is None:
+        return None
+    return SimpleNamespace(**exported)
+
+
+def _worker_main(conn, memory_limit):
+    """Entry point of a worker process: run scripts sent down the pipe until it is closed."""
+    from . import LuaRuntime
+    from .pool import SandboxPool
+
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    # Settings are not available in the worker, and only one script runs at a time, so the pool needs only one state
+    LuaRuntime._pool = SandboxPool(
+        LuaRuntime._create_lua_runtime,
+        size=1,
+        max_uses=LuaRuntime.DEFAULT_POOL_MAX_USES,
+        max_growth=LuaRuntime.DEFAULT_POOL_GROWTH,
+        check_interval=LuaRuntime.DEFAULT_POOL_CHECK,
+        max_scripts=LuaRuntime.DEFAULT_POOL_SCRIPTS,
+    )
+    runtime = LuaRuntime()
+
+    while True:
+        try:
+            method, args = conn.recv()
+        except EOFError:
+            return
+
+        try:
+            if method == 'evaluate':
+                script, exported = args
+                objects = [_import(e) for e in exported]
+                result = runtime._evaluate(script, *objects)
+                value = (result, [o.data if o is not None else None for o in objects])
+            elif method == 'validate_guess':
+                value = bool(runtime._validate_guess(*args))
+            else:
+                raise ValueError(f'Unknown method {method}')
+        except Exception as error:
+            message = pickle.dumps(('error', error))
+        else:
+            try:
+                message = pickle.dumps(('ok', value))
+            except TypeError:
+                # Lua tables and functions can't leave the worker
+                message = pickle.dumps(('error', RuntimeExecutionError("Lua script returned a value which can not be passed back")))
+
+        conn.send_bytes(message)
+
+
+class LuaWorker:
+    """A single worker process and the pipe used to talk to it."""
+    def __init__(self, context, memory_limit):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, memory_limit), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def run(self, method, args, timeout):
+        """Run a method in the worker, returning (status, value). Raises TimeoutError if the worker does not respond."""
+        self.conn.send((method, args))
+        if not self.conn.poll(timeout):
+            raise TimeoutError()
+        return pickle.loads(self.conn.recv_bytes())  # nosec see above
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class LuaWorkerPool:
+    """Runs Lua scripts in a pool of persistent worker processes.
+
+    Unlike running scripts inline, this enforces a wall-clock time limit on each script by killing the worker running it,
+    and a hard limit on the address space of each worker. Scripts run concurrently, up to one per worker, and a caller
+    waits for a worker to become free if they are all busy."""
+    def __init__(self, size, timeout, memory_limit=None):
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self._context = multiprocessing.get_context('forkserver')
+        # Workers are started lazily; None represents a worker which has not been started or has been killed
+        self._workers = queue.Queue()
+        for _ in range(size):
+            self._workers.put(None)
+
+    def evaluate(self, script, team_puzzle_data, user_puzzle_data, team_data, user_data):
+        objects = (team_puzzle_data, user_puzzle_data, team_data, user_data)
+        result, data = self._run('evaluate', script, [_export(o) for o in objects])
+
+        # Copy back any changes the script made to the data
+        for obj, value in zip(objects, data):
+            if obj is not None:
+                obj.data = value
+
+        return result
+
+    def validate_guess(self, validator, guess):
+        return self._run('validate_guess', validator, guess)
+
+    def _run(self, method, *args):
+        worker = self._workers.get()
+        try:
+            if worker is None or not worker.is_alive():
+                worker = LuaWorker(self._context, self.memory_limit)
+            try:
+                status, value = worker.run(method, args, self.timeout)
+            except TimeoutError:
+                worker.kill()
+                worker = None
+                raise RuntimeExecutionTimeExceededError()
+            except (EOFError, OSError) as error:
+                # Most likely the worker ran out of memory and was killed
+                worker.kill()
+                worker = None
+                raise RuntimeExecutionError("Lua worker process exited unexpectedly") from error
+        finally:
+            self._workers.put(worker)
+
+        if status == 'error':
+            raise value
+        return value
+
+    def close(self):
+        while True:
+            try:
+                worker = self._workers.get_nowait()
+            except queue.Empty:
+                return
+            if worker is not None:
+                worker.kill()
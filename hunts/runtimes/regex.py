@@ -36,3 +36,9 @@ class RegexRuntime(AbstractRuntime):
             return re.fullmatch(validator, guess, flags=self.flags)
         except re.error as error:
             raise SyntaxError(error) from error
+
+    def create_validator(self, validator):
+        try:
+            return re.compile(validator, flags=self.flags).fullmatch
+        except re.error as error:
+            raise SyntaxError(error) from error
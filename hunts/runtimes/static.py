@@ -26,3 +26,10 @@ class StaticRuntime(AbstractRuntime):
             return validator == guess
         else:
             return validator.lower() == guess.lower()
+
+    def create_validator(self, validator):
+        if self.case_sensitive:
+            return lambda guess: validator == guess
+        else:
+            validator = validator.lower()
+            return lambda guess: validator == guess.lower()
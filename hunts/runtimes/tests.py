@@ -13,6 +13,8 @@
 
 from django.test import TestCase, SimpleTestCase
 
+from . import Runtime
+from .cache import ValidatorCache
 from .iframe import IFrameRuntime
 from .regex import RegexRuntime
 from .static import StaticRuntime
@@ -84,6 +86,18 @@ class RegexRuntimeTestCase(SimpleTestCase):
         with self.assertRaises(SyntaxError):
             regex_runtime.validate_guess(regex_script, "")
 
+    def test_create_validator(self):
+        regex_runtime = RegexRuntime(case_sensitive=False)
+        validator = regex_runtime.create_validator(r'Hello \w*!')
+        self.assertTrue(validator("Hello Planet!"))
+        self.assertTrue(validator("hello Friend!"))
+        self.assertFalse(validator("Goodbye World!"))
+
+    def test_create_validator_syntax_error_fails(self):
+        regex_runtime = RegexRuntime(case_sensitive=False)
+        with self.assertRaises(SyntaxError):
+            regex_runtime.create_validator(r'[]')
+
 
 class StaticRuntimeTestCase(SimpleTestCase):
     def test_evaluate(self):
@@ -114,3 +128,41 @@ class StaticRuntimeTestCase(SimpleTestCase):
         guess = "answer"
         result = static_runtime.validate_guess(static_script, guess)
         self.assertFalse(result)
+
+    def test_create_validator(self):
+        static_runtime = StaticRuntime(case_sensitive=False)
+        validator = static_runtime.create_validator('Answer')
+        self.assertTrue(validator("answer"))
+        self.assertTrue(validator("ANSWER"))
+        self.assertFalse(validator("incorrect answer"))
+        static_runtime = StaticRuntime(case_sensitive=True)
+        validator = static_runtime.create_validator('Answer')
+        self.assertTrue(validator("Answer"))
+        self.assertFalse(validator("answer"))
+
+
+class ValidatorCacheTestCase(SimpleTestCase):
+    def test_reuses_validators(self):
+        cache = ValidatorCache()
+        validator = cache.get('owner', Runtime.STATIC, 'answer')
+        self.assertIs(cache.get('owner', Runtime.STATIC, 'answer'), validator)
+        self.assertIsNot(cache.get('owner', Runtime.STATIC, 'other'), validator)
+        self.assertIsNot(cache.get('owner', Runtime.REGEX, 'answer'), validator)
+
+    def test_evicts_least_recently_used(self):
+        cache = ValidatorCache(max_size=2)
+        first = cache.get('first', Runtime.STATIC, 'answer')
+        cache.get('second', Runtime.STATIC, 'answer')
+        # Use the first validator so that the second is evicted instead
+        cache.get('first', Runtime.STATIC, 'answer')
+        cache.get('third', Runtime.STATIC, 'answer')
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.get('first', Runtime.STATIC, 'answer'), first)
+
+    def test_invalidate(self):
+        cache = ValidatorCache()
+        validator = cache.get('owner', Runtime.STATIC, 'answer')
+        cache.get('other', Runtime.STATIC, 'answer')
+        cache.invalidate('owner')
+        self.assertEqual(len(cache), 1)
+        self.assertIsNot(cache.get('owner', Runtime.STATIC, 'answer'), validator)
@@ -11,23 +11,38 @@
 # You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db.models.signals import m2m_changed
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
 from accounts.models import UserProfile
+from events.models import EventFile
 from teams.models import Team
-from .models import Episode, Guess
+from . import consumers
+from .content import content_cache
+from .context_processors import invalidate_announcements
+from .headstarts import invalidate_headstarts
+from .models import Announcement, Answer, Episode, Guess, Headstart, Hint, Puzzle, PuzzleFile, SolutionFile, TeamPuzzleData, UnlockAnswer
+from .ordinals import invalidate_ordinals
+from .prequels import episode_graph, invalidate_episode_graph
+from .rules import invalidate_admins
+from .runtimes.cache import validator_cache
+from .stats import invalidate_stats
 
 
 @receiver(m2m_changed, sender=Episode.prequels.through)
 def episode_prequels_changed(sender, instance, action, pk_set, **kwargs):
     if action == 'pre_add':
+        # Check against the prequels as they are in this transaction, rather than as they were last committed
+        graph = episode_graph(cached=False)
         for episode_id in pk_set:
-            episode = Episode.objects.get(pk=episode_id)
-            if episode == instance:
+            if episode_id == instance.pk:
                 raise ValidationError('Episode cannot follow itself')
-            elif episode.follows(instance):
+            elif graph.follows(episode_id, instance.pk):
                 raise ValidationError('Circular dependency found in episodes')
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_episode_graph()
 
 
 @receiver(m2m_changed, sender=Team.members.through)
@@ -35,4 +50,136 @@ def members_changed(sender, instance, action, pk_set, **kwargs):
     if action == 'post_add':
         users = UserProfile.objects.filter(pk__in=pk_set)
         guesses = Guess.objects.filter(by__in=users)
+        # The guesses' previous teams may have been relying on them for their progress
+        affected = set(guesses.values_list('for_puzzle_id', 'by_team_id'))
         guesses.update(by_team=instance, correct_current=False)
+        for puzzle in Puzzle.objects.filter(pk__in={puzzle_id for puzzle_id, _ in affected}):
+            team_ids = {team_id for puzzle_id, team_id in affected if puzzle_id == puzzle.pk and team_id is not None}
+            for team in Team.objects.filter(pk__in=team_ids | {instance.pk}):
+                puzzle.update_progress(team)
+
+
+@receiver(post_delete, sender=Guess)
+def guess_deleted(sender, instance, **kwargs):
+    if instance.by_team_id is None:
+        return
+    try:
+        puzzle = Puzzle.objects.get(pk=instance.for_puzzle_id)
+        team = Team.objects.get(pk=instance.by_team_id)
+    except (Puzzle.DoesNotExist, Team.DoesNotExist):
+        # The guess is being deleted along with its puzzle or team so there is no progress to update
+        return
+    puzzle.update_progress(team)
+
+
+@receiver(post_save, sender=Answer)
+@receiver(post_delete, sender=Answer)
+@receiver(post_save, sender=UnlockAnswer)
+@receiver(post_delete, sender=UnlockAnswer)
+def validator_changed(sender, instance, **kwargs):
+    # Primary keys are only unique within an event's schema, but this only means we may evict more than necessary
+    validator_cache.invalidate((instance._meta.label, instance.pk))
+
+
+@receiver(post_save, sender=Guess)
+def guess_saved(sender, instance, created, **kwargs):
+    # Wait for the guess's effect on progress and unlocks to be saved too. When that is done in the background the
+    # worker sends the guess itself once it is finished.
+    if created and not settings.ASYNC_GUESSES:
+        transaction.on_commit(lambda: consumers.send_guess(instance))
+
+
+@receiver(post_save, sender=Announcement)
+def announcement_saved(sender, instance, created, **kwargs):
+    invalidate_announcements()
+    if created:
+        transaction.on_commit(lambda: consumers.send_announcement(instance))
+
+
+@receiver(post_delete, sender=Announcement)
+def announcement_deleted(sender, instance, **kwargs):
+    invalidate_announcements()
+
+
+@receiver(post_save, sender=Episode)
+@receiver(post_delete, sender=Episode)
+@receiver(post_save, sender=Puzzle)
+@receiver(post_delete, sender=Puzzle)
+@receiver(post_save, sender=Team)
+@receiver(post_delete, sender=Team)
+def stats_structure_changed(sender, instance, **kwargs):
+    invalidate_stats()
+
+
+@receiver(m2m_changed, sender=Team.members.through)
+def stats_members_changed(sender, instance, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_stats()
+
+
+@receiver(post_save, sender=TeamPuzzleData)
+def team_puzzle_data_saved(sender, instance, update_fields, **kwargs):
+    if update_fields is None or 'start_time' in update_fields:
+        invalidate_stats()
+
+
+@receiver(post_save, sender=Puzzle)
+@receiver(post_delete, sender=Puzzle)
+@receiver(post_delete, sender=Episode)
+def headstarts_structure_changed(sender, instance, **kwargs):
+    invalidate_headstarts()
+
+
+@receiver(m2m_changed, sender=Episode.headstart_from.through)
+def episode_headstart_from_changed(sender, instance, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_headstarts()
+
+
+@receiver(post_save, sender=Headstart)
+@receiver(post_delete, sender=Headstart)
+def headstart_changed(sender, instance, **kwargs):
+    invalidate_headstarts(instance.team_id)
+
+
+@receiver(post_save, sender=Episode)
+@receiver(post_delete, sender=Episode)
+@receiver(post_save, sender=Puzzle)
+@receiver(post_delete, sender=Puzzle)
+def episode_structure_changed(sender, instance, **kwargs):
+    invalidate_episode_graph()
+    invalidate_ordinals()
+
+
+@receiver(post_save, sender=EventFile)
+@receiver(post_delete, sender=EventFile)
+@receiver(post_save, sender=PuzzleFile)
+@receiver(post_delete, sender=PuzzleFile)
+@receiver(post_save, sender=SolutionFile)
+@receiver(post_delete, sender=SolutionFile)
+@receiver(post_save, sender=Hint)
+@receiver(post_delete, sender=Hint)
+def content_changed(sender, instance, **kwargs):
+    # These are the only models the content cache depends on; see ContentCache before caching anything else in it
+    content_cache.invalidate()
+
+
+@receiver(post_save, sender=Team)
+@receiver(post_delete, sender=Team)
+def team_changed(sender, instance, **kwargs):
+    invalidate_admins(instance.at_event_id)
+
+
+@receiver(m2m_changed, sender=Team.members.through)
+def admins_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        teams = [instance] if instance.is_admin else []
+    elif pk_set is None:
+        # A user's teams were cleared, and the teams they were removed from are no longer known
+        teams = Team.objects.filter(is_admin=True)
+    else:
+        teams = Team.objects.filter(pk__in=pk_set, is_admin=True)
+    for event_id in {team.at_event_id for team in teams}:
+        invalidate_admins(event_id)
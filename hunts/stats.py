@@ -0,0 +1,172 @@
+# Copyright (C) 2018 The Hunter2 Contributors.
+#
+# This file is part of Hunter2.
+#
+# Hunter2 is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# Hunter2 is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from collections import defaultdict
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Count
+from django.utils import timezone
+
+from .utils import bump_cache_version, cache_version
+
+STATS_CACHE_TIMEOUT = 60 * 60  # Seconds
+
+
+def _version_key(event):
+    return f'hunts.stats.{event.schema_name}.version'
+
+
+def stats_version(event):
+    """Return the current version of the event's stats, or None if there is no cache to keep it in."""
+    return cache_version(_version_key(event))
+
+
+def invalidate_stats(event=None):
+    """Mark the stats of the given event, or the current one, out of date once the current transaction is committed."""
+    if event is None:
+        event = connection.tenant
+    bump_cache_version(_version_key(event))
+
+
+def _aggregate(event, episode):
+    """Collect when each team started and solved each puzzle, and the series which depend only on those times."""
+    from teams.models import Team
+    from .models import Puzzle, TeamPuzzleData, TeamPuzzleProgress
+
+    episodes = event.episode_set.all()
+    puzzles = Puzzle.objects.all()
+    if episode is not None:
+        episodes = episodes.filter(pk=episode.pk)
+        puzzles = puzzles.filter(episode=episode)
+    puzzles = list(puzzles)
+
+    teams = list(Team.objects.annotate(
+        num_members=Count('members')
+    ).filter(
+        at_event=event,
+        is_admin=False,
+        num_members__gte=1,
+    ).prefetch_related('members', 'members__user'))
+    team_names = {t.pk: t.get_verbose_name() for t in teams}
+
+    start_times = {
+        (d['team_id'], d['puzzle_id']): d['start_time']
+        for d in TeamPuzzleData.objects.filter(
+            puzzle__in=puzzles, team__in=teams, start_time__isnull=False
+        ).values('team_id', 'puzzle_id', 'start_time')
+    }
+    solved_times = {
+        (p['team_id'], p['puzzle_id']): p['solved_at']
+        for p in TeamPuzzleProgress.objects.filter(
+            puzzle__in=puzzles, team__in=teams
+        ).values('team_id', 'puzzle_id', 'solved_at')
+    }
+
+    # How long teams which have solved each puzzle took to do so
+    durations = defaultdict(list)
+    for key, solved_at in solved_times.items():
+        if key in start_times:
+            durations[key[1]].append(solved_at - start_times[key])
+
+    return {
+        'teams': [(t.pk, team_names[t.pk]) for t in teams],
+        'puzzles': [(p.pk, p.title) for p in puzzles],
+        # Teams are only stuck on puzzles they have started and not solved
+        'stuck_since': {key: start for key, start in start_times.items() if key not in solved_times},
+        'series': {
+            'teams': [team_names[t.pk] for t in teams],
+            'numTeams': len(teams),
+            'startTime': min([e.start_date for e in episodes]),
+            'puzzles': [p.title for p in puzzles],
+            'puzzleCompletion': [
+                {
+                    'puzzle': p.title,
+                    'completion': len([1 for t in teams if (t.pk, p.pk) in solved_times]),
+                } for p in puzzles],
+            'puzzleProgress': [
+                {
+                    'team': team_names[t.pk],
+                    'progress': [{
+                        'puzzle': p.title,
+                        'time': solved_times[t.pk, p.pk],
+                    } for p in puzzles if (t.pk, p.pk) in solved_times]
+                } for t in teams],
+            'puzzleDifficulty': [
+                {
+                    'puzzle': p.title,
+                    'average_time': sum(durations[p.pk], timedelta()).total_seconds() / len(durations[p.pk]),
+                } for p in puzzles if durations[p.pk]],
+        },
+    }
+
+
+def _cached_aggregate(event, episode, version):
+    if version is None:
+        return _aggregate(event, episode)
+    key = f'hunts.stats.{event.schema_name}.{episode.pk if episode else "all"}.{version}'
+    aggregate = cache.get(key)
+    if aggregate is None:
+        aggregate = _aggregate(event, episode)
+        cache.set(key, aggregate, STATS_CACHE_TIMEOUT)
+    return aggregate
+
+
+def event_stats(event, episode=None, since=None):
+    """Return the stats for the given episode, or the whole event, for the admin stats page.
+
+    The start and solve times of each team on each puzzle are cached until one of them changes. The returned 'cursor'
+    identifies the times the stats were calculated from: if it is passed back as `since` and nothing has changed the
+    series which depend only on those times are left out, since the client already has them."""
+    now = timezone.now()
+    version = stats_version(event)
+    aggregate = _cached_aggregate(event, episode, version)
+
+    teams = aggregate['teams']
+    puzzles = aggregate['puzzles']
+    stuck_since = aggregate['stuck_since']
+
+    # How long each team has been on each puzzle it is stuck on
+    stuckness = {
+        key: (now - start).total_seconds() for key, start in stuck_since.items()
+    }
+    puzzle_stuckness = defaultdict(list)
+    for (team_id, puzzle_id), seconds in stuckness.items():
+        puzzle_stuckness[puzzle_id].append(seconds)
+
+    data = {
+        'cursor': version,
+        'endTime': min(now, event.end_date) + timedelta(minutes=10),
+        'teamTotalStuckness': [
+            {
+                'team': name,
+                'stuckness': sum(stuckness.get((t, p), 0) for p, _ in puzzles),
+            } for t, name in teams],
+        'teamPuzzleStuckness': [
+            {
+                'team': name,
+                'puzzleStuckness': [{
+                    'puzzle': title,
+                    'stuckness': stuckness[t, p],
+                } for p, title in puzzles if (t, p) in stuckness]
+            } for t, name in teams],
+        'puzzleAverageStuckness': [
+            {
+                'puzzle': title,
+                'stuckness': sum(puzzle_stuckness[p]) / len(puzzle_stuckness[p]),
+            } for p, title in puzzles if puzzle_stuckness[p]],
+    }
+    if version is None or since != str(version):
+        data.update(aggregate['series'])
+    return data
@@ -13,19 +13,27 @@
 
 import datetime
 import random
+from io import StringIO
+from unittest import mock
 
 import freezegun
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.db import transaction
+from django.core.management import call_command
+from django.core.signals import request_finished, request_started
+from django.db import connection, transaction
+from django.test import override_settings
 from django.urls import reverse
 from django.utils import timezone
+from django_tenants.test.client import TenantRequestFactory
 from parameterized import parameterized
 
 from accounts.factories import UserProfileFactory
 from events.factories import EventFactory, EventFileFactory
 from events.test import EventTestCase
 from teams.factories import TeamFactory, TeamMemberFactory
-from . import utils
+from . import consumers, content, context_processors, ingestion, ratelimit, rules, stats, utils, views
 from .factories import (
     AnnouncementFactory,
     AnswerFactory,
@@ -43,8 +51,11 @@ from .factories import (
     UserDataFactory,
     UserPuzzleDataFactory,
 )
-from .models import PuzzleData, TeamPuzzleData
+from .models import Answer, Guess, PuzzleData, TeamPuzzleData, TeamPuzzleProgress, UnlockAnswer, UserPuzzleData
+from .prequels import episode_graph
+from .progress import TeamProgress
 from .runtimes import Runtime
+from .runtimes.cache import validator_cache
 
 
 class FactoryTests(EventTestCase):
@@ -155,6 +166,23 @@ class StaticValidationTests(EventTestCase):
         self.assertFalse(answer.validate_guess(guess))
 
 
+class ValidatorCacheTests(EventTestCase):
+    def test_changing_answer_changes_validator(self):
+        answer = AnswerFactory(runtime=Runtime.STATIC, answer='first')
+        guess = GuessFactory(guess='second', for_puzzle=answer.for_puzzle)
+        self.assertFalse(answer.validate_guess(guess))
+        answer.answer = 'second'
+        answer.save()
+        answer = Answer.objects.get(pk=answer.pk)
+        self.assertTrue(answer.validate_guess(guess))
+
+    def test_unlock_answer_validator(self):
+        unlockanswer = UnlockAnswerFactory(runtime=Runtime.REGEX, guess='[Rr]egex.*')
+        self.assertIs(unlockanswer.validator(), unlockanswer.validator())
+        guess = GuessFactory(guess='Regexes', for_puzzle=unlockanswer.unlock.puzzle)
+        self.assertTrue(unlockanswer.validate_guess(guess))
+
+
 class RegexValidationTests(EventTestCase):
     def test_regex_save_answer(self):
         AnswerFactory(runtime=Runtime.REGEX, answer='[Rr]egex.*')
@@ -244,6 +272,45 @@ class AnswerSubmissionTests(EventTestCase):
             })
             self.assertEqual(response.status_code, 200)
 
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test_rate_limiter'}})
+    def test_rate_limiter(self):
+        start = datetime.datetime(2019, 1, 1, tzinfo=timezone.utc)
+
+        def at(seconds):
+            return start + datetime.timedelta(seconds=seconds)
+
+        limiter = ratelimit.RateLimiter('test-gap', 5, 1)
+        self.assertTrue(limiter.allow('a', at(4.9)))
+        # A fixed window would allow this, since it is in the next 5 seconds
+        self.assertFalse(limiter.allow('a', at(5.1)))
+        self.assertFalse(limiter.allow('a', at(9.8)))
+        self.assertTrue(limiter.allow('b', at(9.8)))
+        self.assertTrue(limiter.allow('a', at(9.9)))
+
+        limiter = ratelimit.RateLimiter('test-burst', 1, 2)
+        self.assertTrue(limiter.allow('a', at(0)))
+        self.assertTrue(limiter.allow('a', at(0)))
+        self.assertFalse(limiter.allow('a', at(0.5)))
+        self.assertTrue(limiter.allow('a', at(1)))
+        self.assertFalse(limiter.allow('a', at(1.5)))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test_invalid_answer_not_limited'}})
+    def test_invalid_answer_not_limited(self):
+        with freezegun.freeze_time():
+            for _ in range(2):
+                response = self.client.post(self.url, {'last_updated': '0', 'answer': ''})
+                self.assertEqual(response.status_code, 400)
+            response = self.client.post(self.url, {
+                'last_updated': '0',
+                'answer': GuessFactory.build(for_puzzle=self.puzzle, correct=False).guess
+            })
+            self.assertEqual(response.status_code, 200)
+            response = self.client.post(self.url, {
+                'last_updated': '0',
+                'answer': GuessFactory.build(for_puzzle=self.puzzle, correct=False).guess
+            })
+            self.assertEqual(response.status_code, 429)
+
     def test_answer_after_end(self):
         self.client.force_login(self.user.user)
         with freezegun.freeze_time() as frozen_datetime:
@@ -585,6 +652,50 @@ class EpisodeBehaviourTest(EventTestCase):
 
         self.assertEqual(episode2.headstart_applied(team), puzzle.headstart_granted + headstart.headstart_adjustment)
 
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test_headstart_cached'}})
+    def test_headstart_cached(self):
+        headstart = HeadstartFactory()
+        episode = headstart.episode
+        team = headstart.team
+
+        self.assertEqual(episode.headstart_applied(team), headstart.headstart_adjustment)
+        with self.assertNumQueries(0):
+            self.assertEqual(episode.headstart_applied(team), headstart.headstart_adjustment)
+            self.assertEqual(episode.headstart_granted(team), datetime.timedelta(0))
+
+    def test_team_progress(self):
+        episode1 = EpisodeFactory(parallel=False)
+        episode2 = EpisodeFactory(event=episode1.event, headstart_from=episode1, prequels=episode1)
+        PuzzleFactory.create_batch(3, episode=episode1)
+        PuzzleFactory(episode=episode2)
+        user = UserProfileFactory()
+        team = TeamFactory(at_event=episode1.event, members=user)
+        GuessFactory(for_puzzle=episode1.get_puzzle(1), by=user, correct=True)
+        HeadstartFactory(episode=episode2, team=team)
+
+        progress = TeamProgress(self.tenant, team)
+        episodes = (episode1, episode2)
+        puzzles = list(episode1.puzzle_set.all()) + list(episode2.puzzle_set.all())
+        # Episodes with their prequels and puzzles, the team's solves, then its headstarts since there is no cache in tests
+        with self.assertNumQueries(7):
+            results = [(
+                progress.headstart_applied(episode),
+                progress.episode_started(episode),
+                progress.episode_unlocked(episode),
+                progress.puzzles_solved(episode),
+                progress.unlocked_puzzles(episode),
+            ) for episode in episodes]
+            unlocked = [progress.puzzle_unlocked(puzzle) for puzzle in puzzles]
+
+        self.assertEqual(results, [(
+            episode.headstart_applied(team),
+            episode.started(team),
+            episode.unlocked_by(team),
+            episode.puzzles_solved_by(team),
+            list(episode.unlocked_puzzles(team)),
+        ) for episode in episodes])
+        self.assertEqual(unlocked, [puzzle.unlocked_by(team) for puzzle in puzzles])
+
     def test_next_linear_puzzle(self):
         linear_episode = EpisodeFactory(parallel=False)
         PuzzleFactory.create_batch(10, episode=linear_episode)
@@ -640,6 +751,39 @@ class EpisodeBehaviourTest(EventTestCase):
                 self.assertEqual(puzzle.get_relative_id(), i + 1, msg='Relative ID should match index in episode')
                 self.assertEqual(episode.get_puzzle(puzzle.get_relative_id()), puzzle, msg='A Puzzle\'s relative ID should retrieve it from its Episode')
 
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test_relative_ids_cached'}})
+    def test_relative_ids_cached(self):
+        episodes = EpisodeFactory.create_batch(2, event=self.tenant)
+        puzzles = PuzzleFactory.create_batch(2, episode=episodes[1])
+        episodes[1].get_relative_id()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [e.get_relative_id() for e in episodes],
+                [i + 1 for i, e in enumerate(sorted(episodes, key=lambda e: e.start_date))]
+            )
+            self.assertEqual([p.get_relative_id() for p in puzzles], [1, 2])
+            self.assertEqual(
+                puzzles[1].get_absolute_url(),
+                reverse('puzzle', kwargs={'episode_number': episodes[1].get_relative_id(), 'puzzle_number': 2})
+            )
+
+    def test_relative_ids_kept_for_request(self):
+        # No cache is configured here, so the numbering is only kept until the end of the request
+        episode = EpisodeFactory(event=self.tenant)
+        puzzles = PuzzleFactory.create_batch(3, episode=episode)
+
+        request_started.send(sender=self.__class__)
+        try:
+            with self.assertNumQueries(2):
+                urls = [p.get_absolute_url() for p in puzzles]
+                self.assertEqual([p.get_relative_id() for p in puzzles], [1, 2, 3])
+        finally:
+            request_finished.send(sender=self.__class__)
+        self.assertEqual(urls, [
+            reverse('puzzle', kwargs={'episode_number': 1, 'puzzle_number': i + 1}) for i in range(3)
+        ])
+
 
 class EpisodeSequenceTests(EventTestCase):
     def setUp(self):
@@ -655,6 +799,19 @@ class EpisodeSequenceTests(EventTestCase):
         with self.assertRaises(ValidationError), transaction.atomic():
             self.episode1.prequels.add(self.episode2)
 
+    def test_episode_graph(self):
+        episode3 = EpisodeFactory(event=self.event, prequels=self.episode2)
+        puzzle = PuzzleFactory(episode=self.episode2)
+
+        graph = episode_graph()
+        self.assertTrue(graph.follows(episode3.pk, self.episode1.pk))
+        self.assertFalse(graph.follows(self.episode1.pk, episode3.pk))
+        self.assertTrue(graph.unlocked(self.episode2.pk, set()))
+        self.assertFalse(graph.unlocked(episode3.pk, set()))
+        self.assertTrue(graph.unlocked(episode3.pk, {puzzle.pk}))
+        with self.assertRaises(ValidationError), transaction.atomic():
+            self.episode1.prequels.add(episode3)
+
     def test_episode_unlocking(self):
         puzzle = PuzzleFactory(episode=self.episode1)
 
@@ -711,6 +868,39 @@ class EpisodeSequenceTests(EventTestCase):
         self.assertEqual(response.status_code, 200)
 
 
+class PuzzleDataTests(EventTestCase):
+    def setUp(self):
+        self.user = UserProfileFactory()
+        self.puzzle = PuzzleFactory()
+        self.team = TeamFactory(at_event=self.puzzle.episode.event, members={self.user})
+
+    def test_load_and_save(self):
+        start_time = timezone.now()
+        # Missing data should be created together and then loaded
+        with self.assertNumQueries(3):
+            data = PuzzleData(self.puzzle, self.team, self.user)
+        self.assertIsNone(data.tp_data.start_time)
+        self.assertIsNotNone(data.up_data.token)
+        data.tp_data.start_time = start_time
+        data.up_data.data = {'key': ['value']}
+        data.save()
+
+        # Existing data should be loaded in one query
+        with self.assertNumQueries(1):
+            data = PuzzleData(self.puzzle, self.team, self.user)
+        self.assertEqual(data.tp_data.start_time, start_time)
+        self.assertEqual(data.up_data.data, {'key': ['value']})
+        self.assertEqual(data.up_data.puzzle, self.puzzle)
+
+        # Only changed data should be written back
+        with self.assertNumQueries(0):
+            data.save()
+        data.up_data.data['key'].append('other')
+        with self.assertNumQueries(1):
+            data.save()
+        self.assertEqual(UserPuzzleData.objects.get().data, {'key': ['value', 'other']})
+
+
 class ClueDisplayTests(EventTestCase):
     def setUp(self):
         self.episode = EpisodeFactory()
@@ -742,6 +932,76 @@ class ClueDisplayTests(EventTestCase):
         self.assertTrue(unlock.unlocked_by(self.team), "Unlock should be visible not it's been guessed")
         self.assertFalse(unlock.unlocked_by(other_team), "Unlock should not be visible to other team")
 
+    def test_unlock_answer_changes(self):
+        unlock = UnlockFactory(puzzle=self.puzzle)
+        unlock_answer = unlock.unlockanswer_set.get()
+        guess = GuessFactory.create(for_puzzle=self.puzzle, by=self.user, guess=unlock_answer.guess + '_changed')
+        self.assertFalse(unlock.unlocked_by(self.team))
+
+        # Changing the unlock answer should pick up existing guesses
+        unlock_answer.guess = guess.guess
+        unlock_answer.save()
+        self.assertEqual(unlock.unlocked_by(self.team), [guess])
+        self.assertEqual(self.puzzle.unlocks_by(self.team), [(unlock, [guess])])
+
+        unlock_answer.delete()
+        self.assertFalse(unlock.unlocked_by(self.team))
+        self.assertEqual(self.puzzle.unlocks_by(self.team), [])
+
+    def test_unlocks_only_found_for_new_guesses(self):
+        unlock = UnlockFactory(puzzle=self.puzzle)
+        unlock_answer = unlock.unlockanswer_set.get()
+        guess = GuessFactory.create(for_puzzle=self.puzzle, by=self.user, guess=unlock_answer.guess)
+        self.assertEqual(unlock.unlocked_by(self.team), [guess])
+
+        # Saving the guess again should leave its unlocks alone, even if they would be found differently now
+        UnlockAnswer.objects.filter(pk=unlock_answer.pk).update(guess=unlock_answer.guess + '_changed')
+        guess.save()
+        self.assertEqual(unlock.unlocked_by(self.team), [guess])
+
+
+class AnnouncementTests(EventTestCase):
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test_announcements_cached'}})
+    def test_announcements_cached(self):
+        puzzle = PuzzleFactory()
+        event_announcement = AnnouncementFactory(event=self.tenant, puzzle=None)
+        puzzle_announcement = AnnouncementFactory(event=self.tenant, puzzle=puzzle)
+        request = TenantRequestFactory(self.tenant).get('/irrelevant')
+        request.tenant = self.tenant
+        request.user = AnonymousUser()
+        context_processors.announcements(request)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(context_processors.announcements(request)['announcements'], [event_announcement])
+            request.puzzle = puzzle
+            self.assertEqual(context_processors.announcements(request)['announcements'], [event_announcement, puzzle_announcement])
+
+
+class WebsocketTests(EventTestCase):
+    def test_tenant_for_scope(self):
+        try:
+            scope = {'headers': [(b'host', f'{self.domain.domain}:8000'.encode())]}
+            self.assertEqual(consumers.tenant_for_scope(scope), self.tenant)
+            scope = {'headers': [(b'host', b'app:8000'), (b'x-forwarded-host', self.domain.domain.encode())]}
+            self.assertEqual(consumers.tenant_for_scope(scope), self.tenant)
+        finally:
+            connection.set_tenant(self.tenant)
+
+    def test_puzzle_socket_for_admin_without_team(self):
+        puzzle = PuzzleFactory()
+        user = UserProfileFactory().user
+        consumer = consumers.PuzzleWebsocket({
+            'headers': [(b'host', self.domain.domain.encode())],
+            'user': user,
+            'url_route': {'kwargs': {'episode_number': 1, 'puzzle_number': 1}},
+        })
+        try:
+            with mock.patch('hunts.rules.is_admin_for_puzzle', return_value=True):
+                self.assertEqual(consumer.setup(), [consumers.announcements_group(self.tenant)])
+        finally:
+            connection.set_tenant(self.tenant)
+        self.assertEqual(consumer.puzzle, puzzle)
+
 
 class FileUploadTests(EventTestCase):
     def setUp(self):
@@ -844,6 +1104,54 @@ class FileUploadTests(EventTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, solutionfile.url_path)
 
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test_content_cached'}})
+    def test_content_cached(self):
+        puzzle = PuzzleFactory()
+        puzzlefile = PuzzleFileFactory(puzzle=puzzle)
+        hints = [HintFactory(puzzle=puzzle, time=datetime.timedelta(minutes=m)) for m in (20, 10)]
+        content.event_files(self.tenant)
+        content.puzzle_files(puzzle)
+        content.hints(puzzle)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(content.event_files(self.tenant), {self.eventfile.slug: self.eventfile.file.url})
+            self.assertEqual(content.puzzle_files(puzzle), {puzzlefile.slug: puzzlefile.url_path})
+            self.assertEqual(content.hints(puzzle), hints[::-1])
+
+    def test_content_cached_without_cache(self):
+        # No cache is configured here, so content is only kept in this process
+        puzzle = PuzzleFactory()
+        puzzlefile = PuzzleFileFactory(puzzle=puzzle, slug='first')
+        content.puzzle_files(puzzle)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(content.puzzle_files(puzzle), {puzzlefile.slug: puzzlefile.url_path})
+
+        other_puzzlefile = PuzzleFileFactory(puzzle=puzzle, slug='second')
+        self.assertEqual(content.puzzle_files(puzzle), {
+            puzzlefile.slug: puzzlefile.url_path,
+            other_puzzlefile.slug: other_puzzlefile.url_path,
+        })
+
+    def test_content_local_size_limited(self):
+        with mock.patch('hunts.content.CONTENT_LOCAL_MAX_SIZE', 2):
+            for i in range(3):
+                content.substitute(f'text {i}', {})
+            (_, _, values) = content.content_cache._local[connection.schema_name]
+            self.assertEqual(len(values), 2)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test_static_text_cached'}})
+    def test_static_text_cached(self):
+        files = {self.eventfile.slug: self.eventfile.file.url}
+        text = f'${{{self.eventfile.slug}}}'
+        self.assertEqual(content.substitute(text, files), self.eventfile.file.url)
+        self.assertEqual(content.substitute(text, {self.eventfile.slug: '/other'}), '/other')
+
+        puzzle = PuzzleFactory(content=text)
+        data = PuzzleData(puzzle, TeamFactory(at_event=self.tenant, members={self.user}), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(content.render(puzzle.runtime, puzzle.content, files, data), self.eventfile.file.url)
+
 
 class AdminTeamTests(EventTestCase):
     def setUp(self):
@@ -869,6 +1177,16 @@ class AdminTeamTests(EventTestCase):
         response = self.client.get(reverse('guesses'))
         self.assertEqual(response.status_code, 200)
 
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test_admin_check_cached'}})
+    def test_admin_check_cached(self):
+        user = UserProfileFactory()
+        TeamFactory(at_event=self.event, members={user})
+        self.assertTrue(rules.is_admin_for_event(self.admin_user.user, self.event))
+
+        with self.assertNumQueries(0):
+            self.assertTrue(rules.is_admin_for_episode(self.admin_user.user, self.episode))
+            self.assertFalse(rules.is_admin_for_episode(user.user, self.episode))
+
 
 class AdminContentTests(EventTestCase):
     def setUp(self):
@@ -901,6 +1219,40 @@ class AdminContentTests(EventTestCase):
         response = self.client.get(f'{self.guesses_url}?episode={episode_id}')
         self.assertEqual(response.status_code, 200)
 
+    def test_guesses_pages(self):
+        self.client.force_login(self.admin_user.user)
+        page_size = views.GuessesContent.page_size
+        views.GuessesContent.page_size = 2
+        self.addCleanup(setattr, views.GuessesContent, 'page_size', page_size)
+        expected = sorted(self.guesses, key=lambda g: (g.given, g.id), reverse=True)
+
+        # Follow the older links back to the first guess
+        seen = []
+        response = self.client.get(self.guesses_url)
+        self.assertIsNone(response.context['newer'])
+        while True:
+            seen.extend(response.context['guesses'])
+            older = response.context['older']
+            if older is None:
+                break
+            response = self.client.get(self.guesses_url, {'before': older})
+        self.assertEqual(seen, expected)
+
+        # Guesses after a cursor are the ones given after it, newest first
+        response = self.client.get(self.guesses_url, {'after': utils.guess_cursor(expected[3])})
+        self.assertEqual(response.context['guesses'], expected[1:3])
+        self.assertEqual(response.context['newer'], utils.guess_cursor(expected[1]))
+        response = self.client.get(self.guesses_url, {'after': utils.guess_cursor(expected[0])})
+        self.assertEqual(response.context['guesses'], [])
+
+    def test_guesses_highlight_unlocks(self):
+        puzzle = self.guesses[0].for_puzzle
+        UnlockAnswerFactory(unlock__puzzle=puzzle, guess=self.guesses[0].guess)
+        self.client.force_login(self.admin_user.user)
+        response = self.client.get(self.guesses_url, {'highlight_unlocks': 1})
+        unlocked = [g for g in response.context['guesses'] if getattr(g, 'unlocked', False)]
+        self.assertEqual(unlocked, [self.guesses[0]])
+
     def test_can_view_stats(self):
         stats_url = reverse('stats_content')
         self.client.force_login(self.admin_user.user)
@@ -914,6 +1266,25 @@ class AdminContentTests(EventTestCase):
         response = self.client.get(stats_url)
         self.assertEqual(response.status_code, 200)
 
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test_stats_since_cursor'}})
+    def test_stats_since_cursor(self):
+        stats_url = reverse('stats_content')
+        self.client.force_login(self.admin_user.user)
+        data = self.client.get(stats_url).json()
+        self.assertIn('puzzleProgress', data)
+        self.assertIsNotNone(data['cursor'])
+
+        # Nothing has changed so only the series which depend on the time should be sent again
+        with self.assertNumQueries(0, using='default'):
+            since = stats.event_stats(self.tenant, since=str(data['cursor']))
+        self.assertNotIn('puzzleProgress', since)
+        self.assertIn('teamPuzzleStuckness', since)
+        self.assertEqual(since['cursor'], data['cursor'])
+
+        cache.incr(f'hunts.stats.{self.tenant.schema_name}.version')
+        data = self.client.get(stats_url, {'since': data['cursor']}).json()
+        self.assertIn('puzzleProgress', data)
+
 
 class ProgressionTests(EventTestCase):
     def setUp(self):
@@ -943,6 +1314,17 @@ class ProgressionTests(EventTestCase):
             self.assertEqual(puzzle1.answered_by(self.team1)[1], guess1)
             self.assertEqual(puzzle1.answered_by(self.team1)[2], guess2)
 
+    @override_settings(ASYNC_GUESSES=True, CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+    def test_guess_processed_later(self):
+        puzzle = PuzzleFactory(episode=self.episode)
+        guess = GuessFactory(for_puzzle=puzzle, by=self.user1, correct=True)
+        self.assertIsNotNone(guess.correct_for)
+        self.assertFalse(puzzle.solved_by(self.team1))
+
+        ingestion.process(self.tenant, guess.pk, True)
+        self.assertTrue(puzzle.solved_by(self.team1))
+        self.assertEqual(puzzle.answered_by(self.team1), [guess])
+
     def test_episode_finishing(self):
         # Ensure at least one puzzle in episode.
         puzzles = PuzzleFactory.create_batch(3, episode=self.episode)
@@ -1010,6 +1392,96 @@ class ProgressionTests(EventTestCase):
         # Ensure that the first correct guess is correctly returned
         self.assertEqual(puzzle1.first_correct_guesses(self.event)[self.team1], first_correct_guess)
 
+    def test_progress(self):
+        puzzle1 = PuzzleFactory(episode=self.episode)
+
+        GuessFactory(for_puzzle=puzzle1, by=self.user1, correct=False)
+        self.assertFalse(puzzle1.solved_by(self.team1))
+        self.assertFalse(TeamPuzzleProgress.objects.filter(puzzle=puzzle1).exists())
+
+        with freezegun.freeze_time() as frozen_datetime:
+            guess1 = GuessFactory(for_puzzle=puzzle1, by=self.user1, correct=True)
+            frozen_datetime.tick(datetime.timedelta(hours=1))
+            guess2 = GuessFactory(for_puzzle=puzzle1, by=self.user1, correct=True)
+
+        # The earliest correct guess is the one recorded
+        self.assertTrue(puzzle1.solved_by(self.team1))
+        self.assertFalse(puzzle1.solved_by(self.team2))
+        progress = TeamPuzzleProgress.objects.get(puzzle=puzzle1, team=self.team1)
+        self.assertEqual(progress.solving_guess, guess1)
+        self.assertEqual(progress.solved_at, guess1.given)
+
+        # Removing the solving guess falls back to the next correct one
+        guess1.delete()
+        progress = TeamPuzzleProgress.objects.get(puzzle=puzzle1, team=self.team1)
+        self.assertEqual(progress.solving_guess, guess2)
+
+        # Changing the answer so that no guesses are correct removes the progress
+        answer = puzzle1.answer_set.get()
+        answer.answer = AnswerFactory.build(runtime=answer.runtime).answer
+        answer.save()
+        self.assertFalse(puzzle1.solved_by(self.team1))
+
+        # And changing it back restores it
+        answer.answer = guess2.guess
+        answer.runtime = Runtime.STATIC
+        answer.save()
+        self.assertTrue(puzzle1.solved_by(self.team1))
+
+    def test_progress_keeps_earliest_solve(self):
+        puzzle1 = PuzzleFactory(episode=self.episode)
+        with freezegun.freeze_time() as frozen_datetime:
+            GuessFactory(for_puzzle=puzzle1, by=self.user1, correct=True)
+            # Guesses processed out of order only replace the progress if they were given earlier
+            frozen_datetime.tick(datetime.timedelta(minutes=-1))
+            guess2 = GuessFactory(for_puzzle=puzzle1, by=self.user1, correct=True)
+            frozen_datetime.tick(datetime.timedelta(minutes=2))
+            GuessFactory(for_puzzle=puzzle1, by=self.user1, correct=True)
+        progress = TeamPuzzleProgress.objects.get(puzzle=puzzle1, team=self.team1)
+        self.assertEqual(progress.solving_guess, guess2)
+        self.assertEqual(progress.solved_at, guess2.given)
+
+        # Recalculating progress re-evaluates out of date guesses without saving them again
+        Guess.objects.filter(for_puzzle=puzzle1).update(correct_current=False)
+        puzzle1.update_progress(self.team1)
+        self.assertTrue(Guess.objects.get(pk=guess2.pk).correct_current)
+        self.assertEqual(TeamPuzzleProgress.objects.get(puzzle=puzzle1, team=self.team1).solving_guess, guess2)
+
+    def test_progress_follows_team_membership(self):
+        puzzle1 = PuzzleFactory(episode=self.episode)
+        GuessFactory(for_puzzle=puzzle1, by=self.user1, correct=True)
+        self.assertTrue(puzzle1.solved_by(self.team1))
+
+        self.team1.members.set([])
+        self.team2.members.add(self.user1)
+
+        self.assertFalse(puzzle1.solved_by(self.team1))
+        self.assertTrue(puzzle1.solved_by(self.team2))
+
+    def test_rebuild_progress_command(self):
+        puzzle1 = PuzzleFactory(episode=self.episode)
+        puzzle2 = PuzzleFactory(episode=self.episode)
+        GuessFactory(for_puzzle=puzzle1, by=self.user1, correct=True)
+        GuessFactory(for_puzzle=puzzle2, by=self.user2, correct=True)
+        TeamPuzzleProgress.objects.all().delete()
+
+        output = StringIO()
+        call_command('rebuildprogress', puzzle_ids=[puzzle1.pk], stdout=output)
+        self.assertIn(f'{puzzle1}: 0 guesses changed', output.getvalue())
+        self.assertTrue(puzzle1.solved_by(self.team1))
+        self.assertFalse(puzzle2.solved_by(self.team2))
+        self.assertEqual(self.episode.finished_positions(), [])
+
+        call_command('rebuildprogress', stdout=output)
+        self.assertEqual(puzzle2.position(self.team2), 0)
+
+    def test_benchmark_guesses_command(self):
+        output = StringIO()
+        call_command('benchmarkguesses', guesses=200, puzzles=2, teams=3, stdout=output)
+        self.assertIn('Generated 200 guesses', output.getvalue())
+        self.assertIn('Puzzle.answered_by', output.getvalue())
+        self.assertFalse(Guess.objects.exists())
+
 
 class EventWinningTests(EventTestCase):
     fixtures = ["teams_test"]
@@ -1120,12 +1592,12 @@ class CorrectnessCacheTests(EventTestCase):
         self.assertTrue(guess2.correct_current)
         self.assertFalse(self.puzzle2.answered_by(self.team2))
 
-        # Alter the answer and check only the first guess is invalidated
+        # Alter the answer and check only the first guess is re-evaluated
         self.answer1.answer = AnswerFactory.build(runtime=self.answer1.runtime).answer
         self.answer1.save()
         guess1.refresh_from_db()
         guess2.refresh_from_db()
-        self.assertFalse(guess1.correct_current)
+        self.assertIsNone(guess1.correct_for)
         self.assertTrue(guess2.correct_current)
         self.assertFalse(guess1.get_correct_for())
         self.assertFalse(self.puzzle1.answered_by(self.team1))
@@ -1139,21 +1611,45 @@ class CorrectnessCacheTests(EventTestCase):
         self.answer1.delete()
         guess1.refresh_from_db()
         guess2.refresh_from_db()
-        self.assertFalse(guess1.correct_current)
+        self.assertIsNone(guess1.correct_for)
         self.assertTrue(guess2.correct_current)
         self.assertFalse(guess1.get_correct_for())
         self.assertFalse(self.puzzle1.answered_by(self.team1))
 
         # Add an answer that matches guess 2 and check
-        AnswerFactory(for_puzzle=self.puzzle2, runtime=Runtime.STATIC, answer=guess2.guess).save()
+        answer2 = AnswerFactory(for_puzzle=self.puzzle2, runtime=Runtime.STATIC, answer=guess2.guess)
         guess1.refresh_from_db()
         guess2.refresh_from_db()
         self.assertTrue(guess1.correct_current)
-        self.assertFalse(guess2.correct_current)
+        self.assertEqual(guess2.correct_for, answer2)
         self.assertFalse(self.puzzle1.answered_by(self.team1))
         self.assertTrue(guess2.get_correct_for())
         self.assertTrue(self.puzzle2.answered_by(self.team2))
 
+    def test_revalidate_guesses(self):
+        guess1 = GuessFactory(for_puzzle=self.puzzle1, by=self.user1, correct=True)
+        guess2 = GuessFactory(for_puzzle=self.puzzle1, by=self.user2, correct=False)
+        # Repeated guesses are validated together but should still all be updated
+        guess3 = GuessFactory(for_puzzle=self.puzzle1, by=self.user1, guess=guess2.guess)
+
+        # Nothing has changed, but stale guesses should be marked current again
+        Guess.objects.update(correct_current=False)
+        self.assertEqual(self.puzzle1.revalidate_guesses(chunk_size=1), 0)
+        self.assertFalse(Guess.objects.filter(correct_current=False).exists())
+
+        # Change the answer behind the puzzle's back so that only the second guess is correct
+        Answer.objects.filter(pk=self.answer1.pk).update(runtime=Runtime.STATIC, answer=guess2.guess)
+        validator_cache.clear()
+        self.assertEqual(self.puzzle1.revalidate_guesses(chunk_size=1), 3)
+        guess1.refresh_from_db()
+        guess2.refresh_from_db()
+        guess3.refresh_from_db()
+        self.assertIsNone(guess1.correct_for)
+        self.assertEqual(guess2.correct_for, self.answer1)
+        self.assertEqual(guess3.correct_for, self.answer1)
+        self.assertTrue(self.puzzle1.solved_by(self.team1))
+        self.assertTrue(self.puzzle1.solved_by(self.team2))
+
 
 class GuessTeamDenormalisationTests(EventTestCase):
     def setUp(self):
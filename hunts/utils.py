@@ -11,17 +11,27 @@
 # You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import uuid
 from collections import defaultdict
+from datetime import datetime, timedelta
+from django.core.cache import cache
+from django.db import transaction
 from django.http import Http404
+from django.urls import reverse
+from django.utils import timezone
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
 
 def event_episode(event, episode_number):
     from .models import Episode
+    from .ordinals import ordinals
 
-    episodes = event.episode_set.order_by('start_date')
-    ep_int = int(episode_number)
+    episode_id = ordinals().episode_id(int(episode_number))
+    if episode_id is None:
+        raise Http404
     try:
-        return episodes[ep_int - 1:ep_int].get()
+        return event.episode_set.get(pk=episode_id)
     except Episode.DoesNotExist as e:
         raise Http404 from e
 
@@ -56,3 +66,72 @@ def finishing_positions(event):
             team_times[team] = max(times)
 
     return sorted(team_times.keys(), key=lambda t: team_times[t])
+
+
+def next_puzzle_link(episode, team):
+    """Get the text and URL of the link to follow once the team has solved a puzzle in the episode"""
+    next = episode.next_puzzle(team)
+    if next:
+        return {
+            'text': 'to the next puzzle',
+            'url': reverse('puzzle', kwargs={'episode_number': episode.get_relative_id(), 'puzzle_number': next}),
+        }
+    else:
+        return {
+            'text': f'back to {episode.name}',
+            'url': episode.get_absolute_url(),
+        }
+
+
+def unlocks_json(puzzle, team, new_guess=None):
+    """Get the unlocks the team has for the puzzle as a list of dicts, marking those unlocked by new_guess as new"""
+    unlocks = []
+    for u, correct_guesses in puzzle.unlocks_by(team):
+        guesses = [g.guess for g in correct_guesses]
+        # Get rid of duplicates but preserve order
+        duplicates = set()
+        guesses = [g for g in guesses if not (g in duplicates or duplicates.add(g))]
+        unlocks.append({'guesses': guesses,
+                        'text': u.text,
+                        'new': new_guess in correct_guesses})
+    return unlocks
+
+
+def guess_cursor(guess):
+    """Get a URL-safe string identifying the guess's position in the guesses ordered by (given, id)"""
+    microseconds = (guess.given - EPOCH) // timedelta(microseconds=1)
+    return f'{microseconds}_{guess.id}'
+
+
+def parse_guess_cursor(cursor):
+    """Get the (given, id) pair from a string produced by guess_cursor, or None if it is not valid"""
+    try:
+        microseconds, id = cursor.split('_')
+        return EPOCH + timedelta(microseconds=int(microseconds)), uuid.UUID(id)
+    except (AttributeError, OverflowError, ValueError):
+        return None
+
+
+def cache_version(key):
+    """Get the version stored in the cache under key, or None if there is no cache to keep it in.
+
+    Values cached against a version must be recalculated once it has been bumped by bump_cache_version."""
+    version = cache.get(key)
+    if version is None:
+        # Start from the time rather than 1 so that values cached against a version which was evicted are not reused
+        cache.add(key, int(timezone.now().timestamp() * 1000), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_cache_version(key):
+    """Bump the version stored in the cache under key once the current transaction is committed."""
+    def bump():
+        try:
+            cache.incr(key)
+        except ValueError:
+            # There is no version so nothing can have been cached against it
+            pass
+
+    # Values calculated before the commit would not see the change, so must not be cached against the new version
+    transaction.on_commit(bump)
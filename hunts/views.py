@@ -11,16 +11,14 @@
 # You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
 
 from os import path
-from string import Template
 import tarfile
 
-from collections import defaultdict
 from datetime import datetime, timedelta
+from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import PermissionDenied, ValidationError
 from django.core.files import File
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
-from django.db.models import Count, OuterRef, Prefetch, Subquery
+from django.db.models import OuterRef, Prefetch, Q, Subquery
 from django.http import Http404, HttpResponse, HttpResponseForbidden, HttpResponseRedirect, JsonResponse
 from django.shortcuts import get_object_or_404, redirect
 from django.template.response import TemplateResponse
@@ -33,14 +31,15 @@ from django.views.generic.edit import FormView
 from sendfile import sendfile
 from teams.mixins import TeamMixin
 
-from . import models, rules, utils
+from . import content, models, ratelimit, rules, stats, utils
 from .forms import BulkUploadForm
 from .mixins import EpisodeUnlockedMixin, PuzzleAdminMixin, PuzzleUnlockedMixin
+from .ordinals import ordinals
+from .progress import TeamProgress
 from events.models import Attendance
 from events.utils import annotate_userprofile_queryset_with_seat
 
 import hunter2
-import teams
 
 
 class Index(TemplateView):
@@ -61,9 +60,9 @@ class EpisodeIndex(LoginRequiredMixin, TeamMixin, EpisodeUnlockedMixin, View):
 
 class EpisodeContent(LoginRequiredMixin, TeamMixin, EpisodeUnlockedMixin, View):
     def get(self, request, episode_number):
-        puzzles = request.episode.unlocked_puzzles(request.team)
+        puzzles = request.progress.unlocked_puzzles(request.episode)
         for puzzle in puzzles:
-            puzzle.done = puzzle.answered_by(request.team)
+            puzzle.done = request.progress.solved(puzzle)
 
         positions = request.episode.finished_positions()
         if request.team in positions:
@@ -76,8 +75,8 @@ class EpisodeContent(LoginRequiredMixin, TeamMixin, EpisodeUnlockedMixin, View):
         else:
             position = None
 
-        files = {f.slug: f.file.url for f in request.tenant.eventfile_set.filter(slug__isnull=False)}
-        flavour = Template(request.episode.flavour).safe_substitute(**files)
+        files = content.event_files(request.tenant)
+        flavour = content.substitute(request.episode.flavour, files)
 
         return TemplateResponse(
             request,
@@ -152,6 +151,8 @@ class Guesses(LoginRequiredMixin, View):
 
 
 class GuessesContent(LoginRequiredMixin, View):
+    page_size = 50
+
     def get(self, request):
         admin = rules.is_admin_for_event(request.user, request.tenant)
 
@@ -162,20 +163,10 @@ class GuessesContent(LoginRequiredMixin, View):
         puzzle = request.GET.get('puzzle')
         team = request.GET.get('team')
 
-        puzzles = models.Puzzle.objects.all()
-        if puzzle:
-            puzzles = puzzles.filter(id=puzzle)
-        if episode:
-            puzzles = puzzles.filter(episode=episode)
-
         # The following query is heavily optimised. We only retrieve the fields we will use here and
         # in the template, and we select and prefetch related objects so as not to perform any extra
         # queries.
-        all_guesses = models.Guess.objects.filter(
-            for_puzzle__in=puzzles,
-        ).order_by(
-            '-given'
-        ).select_related(
+        all_guesses = models.Guess.objects.select_related(
             'for_puzzle', 'by_team', 'by__user', 'correct_for'
         ).only(
             'given', 'guess', 'correct_current',
@@ -194,35 +185,60 @@ class GuessesContent(LoginRequiredMixin, View):
             )
         )
 
+        if puzzle:
+            all_guesses = all_guesses.filter(for_puzzle=puzzle)
+        if episode:
+            all_guesses = all_guesses.filter(for_puzzle__episode=episode)
         if team:
-            team = teams.models.Team.objects.get(id=team)
             all_guesses = all_guesses.filter(by_team=team)
 
-        guess_pages = Paginator(all_guesses, 50)
-        page = request.GET.get('page')
-        try:
-            guesses = guess_pages.page(page)
-        except PageNotAnInteger:
-            guesses = guess_pages.page(1)
-        except EmptyPage:
-            guesses = guess_pages.page(guess_pages.num_pages)
+        # Pages are found from the (given, id) of the guess at their edge rather than by counting guesses, so that
+        # they can be read straight from the index however many guesses there are.
+        before = utils.parse_guess_cursor(request.GET.get('before'))
+        after = utils.parse_guess_cursor(request.GET.get('after'))
+        if after:
+            given, id = after
+            # The redundant bound on given lets the database start reading the index at the cursor
+            guesses = list(all_guesses.filter(
+                Q(given__gt=given) | Q(given=given, id__gt=id), given__gte=given
+            ).order_by('given', 'id')[:self.page_size + 1])
+            has_newer = len(guesses) > self.page_size
+            guesses = guesses[:self.page_size][::-1]
+            has_older = True
+        else:
+            if before:
+                given, id = before
+                all_guesses = all_guesses.filter(Q(given__lt=given) | Q(given=given, id__lt=id), given__lte=given)
+            guesses = list(all_guesses.order_by('-given', '-id')[:self.page_size + 1])
+            has_older = len(guesses) > self.page_size
+            guesses = guesses[:self.page_size]
+            has_newer = bool(before)
 
         if request.GET.get('highlight_unlocks'):
+            # Which unlocks each guess unlocks is stored when the guess or unlock changes, so need not be worked out here
+            unlocking = set(models.Guess.unlocks.through.objects.filter(
+                guess__in=guesses
+            ).values_list('guess_id', flat=True))
             for g in guesses:
-                unlockanswers = models.UnlockAnswer.objects.filter(unlock__puzzle=g.for_puzzle)
-                if any([a.validate_guess(g) for a in unlockanswers]):
+                if g.id in unlocking:
                     g.unlocked = True
 
         # Grab the current URL (which is not the URL of *this* view) so that we can manipulate the query string
         # in the template.
+        params = request.GET.copy()
+        params.pop('before', None)
+        params.pop('after', None)
         current_url = reverse('guesses')
-        current_url += '?' + request.GET.urlencode()
+        current_url += '?' + params.urlencode()
 
         return TemplateResponse(
             request,
             'hunts/guesses_content.html',
             context={
                 'guesses': guesses,
+                'newest': utils.guess_cursor(guesses[0]) if guesses else None,
+                'newer': utils.guess_cursor(guesses[0]) if guesses and has_newer else None,
+                'older': utils.guess_cursor(guesses[-1]) if guesses and has_older else None,
                 'current_url': current_url
             }
         )
@@ -249,115 +265,11 @@ class StatsContent(LoginRequiredMixin, View):
         if not admin:
             raise PermissionDenied
 
-        now = timezone.now()
-        end_time = min(now, request.tenant.end_date) + timedelta(minutes=10)
-
-        # TODO select and prefetch all the things
-        episodes = models.Episode.objects.filter(event=request.tenant).order_by('start_date')
+        episode = None
         if episode_id is not None:
-            episodes = episodes.filter(pk=episode_id)
-            if not episodes.exists():
-                raise Http404
-
-        puzzles = models.Puzzle.objects.all()
-
-        all_teams = teams.models.Team.objects.annotate(
-            num_members=Count('members')
-        ).filter(
-            at_event=request.tenant,
-            is_admin=False,
-            num_members__gte=1,
-        ).prefetch_related('members', 'members__user')
-
-        # Get the first correct guess for each team on each puzzle.
-        # We use Guess.correct_for (i.e. the cache) because otherwise we perform a query for every
-        # (team, puzzle) pair i.e. a butt-ton. This comes at the cost of possibly seeing
-        # a team doing worse than it really is.
-        all_guesses = models.Guess.objects.filter(
-            correct_for__isnull=False,
-        ).select_related('for_puzzle', 'by_team')
-        correct_guesses = defaultdict(dict)
-        for guess in all_guesses:
-            team_guesses = correct_guesses[guess.for_puzzle]
-            if guess.by_team not in team_guesses or guess.given < team_guesses[guess.by_team].given:
-                team_guesses[guess.by_team] = guess
-
-        # Get when each team started each puzzle, and in how much time they solved each puzzle if they did.
-        puzzle_datas = models.TeamPuzzleData.objects.filter(puzzle__in=puzzles, team__in=all_teams).select_related('puzzle', 'team')
-        start_times = defaultdict(lambda: defaultdict(dict))
-        solved_times = defaultdict(list)
-        for data in puzzle_datas:
-            if data.team in correct_guesses[data.puzzle] and data.start_time:
-                start_times[data.team][data.puzzle] = None
-                solved_times[data.puzzle].append(correct_guesses[data.puzzle][data.team].given - data.start_time)
-            else:
-                start_times[data.team][data.puzzle] = data.start_time
-
-        # How long a team has been on a puzzle.
-        stuckness = {
-            team: [
-                now - start for start in start_times[team].values() if start
-            ] for team in all_teams
-        }
-        # How many teams have been active on each puzzle
-        num_active_teams = {
-            puzzle: len([1 for t in all_teams if start_times[t][puzzle]])
-            for puzzle in puzzles
-        }
+            episode = get_object_or_404(models.Episode, pk=episode_id, event=request.tenant)
 
-        # Now assemble all the stats ready for giving back to the user
-        puzzle_progress = [
-            {
-                'team': t.get_verbose_name(),
-                'progress': [{
-                    'puzzle': p.title,
-                    'time': correct_guesses[p][t].given
-                } for p in puzzles if t in correct_guesses[p]]
-            } for t in all_teams]
-        puzzle_completion = [
-            {
-                'puzzle': p.title,
-                'completion': len(correct_guesses[p])
-            } for p in puzzles]
-        team_puzzle_stuckness = [
-            {
-                'team': t.get_verbose_name(),
-                'puzzleStuckness': [{
-                    'puzzle': p.title,
-                    'stuckness': (now - start_times[t][p]).total_seconds()
-                } for p in puzzles if start_times[t][p]]
-            } for t in all_teams]
-        team_total_stuckness = [
-            {
-                'team': t.get_verbose_name(),
-                'stuckness': sum(stuckness[t], timedelta()).total_seconds(),
-            } for t in all_teams]
-        puzzle_average_stuckness = [
-            {
-                'puzzle': p.title,
-                'stuckness': sum([
-                    now - start_times[t][p] for t in all_teams if start_times[t][p]
-                ], timedelta()).total_seconds() / num_active_teams[p]
-            } for p in puzzles if num_active_teams[p] > 0]
-        puzzle_difficulty = [
-            {
-                'puzzle': p.title,
-                'average_time': sum(solved_times[p], timedelta()).total_seconds() / len(solved_times[p])
-            } for p in puzzles if solved_times[p]]
-
-        data = {
-            'teams': [t.get_verbose_name() for t in all_teams],
-            'numTeams': all_teams.count(),
-            'startTime': min([e.start_date for e in episodes]),
-            'endTime': end_time,
-            'puzzles': [p.title for p in puzzles],
-            'puzzleCompletion': puzzle_completion,
-            'puzzleProgress': puzzle_progress,
-            'teamTotalStuckness': team_total_stuckness,
-            'teamPuzzleStuckness': team_puzzle_stuckness,
-            'puzzleAverageStuckness': puzzle_average_stuckness,
-            'puzzleDifficulty': puzzle_difficulty
-        }
+        data = stats.event_stats(request.tenant, episode, since=request.GET.get('since'))
         return JsonResponse(data)
 
 
@@ -382,15 +294,17 @@ class EventIndex(LoginRequiredMixin, View):
         else:
             position = None
 
+        progress = TeamProgress(event, request.team)
         episodes = [
             e for e in
             models.Episode.objects.filter(event=event.id).order_by('start_date')
-            if e.started(request.team)
+            if progress.episode_started(e)
         ]
 
         # Annotate the episodes with their position in the event.
+        numbers = ordinals()
         for episode in episodes:
-            episode.index = episode.get_relative_id()
+            episode.index = numbers.episode_number(episode.pk)
 
         return TemplateResponse(
             request,
@@ -414,16 +328,12 @@ class Puzzle(LoginRequiredMixin, TeamMixin, PuzzleUnlockedMixin, View):
         if not data.tp_data.start_time:
             data.tp_data.start_time = now
 
-        answered = puzzle.answered_by(request.team)
+        answered = puzzle.answered_by(request.team) if request.progress.solved(puzzle) else []
         hints = [
-            h for h in puzzle.hint_set.all().order_by('time') if h.unlocked_by(request.team, data)
+            h for h in content.hints(puzzle) if h.unlocked_by(request.team, data)
         ]
         unlocks = []
-        for u in puzzle.unlock_set.all():
-            guesses = u.unlocked_by(request.team)
-            if not guesses:
-                continue
-
+        for u, guesses in puzzle.unlocks_by(request.team):
             guesses = [g.guess for g in guesses]
             # Get rid of duplicates but preserve order
             duplicates = set()
@@ -431,26 +341,19 @@ class Puzzle(LoginRequiredMixin, TeamMixin, PuzzleUnlockedMixin, View):
             unlock_text = mark_safe(u.text)  # nosec unlock text is provided by puzzle admins, we consider this safe
             unlocks.append({'guesses': guesses, 'text': unlock_text})
 
-        event_files = {f.slug: f.file.url for f in request.tenant.eventfile_set.filter(slug__isnull=False)}
-        puzzle_files = {f.slug: reverse(
+        event_files = content.event_files(request.tenant)
+        puzzle_files = {slug: reverse(
             'puzzle_file',
             kwargs={
                 'episode_number': episode_number,
                 'puzzle_number': puzzle_number,
-                'file_path': f.url_path,
-            }) for f in puzzle.puzzlefile_set.filter(slug__isnull=False)
+                'file_path': url_path,
+            }) for slug, url_path in content.puzzle_files(puzzle).items()
         }
         files = {**event_files, **puzzle_files}  # Puzzle files with matching slugs override hunt counterparts
 
-        text = Template(puzzle.runtime.create().evaluate(
-            puzzle.content,
-            data.tp_data,
-            data.up_data,
-            data.t_data,
-            data.u_data,
-        )).safe_substitute(**files)
-
-        flavour = Template(puzzle.flavour).safe_substitute(**files)
+        text = content.render(puzzle.runtime, puzzle.content, files, data)
+        flavour = content.substitute(puzzle.flavour, files)
 
         ended = request.tenant.end_date < now
 
@@ -486,32 +389,26 @@ class SolutionContent(LoginRequiredMixin, TeamMixin, PuzzleUnlockedMixin, View):
 
         data = models.PuzzleData(request.puzzle, request.team, request.user.profile)
 
-        event_files = {f.slug: f.file.url for f in request.tenant.eventfile_set.filter(slug__isnull=False)}
-        puzzle_files = {f.slug: reverse(
+        event_files = content.event_files(request.tenant)
+        puzzle_files = {slug: reverse(
             'puzzle_file',
             kwargs={
                 'episode_number': episode_number,
                 'puzzle_number': puzzle_number,
-                'file_path': f.url_path,
-            }) for f in puzzle.puzzlefile_set.filter(slug__isnull=False)
+                'file_path': url_path,
+            }) for slug, url_path in content.puzzle_files(puzzle).items()
         }
-        solution_files = {f.slug: reverse(
+        solution_files = {slug: reverse(
             'solution_file',
             kwargs={
                 'episode_number': episode_number,
                 'puzzle_number': puzzle_number,
-                'file_path': f.url_path,
-            }) for f in puzzle.solutionfile_set.filter(slug__isnull=False)
+                'file_path': url_path,
+            }) for slug, url_path in content.solution_files(puzzle).items()
         }
         files = {**event_files, **puzzle_files, **solution_files}  # Solution files override puzzle files, which override event files.
 
-        text = Template(request.puzzle.soln_runtime.create().evaluate(
-            request.puzzle.soln_content,
-            data.tp_data,
-            data.up_data,
-            data.t_data,
-            data.u_data,
-        )).safe_substitute(**files)
+        text = content.render(request.puzzle.soln_runtime, request.puzzle.soln_content, files, data)
 
         return HttpResponse(text)
 
@@ -538,20 +435,6 @@ class Answer(LoginRequiredMixin, TeamMixin, PuzzleUnlockedMixin, View):
     def post(self, request, episode_number, puzzle_number):
         now = timezone.now()
 
-        minimum_time = timedelta(seconds=5)
-        try:
-            latest_guess = models.Guess.objects.filter(
-                for_puzzle=request.puzzle,
-                by=request.user.profile
-            ).order_by(
-                '-given'
-            )[0]
-        except IndexError:
-            pass
-        else:
-            if latest_guess.given + minimum_time > now:
-                return JsonResponse({'error': 'too fast'}, status=429)
-
         given_answer = request.POST.get('answer', '')
         if given_answer == '':
             return JsonResponse({'error': 'no answer given'}, status=400)
@@ -559,67 +442,60 @@ class Answer(LoginRequiredMixin, TeamMixin, PuzzleUnlockedMixin, View):
         if request.tenant.end_date < now:
             return JsonResponse({'error': 'event is over'}, status=400)
 
+        minimum_time = timedelta(seconds=ratelimit.guess_limiter.interval)
+        allowed = ratelimit.guess_limiter.allow(f'{request.puzzle.pk}.{request.user.pk}', now)
+        if allowed is None:
+            # There is no cache to count guesses in, so check the time since the last one instead
+            try:
+                latest_guess = models.Guess.objects.filter(
+                    for_puzzle=request.puzzle,
+                    by=request.user.profile
+                ).order_by(
+                    '-given'
+                )[0]
+            except IndexError:
+                allowed = True
+            else:
+                allowed = latest_guess.given + minimum_time <= now
+        if not allowed:
+            return JsonResponse({'error': 'too fast'}, status=429)
+
         data = models.PuzzleData(request.puzzle, request.team)
 
         last_updated = request.POST.get('last_updated')
         if last_updated and data.tp_data.start_time:
             last_updated = datetime.fromtimestamp(int(last_updated) // 1000, timezone.utc)
-            new_hints = request.puzzle.hint_set.filter(
-                time__gt=(last_updated - data.tp_data.start_time),
-                time__lt=(now - data.tp_data.start_time),
-            )
-            new_hints = [{'time': str(hint.time), 'text': hint.text} for hint in new_hints]
+            new_hints = [
+                {'time': str(hint.time), 'text': hint.text} for hint in content.hints(request.puzzle)
+                if last_updated - data.tp_data.start_time < hint.time < now - data.tp_data.start_time
+            ]
         else:
             new_hints = []
 
-        # Put answer in DB
+        # Put answer in DB. Saving validates it against the puzzle's answers.
         guess = models.Guess(
             guess=given_answer,
             for_puzzle=request.puzzle,
-            by=request.user.profile
+            by=request.user.profile,
+            by_team=request.team,
         )
         guess.save()
 
-        correct = any([a.validate_guess(guess) for a in request.puzzle.answer_set.all()])
+        correct = guess.correct_for is not None
 
-        # Build the response JSON depending on whether the answer was correct
+        # Build the response JSON depending on whether the answer was correct. When the guess's effects on progress and
+        # unlocks are being worked out in the background, the next puzzle and unlocks are pushed over the websocket.
         response = {}
         if correct:
-            next = request.episode.next_puzzle(request.team)
-            if next:
-                response['text'] = f'to the next puzzle'
-                response['url'] = reverse('puzzle', kwargs={'episode_number': episode_number, 'puzzle_number': next})
-            else:
-                response['text'] = f'back to {request.episode.name}'
-                response['url'] = request.episode.get_absolute_url()
+            if not settings.ASYNC_GUESSES:
+                response.update(utils.next_puzzle_link(request.episode, request.team))
         else:
-            all_unlocks = models.Unlock.objects.filter(
-                puzzle=request.puzzle
-            ).select_related(
-                'puzzle'
-            ).prefetch_related(
-                'unlockanswer_set'
-            )
-
-            unlocks = []
-            for u in all_unlocks:
-                correct_guesses = u.unlocked_by(request.team)
-                if not correct_guesses:
-                    continue
-
-                guesses = [g.guess for g in correct_guesses]
-                # Get rid of duplicates but preserve order
-                duplicates = set()
-                guesses = [g for g in guesses if not (g in duplicates or duplicates.add(g))]
-                unlocks.append({'guesses': guesses,
-                                'text': u.text,
-                                'new': guess in correct_guesses})
-
             response['guess'] = given_answer
             response['timeout_length'] = minimum_time.total_seconds() * 1000
             response['timeout_end'] = str(now + minimum_time)
             response['new_hints'] = new_hints
-            response['unlocks'] = unlocks
+            if not settings.ASYNC_GUESSES:
+                response['unlocks'] = utils.unlocks_json(request.puzzle, request.team, guess)
         response['correct'] = str(correct).lower()
 
         return JsonResponse(response)
@@ -632,9 +508,13 @@ class Callback(LoginRequiredMixin, TeamMixin, PuzzleUnlockedMixin, View):
         if 'application/json' not in request.META['HTTP_ACCEPT']:
             return HttpResponse(status=406)
 
-        if request.tenant.end_date < timezone.now():
+        now = timezone.now()
+        if request.tenant.end_date < now:
             return JsonResponse({'error': 'event is over'}, status=400)
 
+        if ratelimit.callback_limiter.allow(f'{request.puzzle.pk}.{request.user.pk}', now) is False:
+            return JsonResponse({'error': 'too fast'}, status=429)
+
         data = models.PuzzleData(request.puzzle, request.team, request.user.profile)
 
         response = HttpResponse(
@@ -689,14 +569,14 @@ class AboutView(TemplateView):
         context = super().get_context_data(**kwargs)
         admin_team = self.request.tenant.teams.get(is_admin=True)
 
-        files = {f.slug: f.file.url for f in self.request.tenant.eventfile_set.filter(slug__isnull=False)}
-        content = Template(self.request.tenant.about_text).safe_substitute(**files)
+        files = content.event_files(self.request.tenant)
+        text = content.substitute(self.request.tenant.about_text, files)
 
         admin_members = annotate_userprofile_queryset_with_seat(admin_team.members, self.request.tenant)
 
         context.update({
             'admins': admin_members,
-            'content': content,
+            'content': text,
             'event_name': self.request.tenant.name,
         })
         return context
@@ -708,11 +588,11 @@ class RulesView(TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        files = {f.slug: f.file.url for f in self.request.tenant.eventfile_set.filter(slug__isnull=False)}
-        content = Template(self.request.tenant.rules_text).safe_substitute(**files)
+        files = content.event_files(self.request.tenant)
+        text = content.substitute(self.request.tenant.rules_text, files)
 
         context.update({
-            'content': content,
+            'content': text,
             'event_name': self.request.tenant.name,
         })
         return context
@@ -724,11 +604,11 @@ class HelpView(TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        files = {f.slug: f.file.url for f in self.request.tenant.eventfile_set.filter(slug__isnull=False)}
-        content = Template(self.request.tenant.help_text).safe_substitute(**files)
+        files = content.event_files(self.request.tenant)
+        text = content.substitute(self.request.tenant.help_text, files)
 
         context.update({
-            'content': content,
+            'content': text,
             'event_name': self.request.tenant.name,
         })
         return context
@@ -740,11 +620,11 @@ class ExamplesView(TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        files = {f.slug: f.file.url for f in self.request.tenant.eventfile_set.filter(slug__isnull=False)}
-        content = Template(self.request.tenant.examples_text).safe_substitute(**files)
+        files = content.event_files(self.request.tenant)
+        text = content.substitute(self.request.tenant.examples_text, files)
 
         context.update({
-            'content': content,
+            'content': text,
             'event_name': self.request.tenant.name,
         })
         return context
@@ -0,0 +1,71 @@
+# Copyright (C) 2018 The Hunter2 Contributors.
+#
+# This file is part of Hunter2.
+#
+# Hunter2 is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any later version.
+#
+# Hunter2 is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE.  See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with Hunter2.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from django.core.cache import cache
+from django.db import transaction
+
+from accounts.models import UserInfo, UserProfile
+from events.models import Attendance
+from .models import Team
+
+IDENTITY_CACHE_TIMEOUT = 5 * 60  # Seconds
+
+
+class Identity:
+    """The profile, info, attendance and team of a user at an event, which are needed on almost every request."""
+    def __init__(self, profile, info, attendance, team):
+        self.profile = profile
+        self.info = info
+        self.attendance = attendance
+        self.team = team
+
+
+def _key(user_id, event_id):
+    return f'teams.identity.event-{event_id}.user-{user_id}'
+
+
+def _load(user, event):
+    try:
+        attendance = Attendance.objects.select_related(
+            'user_info__user__profile',
+        ).get(user_info__user=user, event=event)
+        info = attendance.user_info
+        profile = info.user.profile
+    except (Attendance.DoesNotExist, UserProfile.DoesNotExist):
+        # The user has not visited this event before, so create whichever of their records are missing
+        (profile, _) = UserProfile.objects.get_or_create(user=user)
+        (info, _) = UserInfo.objects.get_or_create(user=user)
+        (attendance, _) = info.attendance_set.get_or_create(event=event)
+
+    team = Team.objects.filter(at_event=event, members=profile).first()
+    return Identity(profile, info, attendance, team)
+
+
+def resolve_identity(user, event):
+    """Return the Identity of the user at the event, creating the profile, info and attendance if they do not exist.
+
+    The result is cached until the user's attendance or team at the event changes."""
+    key = _key(user.pk, event.pk)
+    identity = cache.get(key)
+    if identity is None:
+        identity = _load(user, event)
+        cache.set(key, identity, IDENTITY_CACHE_TIMEOUT)
+    return identity
+
+
+def invalidate_identities(user_ids, event_id):
+    """Drop the cached Identities of the users with the given IDs at the event once the current transaction is
+    committed."""
+    keys = [_key(user_id, event_id) for user_id in user_ids]
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
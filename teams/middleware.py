@@ -12,7 +12,7 @@
 
 
 from accounts.models import UserProfile
-from .models import Team
+from .identity import resolve_identity
 
 
 class TeamMiddleware(object):
@@ -28,13 +28,10 @@ class TeamMiddleware(object):
         if not request.user.is_authenticated:
             return
 
-        (user, _) = UserProfile.objects.get_or_create(user=request.user)
-
         if request.tenant is not None:
-            try:
-                request.team = user.teams.get(at_event=request.tenant)
-            except Team.DoesNotExist:
-                request.team = None
-                # TODO: User has no team for this event. Redirect to team creation?
-                pass
+            identity = getattr(request, 'identity', None) or resolve_identity(request.user, request.tenant)
+            # TODO: User has no team for this event if this is None. Redirect to team creation?
+            request.team = identity.team
             return
+
+        UserProfile.objects.get_or_create(user=request.user)
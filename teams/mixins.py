@@ -19,12 +19,14 @@ from .models import Team
 
 class TeamMixin():
     def dispatch(self, request, *args, **kwargs):
+        if getattr(request, 'team', None) is not None:
+            # Already found by TeamMiddleware
+            return super().dispatch(request, *args, **kwargs)
         try:
             user = request.user.profile
         except ObjectDoesNotExist:
             user = UserProfile(user=request.user)
             user.save()
-        # TODO: May conflict with assignment of request.team in TeamMiddleware but shouldn't cause problems
         try:
             request.team = user.team_at(request.tenant)
         except ObjectDoesNotExist:
@@ -12,9 +12,11 @@
 
 
 from django.core.exceptions import ValidationError
-from django.db.models.signals import m2m_changed
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.dispatch import receiver
-from accounts.models import UserProfile
+from accounts.models import UserInfo, UserProfile
+from events.models import Attendance
+from .identity import invalidate_identities
 from .models import Team
 
 
@@ -28,3 +30,40 @@ def members_changed(sender, instance, action, pk_set, **kwargs):
             if Team.objects.exclude(pk=instance.pk).filter(at_event=instance.at_event).filter(members=user).count() > 0:
                 pk_set.remove(user_id)
                 raise ValidationError('User can only join one team per same event')
+
+
+@receiver(m2m_changed, sender=Team.members.through)
+def members_identity_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # Clearing does not say which members were removed, so they are looked up beforehand
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        users = instance.members.all() if action == 'pre_clear' else UserProfile.objects.filter(pk__in=pk_set)
+        invalidate_identities([u.user_id for u in users], instance.at_event_id)
+    else:
+        teams = instance.teams.all() if action == 'pre_clear' else Team.objects.filter(pk__in=pk_set)
+        for event_id in {t.at_event_id for t in teams}:
+            invalidate_identities([instance.user_id], event_id)
+
+
+@receiver(post_save, sender=Team)
+@receiver(pre_delete, sender=Team)
+def team_identity_changed(sender, instance, **kwargs):
+    invalidate_identities(instance.members.values_list('user_id', flat=True), instance.at_event_id)
+
+
+@receiver(post_save, sender=Attendance)
+@receiver(post_delete, sender=Attendance)
+def attendance_changed(sender, instance, **kwargs):
+    invalidate_identities([instance.user_info.user_id], instance.event_id)
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+@receiver(post_save, sender=UserInfo)
+@receiver(post_delete, sender=UserInfo)
+def user_identity_changed(sender, instance, **kwargs):
+    # Identities hold the user's profile and info at every event they attend, so all of them are out of date
+    event_ids = Attendance.objects.filter(user_info__user_id=instance.user_id).values_list('event_id', flat=True)
+    for event_id in event_ids:
+        invalidate_identities([instance.user_id], event_id)
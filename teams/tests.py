@@ -15,6 +15,7 @@ import json
 
 from django.core.exceptions import ValidationError
 from django.http import HttpResponse
+from django.test import override_settings
 from django.urls import reverse
 from django.views import View
 from django_tenants.test.client import TenantRequestFactory
@@ -22,9 +23,10 @@ from django_tenants.test.client import TenantRequestFactory
 from accounts.factories import UserFactory, UserProfileFactory
 from accounts.models import UserProfile
 from events.factories import EventFactory
-from events.models import Event
+from events.models import Attendance, Event
 from events.test import EventAwareTestCase, EventTestCase
 from .factories import TeamFactory
+from .identity import resolve_identity
 from .mixins import TeamMixin
 from .models import Team
 
@@ -113,6 +115,23 @@ class TeamCreateTests(EventTestCase):
         Team.objects.get(members=profile)
 
 
+class IdentityTests(EventTestCase):
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test_identity_cached'}})
+    def test_identity_cached(self):
+        user = UserFactory()
+        identity = resolve_identity(user, self.tenant)
+        self.assertEqual(identity.profile, UserProfile.objects.get(user=user))
+        self.assertEqual(identity.attendance, Attendance.objects.get(user_info__user=user, event=self.tenant))
+        self.assertIsNone(identity.team)
+
+        user = UserProfileFactory().user
+        team = TeamFactory(at_event=self.tenant, members={user.profile})
+        resolve_identity(user, self.tenant)
+        with self.assertNumQueries(0):
+            identity = resolve_identity(user, self.tenant)
+        self.assertEqual(identity.team, team)
+
+
 class InviteTests(EventTestCase):
     def setUp(self):
         self.event = self.tenant